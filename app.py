@@ -1,14 +1,34 @@
 # app.py
-from flask import Flask, render_template, request, redirect, session, url_for, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, session, url_for, flash, send_from_directory, g, has_request_context, make_response, jsonify
 import sqlite3
 import os
 from datetime import date, datetime, timedelta
 import shutil
 from functools import wraps
-from werkzeug.utils import secure_filename
+from contextlib import contextmanager
+from collections import OrderedDict
+from werkzeug.utils import secure_filename, send_from_directory as werkzeug_send_from_directory
 import time
 import re
 import hashlib
+import posixpath
+import threading
+import queue
+import atexit
+import zlib
+import gzip
+import json
+import base64
+import bisect
+import secrets
+
+import click
+
+try:
+    # opcional: miniaturas de las fotos de reparaciones
+    from PIL import Image, ImageOps, features, UnidentifiedImageError
+except ImportError:
+    Image = ImageOps = features = UnidentifiedImageError = None
 
 # =========================
 # Config general
@@ -18,9 +38,11 @@ app.secret_key = "clave_ultra_secreta_local"
 
 DB_NAME = "database.db"
 BACKUP_FOLDER = "backups"
+SUBIDAS_FOLDER = "subidas"   # subidas por partes a medio terminar (no se sirve)
 
 UPLOAD_FOLDER = os.path.join("static", "uploads")
 UPLOAD_DIAG_FOLDER = os.path.join("static", "uploads", "diagnosticos")
+UPLOAD_VARIANTES_FOLDER = os.path.join("static", "uploads", "variantes")
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 
@@ -34,12 +56,89 @@ ESTADOS = ["Presupuesto", "Ingresado", "Entregado", "Facturado"]
 # =========================
 # Helpers generales
 # =========================
-def get_con():
-    con = sqlite3.connect(DB_NAME)
+# Perfil de PRAGMAs que se aplica a todas las conexiones
+SQLITE_PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),       # seguro en WAL, evita un fsync por commit
+    ("cache_size", -16000),          # ~16 MB de caché de páginas por conexión
+    ("mmap_size", 64 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", 5000),
+    ("foreign_keys", "ON"),
+]
+POOL_CONEXIONES_MAX = 8
+
+_pool_conexiones = queue.LifoQueue(maxsize=POOL_CONEXIONES_MAX)
+
+
+def _abrir_conexion(check_same_thread=True, path=None):
+    con = sqlite3.connect(path or DB_NAME, check_same_thread=check_same_thread)
     con.row_factory = sqlite3.Row
+    for nombre, valor in SQLITE_PRAGMAS:
+        con.execute(f"PRAGMA {nombre}={valor}")
+    # los checkpoints los maneja el archivador de WAL (ver "WAL: archivo continuo")
+    con.execute(f"PRAGMA wal_autocheckpoint={WAL_AUTOCHECKPOINT_PAGINAS}")
     return con
 
 
+def get_con(path=None):
+    """
+    Conexión suelta, para scripts y código fuera de un request.
+    La cierra quien la pide.
+    """
+    return _abrir_conexion(path=path)
+
+
+def get_db():
+    """
+    Conexión del request actual. Sale de un pool (así la caché de páginas
+    sobrevive entre requests) y vuelve al pool en el teardown.
+    """
+    if "db" not in g:
+        try:
+            g.db = _pool_conexiones.get_nowait()
+        except queue.Empty:
+            g.db = _abrir_conexion(check_same_thread=False)
+    return g.db
+
+
+@app.teardown_appcontext
+def liberar_db(exc):
+    con = g.pop("db", None)
+    if con is None:
+        return
+
+    try:
+        if con.in_transaction:
+            con.rollback()
+        _pool_conexiones.put_nowait(con)
+    except (queue.Full, sqlite3.Error):
+        con.close()
+
+
+@contextmanager
+def transaccion(con=None):
+    """
+    with transaccion() as cur: ...
+    Abre BEGIN IMMEDIATE, hace commit al salir o rollback si hay excepción.
+    Dentro de un request, avisa al worker de backup después del commit.
+    """
+    con = con or get_db()
+    if not con.in_transaction:
+        con.execute("BEGIN IMMEDIATE")
+
+    cur = con.cursor()
+    try:
+        yield cur
+    except BaseException:
+        con.rollback()
+        raise
+
+    con.commit()
+    if has_request_context():
+        solicitar_backup()
+
+
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -64,6 +163,14 @@ def limpiar_vin(vin: str) -> str:
     return re.sub(r"[^A-Z0-9]", "", str(vin).upper().strip())
 
 
+def rango_prefijo(prefijo):
+    """
+    (desde, hasta) para buscar "empieza con" como rango sobre un índice:
+    col >= desde AND col < hasta. LIKE 'x%' no usa índices de expresión.
+    """
+    return prefijo, prefijo[:-1] + chr(ord(prefijo[-1]) + 1)
+
+
 def limpiar_texto_corto(txt: str) -> str:
     return (txt or "").strip()
 
@@ -106,13 +213,13 @@ def km_a_texto(km):
         return str(km).strip()
 
 
-def parsear_fecha_texto(txt):
+def fecha_iso(txt):
     """
-    Intenta convertir textos comunes a YYYY-MM-DD.
-    Si no puede, devuelve hoy.
+    Convierte textos comunes a YYYY-MM-DD.
+    Devuelve None si viene vacío o no se entiende.
     """
     if not txt:
-        return date.today().isoformat()
+        return None
 
     txt = str(txt).strip()
 
@@ -143,7 +250,124 @@ def parsear_fecha_texto(txt):
     if m:
         return f"{m.group(3)}-{m.group(2)}-{m.group(1)}"
 
-    return date.today().isoformat()
+    return None
+
+
+def parsear_fecha_texto(txt):
+    """
+    Intenta convertir textos comunes a YYYY-MM-DD.
+    Si no puede, devuelve hoy.
+    """
+    return fecha_iso(txt) or date.today().isoformat()
+
+
+def filtro_rango_fechas(columna, desde, hasta):
+    """
+    Arma el filtro de rango sobre una columna de fecha ISO, en forma que
+    pueda usar el índice (nada de DATE(columna)).
+    Sirve también con COALESCE(columna,''): "hasta" solo va con piso, así
+    las filas sin fecha quedan afuera igual que con la columna pelada.
+    Devuelve (sql, params); sql vacío si no hay filtro.
+    """
+    desde = fecha_iso(desde)
+    hasta = fecha_iso(hasta)
+
+    if desde and hasta:
+        return f"{columna} BETWEEN ? AND ?", [desde, hasta]
+    if desde:
+        return f"{columna} >= ?", [desde]
+    if hasta:
+        return f"{columna} BETWEEN ? AND ?", [FECHA_MINIMA, hasta]
+    return "", []
+
+
+# =========================
+# Paginación keyset
+# =========================
+TAMANIOS_PAGINA = (25, 50, 100, 200)
+TAMANIO_PAGINA = 50
+
+
+@app.template_global()
+def tamanio_pagina():
+    """Tamaño de página pedido en ?por_pagina=, limitado a los valores permitidos."""
+    try:
+        n = int(request.args.get("por_pagina") or TAMANIO_PAGINA)
+    except ValueError:
+        return TAMANIO_PAGINA
+    return n if n in TAMANIOS_PAGINA else TAMANIO_PAGINA
+
+
+def _armar_cursor(clave):
+    txt = json.dumps(list(clave), separators=(",", ":"))
+    return base64.urlsafe_b64encode(txt.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _leer_cursor(txt, n):
+    """Devuelve la clave guardada en el cursor, o None si falta o no es válido."""
+    if not txt:
+        return None
+    try:
+        clave = json.loads(base64.urlsafe_b64decode(txt + "=" * (-len(txt) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(clave, list) or len(clave) != n:
+        return None
+    if not all(isinstance(v, (str, int, float)) for v in clave):
+        return None
+    return clave
+
+
+def pagina_keyset(cur, sql, params, orden, clave_fila, despues="", tamanio=TAMANIO_PAGINA, descendente=False):
+    """
+    Trae una página de un listado por keyset (seek), sin OFFSET.
+    - sql: SELECT ... WHERE ... sin ORDER BY ni LIMIT
+    - orden: expresiones del orden, todas en la misma dirección; la última
+      tiene que ser única (id). Las columnas que admiten NULL van con COALESCE
+      para que la comparación por tupla no pierda filas.
+    - clave_fila: fila -> valores de esas expresiones
+    Devuelve (filas, cursor de la página siguiente o None).
+    """
+    op = "<" if descendente else ">"
+    direccion = "DESC" if descendente else "ASC"
+    params = list(params)
+
+    clave = _leer_cursor(despues, len(orden))
+    if clave:
+        # la cota sobre la primera columna sola es la que permite buscar en el índice
+        # (SQLite no busca por tupla cuando hay expresiones); la tupla hace el corte exacto
+        sql += f" AND {orden[0]} {op}= ? AND ({', '.join(orden)}) {op} ({', '.join('?' * len(orden))})"
+        params.append(clave[0])
+        params.extend(clave)
+
+    sql += " ORDER BY " + ", ".join(f"{e} {direccion}" for e in orden) + " LIMIT ?"
+    params.append(tamanio + 1)
+
+    cur.execute(sql, params)
+    filas = cur.fetchall()
+
+    if len(filas) <= tamanio:
+        return filas, None
+    filas = filas[:tamanio]
+    return filas, _armar_cursor(clave_fila(filas[-1]))
+
+
+@app.template_global()
+def url_pagina(despues=None, por_pagina=None):
+    """
+    URL del mismo listado con los filtros actuales: con el cursor de la
+    página siguiente, o vuelta al principio con otro tamaño de página.
+    """
+    args = request.args.to_dict()
+    args.pop("despues", None)
+    if despues:
+        args["despues"] = despues
+    if por_pagina:
+        args["por_pagina"] = por_pagina
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+
+app.add_template_global(TAMANIOS_PAGINA, "TAMANIOS_PAGINA")
 
 
 # =========================
@@ -158,12 +382,7 @@ def obtener_vehiculo_por_vin(cur, vin):
     vin = limpiar_vin(vin)
     if not vin:
         return None
-    cur.execute("""
-        SELECT *
-        FROM vehiculos
-        WHERE UPPER(COALESCE(vin,'')) = ?
-        LIMIT 1
-    """, (vin,))
+    cur.execute("SELECT * FROM vehiculos WHERE vin_norm = ?", (vin,))
     return cur.fetchone()
 
 
@@ -404,6 +623,74 @@ def vincular_diagnostico_existente(cur, diagnostico_id, vehiculo_id=None, repara
     }
 
 
+def revincular_diagnosticos_pendientes(cur, vin=None, ids=None):
+    """
+    Vincula de una sola vez los diagnósticos PENDIENTE cuyo VIN ya tiene
+    vehículo (join por vin_norm), con la reparación abierta si la hay.
+    Con vin, sólo los de ese VIN (alta o edición de un vehículo); con ids,
+    sólo esos diagnósticos (un lote recién cargado).
+    Devuelve las filas vinculadas (id, vehiculo_id, reparacion_id, ...).
+    """
+    vin = limpiar_vin(vin)
+    filtros = ""
+    params = [datetime.now().isoformat(sep=" ", timespec="seconds")]
+    if vin:
+        filtros += " AND d.vin = ?"
+        params.append(vin)
+    if ids is not None:
+        filtros += " AND d.id IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(ids)))
+
+    cur.execute(f"""
+        UPDATE diagnosticos
+        SET vehiculo_id = m.vehiculo_id,
+            reparacion_id = m.reparacion_id,
+            estado_vinculacion = CASE WHEN m.reparacion_id IS NULL THEN 'VEHICULO_ENCONTRADO' ELSE 'VINCULADO' END,
+            vinculado_auto = 1,
+            updated_at = ?
+        FROM (
+            SELECT
+                d.id AS diagnostico_id,
+                v.id AS vehiculo_id,
+                (
+                    SELECT r.id
+                    FROM reparaciones r
+                    WHERE r.vehiculo_id = v.id
+                      AND r.estado IN ('Presupuesto', 'Ingresado', 'Entregado')
+                    ORDER BY r.fecha DESC, r.id DESC
+                    LIMIT 1
+                ) AS reparacion_id
+            FROM diagnosticos d
+            JOIN vehiculos v ON v.vin_norm = d.vin
+            WHERE COALESCE(d.estado_vinculacion, 'PENDIENTE') = 'PENDIENTE'
+              {filtros}
+        ) AS m
+        WHERE diagnosticos.id = m.diagnostico_id
+        RETURNING id, vehiculo_id, reparacion_id, marca, modelo, odometro, fecha_mail, created_at
+    """, params)
+    vinculados = cur.fetchall()
+
+    # lo que no es set-based: km (se comparan como número) y marca/modelo vacíos
+    for d in vinculados:
+        completar_marca_modelo_vehiculo_si_vacio(cur, d["vehiculo_id"], marca=d["marca"], modelo=d["modelo"])
+
+        odometro = parsear_km(d["odometro"])
+        if odometro is None:
+            continue
+        actualizar_km_vehiculo_si_corresponde(
+            cur,
+            vehiculo_id=d["vehiculo_id"],
+            km_nuevo=odometro,
+            fuente="Diagnóstico Autel",
+            diagnostico_id=d["id"],
+            fecha=parsear_fecha_texto(d["fecha_mail"] or d["created_at"]),
+        )
+        if d["reparacion_id"]:
+            actualizar_km_reparacion_si_corresponde(cur, d["reparacion_id"], odometro)
+
+    return vinculados
+
+
 def registrar_diagnostico_autel(
     fecha_mail=None,
     from_email="",
@@ -422,9 +709,6 @@ def registrar_diagnostico_autel(
 
     Devuelve un dict con info del insert/vinculación.
     """
-    con = get_con()
-    cur = con.cursor()
-
     vin = limpiar_vin(vin)
     marca = limpiar_marca_modelo(marca)
     modelo = limpiar_marca_modelo(modelo)
@@ -432,89 +716,297 @@ def registrar_diagnostico_autel(
     fecha_mail_norm = parsear_fecha_texto(fecha_mail or date.today().isoformat())
     now_txt = datetime.now().isoformat(sep=" ", timespec="seconds")
 
-    # si ya existe por sha256, actualiza datos útiles y vuelve ese id
-    if sha256:
-        cur.execute("SELECT id FROM diagnosticos WHERE sha256=?", (sha256,))
-        existente = cur.fetchone()
-        if existente:
-            diag_id = existente["id"]
-            cur.execute("""
-                UPDATE diagnosticos
-                SET fecha_mail = COALESCE(NULLIF(?, ''), fecha_mail),
-                    from_email = COALESCE(NULLIF(?, ''), from_email),
-                    subject = COALESCE(NULLIF(?, ''), subject),
-                    filename = COALESCE(NULLIF(?, ''), filename),
-                    vin = COALESCE(NULLIF(?, ''), vin),
-                    marca = COALESCE(NULLIF(?, ''), marca),
-                    modelo = COALESCE(NULLIF(?, ''), modelo),
-                    odometro = COALESCE(?, odometro),
-                    updated_at = ?
-                WHERE id = ?
-            """, (
-                fecha_mail_norm,
-                from_email.strip(),
-                subject.strip(),
-                filename.strip(),
-                vin,
-                marca,
-                modelo,
-                odometro_num,
-                now_txt,
-                diag_id
-            ))
+    con = get_con()
+    try:
+        with transaccion(con) as cur:
+            # si ya existe por sha256, actualiza datos útiles y vuelve ese id
+            existente = None
+            if sha256:
+                cur.execute("SELECT id FROM diagnosticos WHERE sha256=?", (sha256,))
+                existente = cur.fetchone()
+
+            if existente:
+                diag_id = existente["id"]
+                cur.execute("""
+                    UPDATE diagnosticos
+                    SET fecha_mail = COALESCE(NULLIF(?, ''), fecha_mail),
+                        from_email = COALESCE(NULLIF(?, ''), from_email),
+                        subject = COALESCE(NULLIF(?, ''), subject),
+                        filename = COALESCE(NULLIF(?, ''), filename),
+                        vin = COALESCE(NULLIF(?, ''), vin),
+                        marca = COALESCE(NULLIF(?, ''), marca),
+                        modelo = COALESCE(NULLIF(?, ''), modelo),
+                        odometro = COALESCE(?, odometro),
+                        updated_at = ?
+                    WHERE id = ?
+                """, (
+                    fecha_mail_norm,
+                    from_email.strip(),
+                    subject.strip(),
+                    filename.strip(),
+                    vin,
+                    marca,
+                    modelo,
+                    odometro_num,
+                    now_txt,
+                    diag_id
+                ))
+                msg_sin_vinculo = "Diagnóstico ya existente, datos actualizados."
+            else:
+                cur.execute("""
+                    INSERT INTO diagnosticos (
+                        fecha_mail, from_email, subject, filename,
+                        vin, marca, modelo, odometro,
+                        created_at, updated_at, sha256,
+                        vehiculo_id, reparacion_id,
+                        estado_vinculacion, vinculado_auto
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, 'PENDIENTE', 0)
+                """, (
+                    fecha_mail_norm,
+                    from_email.strip(),
+                    subject.strip(),
+                    filename.strip(),
+                    vin,
+                    marca,
+                    modelo,
+                    odometro_num,
+                    now_txt,
+                    now_txt,
+                    sha256.strip() if sha256 else None
+                ))
+                diag_id = cur.lastrowid
+                msg_sin_vinculo = "Diagnóstico registrado."
+
             if intentar_autovinculo:
                 res = vincular_diagnostico_existente(cur, diag_id)
             else:
-                res = {"ok": True, "msg": "Diagnóstico ya existente, datos actualizados.", "diagnostico_id": diag_id}
+                res = {"ok": True, "msg": msg_sin_vinculo}
+    finally:
+        con.close()
 
-            con.commit()
-            con.close()
-            res["diagnostico_id"] = diag_id
-            return res
+    res["diagnostico_id"] = diag_id
+    return res
+
+
+# Carga por lotes (backfill de la casilla)
+LOTE_DIAGNOSTICOS = 500
+
+
+def _datos_diagnostico_autel(d):
+    """Normaliza un diagnóstico parseado (mismas claves que registrar_diagnostico_autel)."""
+    return {
+        "fecha_mail": parsear_fecha_texto(d.get("fecha_mail") or date.today().isoformat()),
+        "from_email": (d.get("from_email") or "").strip(),
+        "subject": (d.get("subject") or "").strip(),
+        "filename": (d.get("filename") or "").strip(),
+        "vin": limpiar_vin(d.get("vin")),
+        "marca": limpiar_marca_modelo(d.get("marca")),
+        "modelo": limpiar_marca_modelo(d.get("modelo")),
+        "odometro": parsear_km(d.get("odometro")),
+        "sha256": (d.get("sha256") or "").strip() or None,
+        "ruta": d.get("ruta"),   # blob ya escrito con escribir_blob
+        "tamanio": d.get("tamanio"),
+    }
 
+
+def _ids_por_sha256(cur, shas):
     cur.execute("""
-        INSERT INTO diagnosticos (
-            fecha_mail, from_email, subject, filename,
-            vin, marca, modelo, odometro,
-            created_at, updated_at, sha256,
-            vehiculo_id, reparacion_id,
-            estado_vinculacion, vinculado_auto
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, 'PENDIENTE', 0)
-    """, (
-        fecha_mail_norm,
-        from_email.strip(),
-        subject.strip(),
-        filename.strip(),
-        vin,
-        marca,
-        modelo,
-        odometro_num,
-        now_txt,
-        now_txt,
-        sha256.strip() if sha256 else None
-    ))
-    diag_id = cur.lastrowid
+        SELECT sha256, id
+        FROM diagnosticos
+        WHERE sha256 IN (SELECT value FROM json_each(?))
+    """, (json.dumps(shas),))
+    return {sha: diag_id for sha, diag_id in cur.fetchall()}
 
-    if intentar_autovinculo:
-        res = vincular_diagnostico_existente(cur, diag_id)
-    else:
-        res = {"ok": True, "msg": "Diagnóstico registrado.", "diagnostico_id": diag_id}
 
-    con.commit()
-    con.close()
+def _registrar_lote_autel(con, lote, intentar_autovinculo):
+    now_txt = datetime.now().isoformat(sep=" ", timespec="seconds")
+    resultados = []
+
+    with transaccion(con) as cur:
+        existentes = _ids_por_sha256(cur, [d["sha256"] for d in lote if d["sha256"]])
+
+        nuevos, actualizar, vistos = [], [], set()
+        for d in lote:
+            sha = d["sha256"]
+            if sha in existentes:
+                d["estado"] = "ACTUALIZADO"
+                actualizar.append(d)
+            elif sha in vistos:
+                d["estado"] = "REPETIDO"   # el mismo archivo dos veces en el lote
+            else:
+                d["estado"] = "NUEVO"
+                nuevos.append(d)
+                if sha:
+                    vistos.add(sha)
 
-    res["diagnostico_id"] = diag_id
-    return res
+        # también los ya cargados: un diagnóstico viejo (PDF fuera del almacén)
+        # pasa a usar el blob que se acaba de escribir
+        registrar_blobs(cur, [(d["sha256"], d["ruta"], d["tamanio"]) for d in lote if d["sha256"] and d["ruta"]])
+
+        # filename queda el original: en las cargas viejas es el archivo en disco
+        cur.executemany("""
+            UPDATE diagnosticos
+            SET fecha_mail = COALESCE(NULLIF(?, ''), fecha_mail),
+                from_email = COALESCE(NULLIF(?, ''), from_email),
+                subject = COALESCE(NULLIF(?, ''), subject),
+                vin = COALESCE(NULLIF(?, ''), vin),
+                marca = COALESCE(NULLIF(?, ''), marca),
+                modelo = COALESCE(NULLIF(?, ''), modelo),
+                odometro = COALESCE(?, odometro),
+                updated_at = ?
+            WHERE id = ?
+        """, [
+            (d["fecha_mail"], d["from_email"], d["subject"], d["vin"],
+             d["marca"], d["modelo"], d["odometro"], now_txt, existentes[d["sha256"]])
+            for d in actualizar
+        ])
+        # el trigger sólo suma al insertar: los blobs recién dados de alta
+        # para filas existentes necesitan su cuenta
+        recontar_refs_blobs(cur, [d["sha256"] for d in actualizar if d["ruta"]])
+
+        sql_insert = """
+            INSERT INTO diagnosticos (
+                fecha_mail, from_email, subject, filename,
+                vin, marca, modelo, odometro,
+                created_at, updated_at, sha256,
+                vehiculo_id, reparacion_id,
+                estado_vinculacion, vinculado_auto
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, 'PENDIENTE', 0)
+        """
+
+        def valores(d):
+            return (d["fecha_mail"], d["from_email"], d["subject"], d["filename"], d["vin"],
+                    d["marca"], d["modelo"], d["odometro"], now_txt, now_txt, d["sha256"])
+
+        # con sha256 van todos juntos y el id se recupera por sha256;
+        # los que no lo tienen (raro) necesitan su lastrowid
+        cur.executemany(sql_insert, [valores(d) for d in nuevos if d["sha256"]])
+        for d in nuevos:
+            if not d["sha256"]:
+                cur.execute(sql_insert, valores(d))
+                d["id"] = cur.lastrowid
+
+        existentes.update(_ids_por_sha256(cur, [d["sha256"] for d in nuevos if d["sha256"]]))
+        for d in lote:
+            if d["sha256"]:
+                d["id"] = existentes[d["sha256"]]
+
+        vinculados = {}
+        if intentar_autovinculo:
+            ids = {d["id"] for d in lote if d["estado"] != "REPETIDO"}
+            vinculados = {v["id"]: v for v in revincular_diagnosticos_pendientes(cur, ids=ids)}
+
+    for d in lote:
+        res = {"ok": True, "diagnostico_id": d["id"], "estado": d["estado"], "vinculado": False}
+        v = vinculados.get(d["id"]) if d["estado"] != "REPETIDO" else None
+        if v:
+            res.update(vinculado=True, vehiculo_id=v["vehiculo_id"], reparacion_id=v["reparacion_id"])
+            res["msg"] = ("Diagnóstico vinculado correctamente." if v["reparacion_id"]
+                          else "Vehículo encontrado. No había reparación abierta, quedó vinculado al vehículo.")
+        elif d["estado"] == "REPETIDO":
+            res["msg"] = "Archivo repetido en el lote."
+        elif d["estado"] == "ACTUALIZADO":
+            res["msg"] = "Diagnóstico ya existente, datos actualizados."
+        else:
+            res["msg"] = "Diagnóstico registrado."
+        resultados.append(res)
+
+    return resultados
+
+
+def registrar_diagnosticos_autel_lote(diagnosticos, intentar_autovinculo=True, tamanio_lote=LOTE_DIAGNOSTICOS):
+    """
+    Versión por lotes de registrar_diagnostico_autel, para cargar muchos
+    informes de una vez (backfill de la casilla). Recibe un iterable de dicts
+    con las mismas claves y por cada lote hace: una consulta de sha256 ya
+    cargados, INSERT/UPDATE con executemany, el autovínculo por VIN en una
+    sola sentencia (sólo los que quedan PENDIENTE) y un único commit.
+
+    Devuelve {"resultados": [uno por diagnóstico, en el mismo orden], "total",
+    "nuevos", "actualizados", "vinculados", "segundos", "por_segundo"}.
+    """
+    inicio = time.perf_counter()
+    resultados = []
+
+    con = get_con()
+    try:
+        lote = []
+        for d in diagnosticos:
+            lote.append(_datos_diagnostico_autel(d))
+            if len(lote) >= tamanio_lote:
+                resultados.extend(_registrar_lote_autel(con, lote, intentar_autovinculo))
+                lote = []
+        if lote:
+            resultados.extend(_registrar_lote_autel(con, lote, intentar_autovinculo))
+    finally:
+        con.close()
+
+    segundos = time.perf_counter() - inicio
+    return {
+        "resultados": resultados,
+        "total": len(resultados),
+        "nuevos": sum(1 for r in resultados if r["estado"] == "NUEVO"),
+        "actualizados": sum(1 for r in resultados if r["estado"] == "ACTUALIZADO"),
+        "vinculados": sum(1 for r in resultados if r["vinculado"]),
+        "segundos": segundos,
+        "por_segundo": len(resultados) / segundos if segundos else 0.0,
+    }
 
 
 # =========================
 # DB init / migraciones
 # =========================
-def init_db():
-    con = get_con()
-    cur = con.cursor()
+# Migraciones versionadas sobre PRAGMA user_version. Cada una corre una sola
+# vez, en orden, dentro de su propia transacción. Arrancar la app con el
+# esquema al día es leer un entero.
+MIGRACIONES = []
+
+
+def migracion(version, descripcion):
+    def decorador(fn):
+        MIGRACIONES.append((version, descripcion, fn))
+        MIGRACIONES.sort(key=lambda m: m[0])
+        return fn
+    return decorador
+
+
+def version_esquema(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrar_db(verbose=False, path=None):
+    """
+    Aplica las migraciones pendientes. Devuelve la lista de versiones aplicadas.
+    Si el esquema ya está al día no toca nada (no abre transacción).
+    """
+    ultima = MIGRACIONES[-1][0] if MIGRACIONES else 0
+    aplicadas = []
+
+    con = get_con(path)
+    try:
+        if version_esquema(con) >= ultima:
+            return aplicadas
+
+        for version, descripcion, fn in MIGRACIONES:
+            with transaccion(con) as cur:
+                # se relee con el lock tomado: otro proceso pudo migrar primero
+                if version_esquema(con) >= version:
+                    continue
+                fn(cur)
+                cur.execute(f"PRAGMA user_version={int(version)}")
+            aplicadas.append(version)
+            if verbose:
+                print(f"Migración {version} aplicada: {descripcion}")
+    finally:
+        con.close()
+
+    return aplicadas
+
 
+@migracion(1, "esquema base")
+def _migracion_esquema_base(cur):
     # ---------------- LISTA DE PRECIOS ----------------
     cur.execute("""
     CREATE TABLE IF NOT EXISTS lista_precios (
@@ -592,15 +1084,9 @@ def init_db():
     if "rol" not in cols:
         cur.execute("ALTER TABLE users ADD COLUMN rol TEXT")
 
-    # asegurar usuario admin
+    # asegurar usuario admin (solo si no existe: no pisa la contraseña)
     cur.execute("SELECT id FROM users WHERE username='admin'")
-    row = cur.fetchone()
-    if row:
-        cur.execute(
-            "UPDATE users SET password=?, rol=? WHERE id=?",
-            ("1234", "admin", row[0])
-        )
-    else:
+    if not cur.fetchone():
         cur.execute(
             "INSERT INTO users (username, password, rol) VALUES (?, ?, ?)",
             ("admin", "1234", "admin")
@@ -820,87 +1306,1637 @@ def init_db():
     cur.execute("CREATE INDEX IF NOT EXISTS idx_diagnosticos_vehiculo ON diagnosticos(vehiculo_id)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_km_historial_vehiculo ON vehiculo_km_historial(vehiculo_id)")
 
-    con.commit()
-    con.close()
 
+@migracion(2, "índices para las consultas calientes")
+def _migracion_indices(cur):
+    # reparaciones: historial por vehículo y tablero por estado, ya ordenados
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reparaciones_vehiculo_fecha ON reparaciones(vehiculo_id, fecha, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_reparaciones_estado_fecha ON reparaciones(estado, fecha, id)")
 
-# =========================
-# Backups (1 solo, sobreescribe)
-# =========================
-def backup_db_if_changed():
-    """
-    Genera 1 solo backup: backups/backup_latest.db
-    Sólo lo actualiza si el DB cambió.
-    """
-    if not os.path.exists(BACKUP_FOLDER):
-        os.makedirs(BACKUP_FOLDER, exist_ok=True)
+    # facturas: la de cada reparación (subconsulta del tablero) y rango de fechas de las confirmadas
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_facturas_reparacion ON facturas(reparacion_id, id)")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_facturas_confirmadas_fecha
+        ON facturas(fecha)
+        WHERE COALESCE(es_presupuesto,1)=0
+    """)
 
-    if not os.path.exists(DB_NAME):
-        return None
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_items_reparacion ON reparacion_items(reparacion_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_imagenes_reparacion ON reparacion_imagenes(reparacion_id, id)")
 
-    dst = os.path.join(BACKUP_FOLDER, "backup_latest.db")
-    src_hash = file_sha256(DB_NAME)
-    dst_hash = file_sha256(dst) if os.path.exists(dst) else None
+    # gastos: rango de fechas, impagos (parcial) y repuestos de una reparación
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_gastos_fecha ON gastos(fecha, id)")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_gastos_impagos
+        ON gastos(fecha, id)
+        WHERE COALESCE(pagado,0)=0
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_gastos_reparacion ON gastos(reparacion_id, categoria)")
 
-    if src_hash != dst_hash:
-        shutil.copy2(DB_NAME, dst)
-        return dst
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_citas_fecha_hora ON citas(fecha, hora)")
 
-    return None
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_vehiculos_cliente ON vehiculos(cliente_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_vehiculos_vin_upper ON vehiculos(UPPER(COALESCE(vin,'')))")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_clientes_apellido_nombre ON clientes(apellido, nombre)")
 
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_diagnosticos_pendientes
+        ON diagnosticos(id)
+        WHERE COALESCE(estado_vinculacion, 'PENDIENTE') <> 'VINCULADO'
+    """)
 
-def get_last_backup_datetime():
-    path = os.path.join(BACKUP_FOLDER, "backup_latest.db")
-    if not os.path.exists(path):
-        return None
-    try:
-        return datetime.fromtimestamp(os.path.getmtime(path))
-    except Exception:
-        return None
 
+# columnas de fecha que se guardan como YYYY-MM-DD
+COLUMNAS_FECHA = [
+    ("reparaciones", "fecha"),
+    ("facturas", "fecha"),
+    ("gastos", "fecha"),
+    ("gastos", "fecha_pago"),
+    ("citas", "fecha"),
+    ("vehiculo_km_historial", "fecha"),
+]
+GLOB_FECHA_ISO = "[0-9][0-9][0-9][0-9]-[0-1][0-9]-[0-3][0-9]"
+FECHA_MINIMA = "0000-01-01"
 
-# =========================
-# Decoradores auth
-# =========================
-def login_required(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if "user_id" not in session:
-            return redirect(url_for("login"))
-        return f(*args, **kwargs)
-    return wrapper
 
+@migracion(3, "fechas normalizadas a ISO y validadas al escribir")
+def _migracion_fechas_iso(cur):
+    # lo que no se entiende queda NULL (un texto libre no sirve para filtrar),
+    # pero el valor original se guarda acá para poder revisarlo a mano
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS fechas_no_iso (
+        tabla TEXT,
+        fila_id INTEGER,
+        columna TEXT,
+        valor TEXT,
+        PRIMARY KEY (tabla, fila_id, columna)
+    )
+    """)
 
-def admin_required(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if "user_id" not in session or session.get("rol") != "admin":
-            return redirect(url_for("dashboard"))
-        return f(*args, **kwargs)
-    return wrapper
+    descartadas = {}
+    for tabla, columna in COLUMNAS_FECHA:
+        cur.execute(f"""
+            SELECT id, {columna}
+            FROM {tabla}
+            WHERE {columna} IS NOT NULL
+              AND NOT ({columna} GLOB '{GLOB_FECHA_ISO}')
+        """)
+        cambios = [(fecha_iso(valor), fila_id, valor) for fila_id, valor in cur.fetchall()]
+        perdidas = [(tabla, fila_id, columna, str(valor)) for nueva, fila_id, valor in cambios if nueva is None]
+        cur.executemany("INSERT OR REPLACE INTO fechas_no_iso (tabla, fila_id, columna, valor) VALUES (?, ?, ?, ?)", perdidas)
+        cur.executemany(f"UPDATE {tabla} SET {columna}=? WHERE id=?", [(nueva, fila_id) for nueva, fila_id, _ in cambios])
+        if perdidas:
+            descartadas[f"{tabla}.{columna}"] = len(perdidas)
+
+        for evento in ("INSERT", f"UPDATE OF {columna}"):
+            sufijo = "ins" if evento == "INSERT" else "upd"
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{tabla}_{columna}_iso_{sufijo}
+                BEFORE {evento} ON {tabla}
+                WHEN NEW.{columna} IS NOT NULL AND NOT (NEW.{columna} GLOB '{GLOB_FECHA_ISO}')
+                BEGIN
+                    SELECT RAISE(ABORT, '{tabla}.{columna}: fecha no ISO (YYYY-MM-DD)');
+                END
+            """)
+
+    for donde, cantidad in descartadas.items():
+        print(f"  {donde}: {cantidad} fechas no reconocidas quedaron NULL (originales en fechas_no_iso)")
+
+
+# ---------------- LEDGER DIARIO ----------------
+# Totales por día y categoría, mantenidos por triggers sobre facturas y gastos.
+# Los ingresos (facturas confirmadas) van con categoria ''. Lo que no tiene
+# fecha se acumula en fecha '' (cuenta para los totales generales, no para rangos).
+def _sql_ledger_factura(fila, signo):
+    return f"""
+        INSERT INTO ledger_diario (fecha, categoria, ingresos_servicios, ingresos_repuestos)
+        SELECT COALESCE({fila}.fecha, ''), '',
+               {signo} COALESCE({fila}.total_servicios, {fila}.total, 0),
+               {signo} COALESCE({fila}.total_repuestos, 0)
+        WHERE COALESCE({fila}.es_presupuesto, 1) = 0
+        ON CONFLICT(fecha, categoria) DO UPDATE SET
+            ingresos_servicios = ingresos_servicios + excluded.ingresos_servicios,
+            ingresos_repuestos = ingresos_repuestos + excluded.ingresos_repuestos;
+    """
 
 
-# =========================
-# Diagnósticos (AUTEL)
-# =========================
-@app.route("/diagnosticos")
-@login_required
-def diagnosticos_listado():
-    q = (request.args.get("q") or "").strip()
+def _sql_ledger_gasto(fila, signo):
+    return f"""
+        INSERT INTO ledger_diario (fecha, categoria, gastos, gastos_pendientes)
+        SELECT COALESCE({fila}.fecha, ''), COALESCE({fila}.categoria, ''),
+               {signo} COALESCE({fila}.monto, 0),
+               {signo} (CASE WHEN COALESCE({fila}.pagado, 0) = 0 THEN COALESCE({fila}.monto, 0) ELSE 0 END)
+        WHERE 1  -- el upsert sobre un SELECT necesita WHERE para parsear sin ambigüedad
+        ON CONFLICT(fecha, categoria) DO UPDATE SET
+            gastos = gastos + excluded.gastos,
+            gastos_pendientes = gastos_pendientes + excluded.gastos_pendientes;
+    """
 
-    con = get_con()
-    cur = con.cursor()
 
+def reconstruir_ledger(cur):
+    cur.execute("DELETE FROM ledger_diario")
+    cur.execute("""
+        INSERT INTO ledger_diario (fecha, categoria, ingresos_servicios, ingresos_repuestos)
+        SELECT COALESCE(fecha, ''), '',
+               SUM(COALESCE(total_servicios, total, 0)),
+               SUM(COALESCE(total_repuestos, 0))
+        FROM facturas
+        WHERE COALESCE(es_presupuesto, 1) = 0
+        GROUP BY COALESCE(fecha, '')
+    """)
+    cur.execute("""
+        INSERT INTO ledger_diario (fecha, categoria, gastos, gastos_pendientes)
+        SELECT COALESCE(fecha, ''), COALESCE(categoria, ''),
+               SUM(COALESCE(monto, 0)),
+               SUM(CASE WHEN COALESCE(pagado, 0) = 0 THEN COALESCE(monto, 0) ELSE 0 END)
+        FROM gastos
+        WHERE 1
+        GROUP BY COALESCE(fecha, ''), COALESCE(categoria, '')
+        ON CONFLICT(fecha, categoria) DO UPDATE SET
+            gastos = excluded.gastos,
+            gastos_pendientes = excluded.gastos_pendientes
+    """)
+
+
+@migracion(4, "ledger diario de ingresos y gastos")
+def _migracion_ledger_diario(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ledger_diario (
+        fecha TEXT NOT NULL,
+        categoria TEXT NOT NULL DEFAULT '',
+        ingresos_servicios REAL NOT NULL DEFAULT 0,
+        ingresos_repuestos REAL NOT NULL DEFAULT 0,
+        gastos REAL NOT NULL DEFAULT 0,
+        gastos_pendientes REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (fecha, categoria)
+    ) WITHOUT ROWID
+    """)
+
+    columnas = {
+        "facturas": ("fecha, total, total_servicios, total_repuestos, es_presupuesto", _sql_ledger_factura),
+        "gastos": ("fecha, categoria, monto, pagado", _sql_ledger_gasto),
+    }
+    for tabla, (cols_update, sql_fila) in columnas.items():
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_ledger_ins
+            AFTER INSERT ON {tabla}
+            BEGIN
+                {sql_fila("NEW", "+")}
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_ledger_upd
+            AFTER UPDATE OF {cols_update} ON {tabla}
+            BEGIN
+                {sql_fila("OLD", "-")}
+                {sql_fila("NEW", "+")}
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_ledger_del
+            AFTER DELETE ON {tabla}
+            BEGIN
+                {sql_fila("OLD", "-")}
+            END
+        """)
+
+    reconstruir_ledger(cur)
+
+
+def totales_ledger(cur, desde="", hasta=""):
+    """
+    Totales del período desde el ledger (sin rango = todo el historial).
+    Devuelve dict con ingresos_servicios, ingresos_repuestos, gastos, gastos_pendientes.
+    """
     sql = """
         SELECT
-            d.id,
-            d.fecha_mail,
-            d.vin,
-            d.marca,
-            d.modelo,
-            d.odometro,
-            d.subject,
-            d.filename,
+            COALESCE(SUM(ingresos_servicios), 0),
+            COALESCE(SUM(ingresos_repuestos), 0),
+            COALESCE(SUM(gastos), 0),
+            COALESCE(SUM(gastos_pendientes), 0)
+        FROM ledger_diario
+    """
+    filtro, params = filtro_rango_fechas("fecha", desde, hasta)
+    if filtro:
+        sql += " WHERE " + filtro
+
+    fila = cur.execute(sql, params).fetchone()
+    return dict(zip(("ingresos_servicios", "ingresos_repuestos", "gastos", "gastos_pendientes"), fila))
+
+
+# ---------------- TOTALES DE REPARACIÓN ----------------
+# Motor único de totales: la misma fórmula y la misma clasificación de tipos
+# se usan en los triggers, en las consultas y en los templates.
+TIPOS_REPUESTO = ("REPUESTO", "REPUESTOS", "INSUMO", "INSUMOS")
+
+SQL_SUBTOTAL_ITEM = "COALESCE(cantidad,0) * COALESCE(precio_unitario,0) * (1 - COALESCE(descuento,0) / 100.0)"
+SQL_ES_REPUESTO = "UPPER(TRIM(COALESCE(tipo,'SERVICIO'))) IN (%s)" % ", ".join(f"'{t}'" for t in TIPOS_REPUESTO)
+
+
+def _sql_recalcular_totales(reparacion_id):
+    # items_version cambia con cada cambio de ítems (sirve para invalidar cachés)
+    return f"""
+        UPDATE reparaciones
+        SET (total_servicios, total_repuestos, total) = (
+                SELECT
+                    COALESCE(SUM(CASE WHEN {SQL_ES_REPUESTO} THEN 0 ELSE {SQL_SUBTOTAL_ITEM} END), 0),
+                    COALESCE(SUM(CASE WHEN {SQL_ES_REPUESTO} THEN {SQL_SUBTOTAL_ITEM} ELSE 0 END), 0),
+                    COALESCE(SUM({SQL_SUBTOTAL_ITEM}), 0)
+                FROM reparacion_items
+                WHERE reparacion_id = reparaciones.id
+            ),
+            items_version = COALESCE(items_version, 0) + 1
+        WHERE id = {reparacion_id};
+    """
+
+
+def totales_reparacion(cur, reparacion_id):
+    """Totales guardados de la reparación: dict con servicios, repuestos y total."""
+    cur.execute("""
+        SELECT COALESCE(total_servicios,0), COALESCE(total_repuestos,0), COALESCE(total,0)
+        FROM reparaciones
+        WHERE id=?
+    """, (reparacion_id,))
+    fila = cur.fetchone()
+    if not fila:
+        return {"servicios": 0.0, "repuestos": 0.0, "total": 0.0}
+    return {"servicios": float(fila[0]), "repuestos": float(fila[1]), "total": float(fila[2])}
+
+
+@migracion(5, "totales guardados en reparaciones")
+def _migracion_totales_reparacion(cur):
+    cur.execute("PRAGMA table_info(reparaciones)")
+    cols = [c[1] for c in cur.fetchall()]
+    for col, tipo in (
+        ("total_servicios", "REAL DEFAULT 0"),
+        ("total_repuestos", "REAL DEFAULT 0"),
+        ("total", "REAL DEFAULT 0"),
+        ("items_version", "INTEGER DEFAULT 0"),
+    ):
+        if col not in cols:
+            cur.execute(f"ALTER TABLE reparaciones ADD COLUMN {col} {tipo}")
+
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_items_totales_ins
+        AFTER INSERT ON reparacion_items
+        BEGIN
+            {_sql_recalcular_totales("NEW.reparacion_id")}
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_items_totales_upd
+        AFTER UPDATE OF reparacion_id, concepto, cantidad, precio_unitario, descuento, tipo ON reparacion_items
+        BEGIN
+            {_sql_recalcular_totales("NEW.reparacion_id")}
+            {_sql_recalcular_totales("OLD.reparacion_id")}
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_items_totales_del
+        AFTER DELETE ON reparacion_items
+        BEGIN
+            {_sql_recalcular_totales("OLD.reparacion_id")}
+        END
+    """)
+
+    cur.execute(_sql_recalcular_totales("reparaciones.id"))
+
+
+@migracion(6, "presupuestos sincronizados con los totales de la reparación")
+def _migracion_presupuestos_sincronizados(cur):
+    # el presupuesto (factura sin confirmar) sigue a los ítems; la factura confirmada queda fija
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reparaciones_presupuesto_totales
+        AFTER UPDATE OF total_servicios, total_repuestos, total ON reparaciones
+        BEGIN
+            UPDATE facturas
+            SET total = COALESCE(NEW.total, 0) * (1 - COALESCE(descuento_global, 0) / 100.0),
+                total_servicios = NEW.total_servicios,
+                total_repuestos = NEW.total_repuestos
+            WHERE reparacion_id = NEW.id
+              AND COALESCE(es_presupuesto, 1) = 1;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_facturas_presupuesto_descuento
+        AFTER UPDATE OF descuento_global ON facturas
+        WHEN COALESCE(NEW.es_presupuesto, 1) = 1
+        BEGIN
+            UPDATE facturas
+            SET total = (SELECT COALESCE(total, 0) FROM reparaciones WHERE id = NEW.reparacion_id)
+                        * (1 - COALESCE(NEW.descuento_global, 0) / 100.0)
+            WHERE id = NEW.id;
+        END
+    """)
+
+    cur.execute("""
+        UPDATE facturas
+        SET (total, total_servicios, total_repuestos) = (
+            SELECT COALESCE(r.total, 0) * (1 - COALESCE(facturas.descuento_global, 0) / 100.0),
+                   r.total_servicios,
+                   r.total_repuestos
+            FROM reparaciones r
+            WHERE r.id = facturas.reparacion_id
+        )
+        WHERE COALESCE(es_presupuesto, 1) = 1
+          AND reparacion_id IN (SELECT id FROM reparaciones)
+    """)
+
+
+@migracion(7, "foto inmutable de la factura al confirmar")
+def _migracion_snapshot_facturas(cur):
+    cur.execute("PRAGMA table_info(facturas)")
+    cols = [c[1] for c in cur.fetchall()]
+    for col in ("cliente_nombre", "cliente_apellido", "patente", "marca", "modelo", "snapshot"):
+        if col not in cols:
+            cur.execute(f"ALTER TABLE facturas ADD COLUMN {col} TEXT")
+
+    # facturas ya confirmadas: la mejor foto disponible es el estado actual
+    cur.execute("SELECT id, reparacion_id FROM facturas WHERE COALESCE(es_presupuesto,1)=0 AND snapshot IS NULL")
+    for factura_id, reparacion_id in cur.fetchall():
+        foto = snapshot_factura(cur, reparacion_id)
+        if not foto:
+            continue
+        cliente = fila_foto(cur, "clientes", foto["cliente"])
+        vehiculo = fila_foto(cur, "vehiculos", foto["vehiculo"])
+        cur.execute("""
+            UPDATE facturas
+            SET cliente_nombre=?, cliente_apellido=?, patente=?, marca=?, modelo=?, snapshot=?
+            WHERE id=?
+        """, (
+            cliente["nombre"], cliente["apellido"], vehiculo["patente"], vehiculo["marca"], vehiculo["modelo"],
+            json.dumps(foto, separators=(",", ":"), ensure_ascii=False),
+            factura_id,
+        ))
+
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_facturas_confirmadas_inmutables
+        BEFORE UPDATE OF total, total_servicios, total_repuestos, descuento_global,
+                         cliente_nombre, cliente_apellido, patente, marca, modelo, snapshot
+        ON facturas
+        WHEN COALESCE(OLD.es_presupuesto, 1) = 0
+        BEGIN
+            SELECT RAISE(ABORT, 'factura confirmada: no se puede modificar');
+        END
+    """)
+
+
+# ---------------- BÚSQUEDA (FTS5) ----------------
+# Un solo índice trigram para clientes, vehículos, reparaciones y diagnósticos.
+# rowid = id * 8 + código del tipo, así cada fila se ubica sin buscar.
+FTS_TIPOS = {
+    # tipo: (código, tabla, título, columnas del texto buscable)
+    "cliente": (1, "clientes", "COALESCE({f}.apellido,'') || ', ' || COALESCE({f}.nombre,'')",
+                ("nombre", "apellido", "telefono", "email", "documento", "razon_social")),
+    "vehiculo": (2, "vehiculos", "COALESCE({f}.patente,'') || ' ' || COALESCE({f}.marca,'') || ' ' || COALESCE({f}.modelo,'')",
+                 ("patente", "marca", "modelo", "vin")),
+    "reparacion": (3, "reparaciones", "COALESCE({f}.descripcion,'')",
+                   ("descripcion", "notas")),
+    "diagnostico": (4, "diagnosticos", "COALESCE(NULLIF({f}.subject,''), {f}.filename, '')",
+                    ("subject", "vin", "marca", "modelo", "filename")),
+}
+
+
+@migracion(8, "búsqueda full-text (FTS5 trigram)")
+def _migracion_busqueda_fts(cur):
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS busqueda_fts
+        USING fts5(tipo UNINDEXED, ref_id UNINDEXED, titulo, texto, tokenize='trigram')
+    """)
+
+    for tipo, (codigo, tabla, sql_titulo, columnas) in FTS_TIPOS.items():
+        def valores(f):
+            texto = " || ' ' || ".join(f"COALESCE({f}.{c},'')" for c in columnas)
+            return f"{f}.id * 8 + {codigo}, '{tipo}', {f}.id, {sql_titulo.format(f=f)}, {texto}"
+
+        insertar = f"INSERT INTO busqueda_fts (rowid, tipo, ref_id, titulo, texto) SELECT {valores('NEW')};"
+        borrar = f"DELETE FROM busqueda_fts WHERE rowid = OLD.id * 8 + {codigo};"
+
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{tabla}_fts_ins AFTER INSERT ON {tabla} BEGIN {insertar} END")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{tabla}_fts_upd AFTER UPDATE OF {', '.join(columnas)} ON {tabla} BEGIN {borrar} {insertar} END")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{tabla}_fts_del AFTER DELETE ON {tabla} BEGIN {borrar} END")
+
+        cur.execute(f"DELETE FROM busqueda_fts WHERE tipo = '{tipo}'")
+        cur.execute(f"INSERT INTO busqueda_fts (rowid, tipo, ref_id, titulo, texto) SELECT {valores('t')} FROM {tabla} t")
+
+
+def consulta_fts(q):
+    """
+    Arma la expresión MATCH para el texto del usuario (cada palabra como frase,
+    todas requeridas). Devuelve None si no hay palabras de 3+ letras: el
+    trigram no puede buscarlas y hay que ir por LIKE.
+    """
+    palabras = [p for p in (q or "").split() if len(p) >= 3]
+    if not palabras:
+        return None
+    return " ".join('"' + p.replace('"', '""') + '"' for p in palabras)
+
+
+@migracion(9, "índices en el orden de los listados paginados")
+def _migracion_indices_paginacion(cur):
+    # mismo orden (y mismas expresiones) que usan los listados con pagina_keyset
+    cur.execute("DROP INDEX IF EXISTS idx_clientes_apellido_nombre")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_clientes_orden
+        ON clientes(COALESCE(apellido,''), COALESCE(nombre,''), id)
+    """)
+
+    cur.execute("DROP INDEX IF EXISTS idx_facturas_confirmadas_fecha")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_facturas_confirmadas_orden
+        ON facturas(COALESCE(fecha,''), id)
+        WHERE COALESCE(es_presupuesto,1)=0
+    """)
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_gastos_orden ON gastos(COALESCE(fecha,''), id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_citas_orden ON citas(COALESCE(fecha,''), COALESCE(hora,''), id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_precios_concepto ON lista_precios(concepto, id)")
+
+
+@migracion(10, "índice de patentes para el buscador de vehículos")
+def _migracion_indice_patentes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_vehiculos_patente_upper ON vehiculos(UPPER(COALESCE(patente,'')))")
+
+
+@migracion(11, "VIN normalizado y único en vehículos")
+def _migracion_vin_norm(cur):
+    cur.execute("PRAGMA table_info(vehiculos)")
+    if "vin_norm" not in [c[1] for c in cur.fetchall()]:
+        cur.execute("ALTER TABLE vehiculos ADD COLUMN vin_norm TEXT")
+
+    # el primero (id más bajo) se queda con el VIN; los repetidos quedan sin
+    # vin_norm y los lista "flask vins-duplicados"
+    cur.execute("SELECT id, vin FROM vehiculos ORDER BY id")
+    vistos = set()
+    valores = []
+    for vehiculo_id, vin in cur.fetchall():
+        vin_norm = limpiar_vin(vin) or None
+        if vin_norm in vistos:
+            vin_norm = None
+        elif vin_norm:
+            vistos.add(vin_norm)
+        valores.append((vin_norm, vehiculo_id))
+    cur.executemany("UPDATE vehiculos SET vin_norm=? WHERE id=?", valores)
+
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_vehiculos_vin_norm
+        ON vehiculos(vin_norm)
+        WHERE vin_norm IS NOT NULL
+    """)
+    cur.execute("DROP INDEX IF EXISTS idx_vehiculos_vin")
+    cur.execute("DROP INDEX IF EXISTS idx_vehiculos_vin_upper")
+
+
+@migracion(12, "índice de diagnósticos pendientes por VIN")
+def _migracion_diagnosticos_pendientes_vin(cur):
+    # el join de revincular_diagnosticos_pendientes recorre sólo los PENDIENTE
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_diagnosticos_pendientes_vin
+        ON diagnosticos(vin)
+        WHERE COALESCE(estado_vinculacion, 'PENDIENTE') = 'PENDIENTE'
+    """)
+
+
+@migracion(13, "miniaturas de las fotos de reparaciones")
+def _migracion_variantes_imagenes(cur):
+    # NULL = todavía sin generar (fotos viejas o sin Pillow): se generan
+    # en el primer pedido desde reparacion_imagen_variante
+    cur.execute("PRAGMA table_info(reparacion_imagenes)")
+    cols = [c[1] for c in cur.fetchall()]
+    for col, tipo in (("miniatura", "TEXT"), ("mediana", "TEXT"), ("ancho", "INTEGER"), ("alto", "INTEGER")):
+        if col not in cols:
+            cur.execute(f"ALTER TABLE reparacion_imagenes ADD COLUMN {col} {tipo}")
+
+
+@migracion(14, "almacén de archivos por sha256 con referencias")
+def _migracion_blobs(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        ruta TEXT NOT NULL,
+        tamanio INTEGER,
+        refs INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT
+    ) WITHOUT ROWID
+    """)
+
+    cur.execute("PRAGMA table_info(reparacion_imagenes)")
+    if "sha256" not in [c[1] for c in cur.fetchall()]:
+        cur.execute("ALTER TABLE reparacion_imagenes ADD COLUMN sha256 TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_imagenes_sha256 ON reparacion_imagenes(sha256) WHERE sha256 IS NOT NULL")
+
+    # refs = filas de reparacion_imagenes + diagnosticos que apuntan al blob
+    for tabla in ("reparacion_imagenes", "diagnosticos"):
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_blobs_ins
+            AFTER INSERT ON {tabla}
+            WHEN NEW.sha256 IS NOT NULL
+            BEGIN
+                UPDATE blobs SET refs = refs + 1 WHERE sha256 = NEW.sha256;
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_blobs_upd
+            AFTER UPDATE OF sha256 ON {tabla}
+            WHEN OLD.sha256 IS NOT NEW.sha256
+            BEGIN
+                UPDATE blobs SET refs = refs - 1 WHERE sha256 = OLD.sha256;
+                UPDATE blobs SET refs = refs + 1 WHERE sha256 = NEW.sha256;
+            END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{tabla}_blobs_del
+            AFTER DELETE ON {tabla}
+            WHEN OLD.sha256 IS NOT NULL
+            BEGIN
+                UPDATE blobs SET refs = refs - 1 WHERE sha256 = OLD.sha256;
+            END
+        """)
+
+    # los archivos ya subidos pasan al almacén acá mismo; los originales
+    # quedan sin referencias y los levanta "flask limpiar-uploads"
+    importar_archivos_viejos(cur)
+
+
+@migracion(15, "fotos de facturas por nombre de columna")
+def _migracion_fotos_por_nombre(cur):
+    # las fotos guardadas como listas se pasan a dicts con el orden de
+    # columnas de hoy, que es el mismo que cuando se tomaron
+    columnas = {}
+    for tabla in ("reparaciones", "vehiculos", "clientes", "reparacion_items"):
+        cur.execute(f"PRAGMA table_info({tabla})")
+        columnas[tabla] = [c[1] for c in cur.fetchall()]
+
+    def por_nombre(tabla, valores):
+        return dict(zip(columnas[tabla], valores)) if isinstance(valores, list) else valores
+
+    cur.execute("SELECT id, snapshot FROM facturas WHERE snapshot IS NOT NULL")
+    cambios = []
+    for factura_id, snapshot in cur.fetchall():
+        foto = json.loads(snapshot)
+        foto = {
+            "reparacion": por_nombre("reparaciones", foto.get("reparacion")),
+            "vehiculo": por_nombre("vehiculos", foto.get("vehiculo")),
+            "cliente": por_nombre("clientes", foto.get("cliente")),
+            "items": [por_nombre("reparacion_items", it) for it in foto.get("items") or []],
+        }
+        cambios.append((json.dumps(foto, separators=(",", ":"), ensure_ascii=False), factura_id))
+
+    # el trigger de facturas confirmadas no deja tocar snapshot: se saca y se
+    # vuelve a crear igual
+    cur.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='trg_facturas_confirmadas_inmutables'")
+    trigger = cur.fetchone()
+    if trigger:
+        cur.execute("DROP TRIGGER trg_facturas_confirmadas_inmutables")
+    cur.executemany("UPDATE facturas SET snapshot=? WHERE id=?", cambios)
+    if trigger:
+        cur.execute(trigger[0])
+
+
+def vins_duplicados(cur):
+    """
+    VINs que aparecen en más de un vehículo (comparados ya normalizados).
+    Devuelve [(vin, [filas de vehiculos]), ...].
+    """
+    cur.execute("""
+        SELECT v.id, v.patente, v.marca, v.modelo, v.vin, v.vin_norm, c.nombre, c.apellido
+        FROM vehiculos v
+        LEFT JOIN clientes c ON c.id = v.cliente_id
+        WHERE COALESCE(v.vin,'') <> ''
+        ORDER BY v.id
+    """)
+    grupos = {}
+    for fila in cur.fetchall():
+        vin = limpiar_vin(fila["vin"])
+        if vin:
+            grupos.setdefault(vin, []).append(fila)
+    return [(vin, filas) for vin, filas in sorted(grupos.items()) if len(filas) > 1]
+
+
+@app.cli.command("reconstruir-ledger")
+def cli_reconstruir_ledger():
+    """Recalcula ledger_diario desde facturas y gastos."""
+    con = get_con()
+    try:
+        with transaccion(con) as cur:
+            reconstruir_ledger(cur)
+            cur.execute("SELECT COUNT(*) FROM ledger_diario")
+            print(f"Ledger reconstruido: {cur.fetchone()[0]} filas.")
+    finally:
+        con.close()
+
+
+@app.cli.command("vins-duplicados")
+def cli_vins_duplicados():
+    """Lista los VINs cargados en más de un vehículo."""
+    con = get_con()
+    try:
+        grupos = vins_duplicados(con.cursor())
+    finally:
+        con.close()
+
+    for vin, filas in grupos:
+        print(vin)
+        for v in filas:
+            nota = "" if v["vin_norm"] else "  (sin vincular por VIN)"
+            print(f"  #{v['id']} {v['patente'] or '-'} {v['marca'] or ''} {v['modelo'] or ''} - {v['nombre'] or ''} {v['apellido'] or ''}{nota}")
+    print(f"{len(grupos)} VINs repetidos.")
+
+
+@app.cli.command("migrar")
+def cli_migrar():
+    """Aplica las migraciones de esquema pendientes."""
+    con = get_con()
+    try:
+        antes = version_esquema(con)
+    finally:
+        con.close()
+
+    aplicadas = migrar_db(verbose=True)
+    if not aplicadas:
+        print(f"Esquema al día (versión {antes}).")
+
+
+# =========================
+# Planes de consulta (EXPLAIN QUERY PLAN)
+# =========================
+# Tablas donde un SCAN completo es una regresión.
+TABLAS_CALIENTES = {
+    "reparaciones", "facturas", "reparacion_items", "reparacion_imagenes",
+    "gastos", "citas", "vehiculos", "diagnosticos", "vehiculo_km_historial",
+}
+
+# Sentencias que recorren la tabla a propósito (listados completos o LIKE '%x%').
+# Se identifican por un fragmento de su SQL.
+PLANES_SCAN_PERMITIDOS = [
+    "LEFT JOIN reparaciones r ON r.id = d.reparacion_id",  # listado de diagnósticos
+    "FROM gastos\n        WHERE 1=1",               # listados de gastos sin filtro
+    "FROM citas WHERE 1=1",
+    "WHERE patente LIKE ? OR vin LIKE ?",            # búsqueda de clientes
+    "WHERE COALESCE(v.vin,'') <> ''",                # reporte de VINs repetidos
+    "WHERE sha256 IS NULL AND COALESCE(filename, '') <> ''",   # importar-blobs
+    "WHERE b.sha256 IS NULL AND COALESCE(d.filename, '') <> ''",
+]
+
+_PREFIJOS_SQL = ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")
+
+
+def sentencias_sql_app(path=None):
+    """
+    Devuelve [(linea, sql)] con todas las sentencias SQL literales de app.py.
+    Las migraciones no se incluyen (corren una sola vez).
+    """
+    import ast
+
+    path = path or os.path.abspath(__file__)
+    with open(path, encoding="utf-8") as f:
+        arbol = ast.parse(f.read())
+
+    sentencias = []
+    for nodo in arbol.body:
+        if isinstance(nodo, ast.FunctionDef) and nodo.name.startswith("_migracion"):
+            continue
+
+        # las partes de un f-string no son sentencias completas
+        partes_fstring = set()
+        for sub in ast.walk(nodo):
+            if isinstance(sub, ast.JoinedStr):
+                partes_fstring.update(id(v) for v in sub.values)
+
+        for sub in ast.walk(nodo):
+            if not (isinstance(sub, ast.Constant) and isinstance(sub.value, str)):
+                continue
+            if id(sub) in partes_fstring:
+                continue
+            sql = sub.value.strip()
+            if sql.upper().startswith(_PREFIJOS_SQL) and ("FROM" in sql.upper() or "INTO" in sql.upper() or "SET" in sql.upper()):
+                sentencias.append((sub.lineno, sql))
+
+    return sorted(sentencias)
+
+
+def _tablas_por_alias(sql):
+    alias = {}
+    for tabla, nombre in re.findall(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", sql, re.I):
+        alias[tabla] = tabla
+        if nombre and nombre.upper() not in ("WHERE", "ON", "SET", "ORDER", "GROUP", "LEFT", "JOIN", "LIMIT", "VALUES"):
+            alias[nombre] = tabla
+    return alias
+
+
+def verificar_planes(con, sentencias=None, verbose=False):
+    """
+    Corre EXPLAIN QUERY PLAN sobre cada sentencia y devuelve la lista de
+    problemas: (linea, tabla, detalle, sql) por cada SCAN completo sobre una
+    tabla caliente, o (linea, None, error, sql) si la sentencia no compila.
+    """
+    problemas = []
+    for linea, sql in (sentencias if sentencias is not None else sentencias_sql_app()):
+        if "temp." in sql:
+            continue   # tablas temporales: sólo existen en la conexión que las crea
+        params = [None] * sql.count("?")
+        try:
+            plan = con.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        except sqlite3.Error as e:
+            problemas.append((linea, None, str(e), sql))
+            continue
+
+        alias = _tablas_por_alias(sql)
+        for fila in plan:
+            detalle = fila[3]
+            if verbose:
+                print(f"  {linea}: {detalle}")
+            m = re.match(r"SCAN (\w+)$", detalle)
+            if not m:
+                continue
+            tabla = alias.get(m.group(1), m.group(1))
+            if tabla not in TABLAS_CALIENTES:
+                continue
+            if any(frag in sql for frag in PLANES_SCAN_PERMITIDOS):
+                continue
+            problemas.append((linea, tabla, detalle, sql))
+
+    return problemas
+
+
+@app.cli.command("verificar-planes")
+@click.option("--db", "path", default="", help="DB a revisar. Vacío = esquema nuevo migrado en un temporal.")
+@click.option("--verbose", is_flag=True, help="Muestra el plan de cada sentencia.")
+def cli_verificar_planes(path, verbose):
+    """Falla si alguna consulta caliente de app.py hace un SCAN completo."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if not path:
+            path = os.path.join(tmp, "planes.db")
+            migrar_db(path=path)
+
+        con = get_con(path)
+        try:
+            sentencias = sentencias_sql_app()
+            problemas = verificar_planes(con, sentencias, verbose=verbose)
+        finally:
+            con.close()
+
+    for linea, tabla, detalle, sql in problemas:
+        print(f"app.py:{linea}: {detalle}" + (f" ({tabla})" if tabla else ""))
+        print("    " + " ".join(sql.split())[:160])
+
+    print(f"{len(sentencias)} sentencias revisadas, {len(problemas)} problemas.")
+    if problemas:
+        raise SystemExit(1)
+
+
+# =========================
+# Backups (1 solo, sobreescribe)
+# =========================
+BACKUP_LATEST = os.path.join(BACKUP_FOLDER, "backup_latest.db")
+BACKUP_FIRMA = os.path.join(BACKUP_FOLDER, "backup_latest.firma")
+
+
+def db_firma_cambios(path=DB_NAME):
+    """
+    Firma O(1) del estado del DB, sin leer el archivo entero:
+    - contador de cambios del header SQLite (bytes 24..27, se incrementa en cada commit)
+    - tamaño y mtime del archivo
+    - tamaño y mtime del -wal (si existe), por si hay commits sin checkpoint
+    """
+    try:
+        st = os.stat(path)
+        with open(path, "rb") as f:
+            header = f.read(100)
+    except OSError:
+        return None
+
+    contador = int.from_bytes(header[24:28], "big") if len(header) >= 28 else 0
+    firma = f"{contador}:{st.st_size}:{st.st_mtime_ns}"
+
+    try:
+        st_wal = os.stat(path + "-wal")
+        firma += f":{st_wal.st_size}:{st_wal.st_mtime_ns}"
+    except OSError:
+        pass
+
+    return firma
+
+
+def _leer_firma_backup():
+    try:
+        with open(BACKUP_FIRMA, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def _guardar_firma_backup(firma):
+    try:
+        with open(BACKUP_FIRMA, "w", encoding="utf-8") as f:
+            f.write(firma or "")
+    except OSError:
+        pass
+
+
+def snapshot_sqlite(dst, origen=DB_NAME):
+    """
+    Copia consistente del DB usando la API de backup online de sqlite3
+    (no copia un archivo que puede estar a mitad de una escritura).
+    Escribe a un .tmp y lo reemplaza de forma atómica.
+
+    Devuelve la posición del archivo WAL que refleja la foto (o None).
+    """
+    tmp = dst + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    src = sqlite3.connect(origen)
+    out = sqlite3.connect(tmp)
+    posicion_wal = None
+    try:
+        if origen == DB_NAME:
+            # la foto queda alineada con lo ya archivado del WAL
+            posicion_wal = fijar_lectura_en_posicion_wal(src)
+        src.backup(out)
+    finally:
+        if src.in_transaction:
+            src.rollback()
+        out.close()
+        src.close()
+
+    os.replace(tmp, dst)
+    return posicion_wal
+
+
+def backup_db_if_changed(verificar=False):
+    """
+    Genera 1 solo backup: backups/backup_latest.db
+    Sólo lo actualiza si el DB cambió.
+
+    Por defecto compara la firma O(1) de db_firma_cambios() contra la del
+    último backup. Con verificar=True compara el sha256 completo de ambos
+    archivos (más lento, lee los dos DB enteros).
+    """
+    if not os.path.exists(BACKUP_FOLDER):
+        os.makedirs(BACKUP_FOLDER, exist_ok=True)
+
+    if not os.path.exists(DB_NAME):
+        return None
+
+    dst = BACKUP_LATEST
+    firma = db_firma_cambios(DB_NAME)
+
+    if verificar:
+        src_hash = file_sha256(DB_NAME)
+        dst_hash = file_sha256(dst) if os.path.exists(dst) else None
+        cambio = src_hash != dst_hash
+    else:
+        cambio = firma is None or not os.path.exists(dst) or firma != _leer_firma_backup()
+
+    if cambio:
+        posicion_wal = snapshot_sqlite(dst)
+        _guardar_firma_backup(firma)
+        guardar_generacion(dst, wal=posicion_wal)
+        podar_generaciones()
+        return dst
+
+    if verificar:
+        _guardar_firma_backup(firma)
+    return None
+
+
+def get_last_backup_datetime():
+    with _backup_lock:
+        ultimo_ok = _backup_estado["ultimo_ok"]
+    if ultimo_ok:
+        return datetime.fromtimestamp(ultimo_ok)
+
+    path = BACKUP_LATEST
+    if not os.path.exists(path):
+        return None
+    try:
+        return datetime.fromtimestamp(os.path.getmtime(path))
+    except Exception:
+        return None
+
+
+# =========================
+# Backup en segundo plano
+# =========================
+# Las rutas sólo avisan que hubo una escritura (solicitar_backup).
+# Un hilo aparte junta las ráfagas de escrituras (debounce) y hace el backup.
+BACKUP_DEBOUNCE_SEGUNDOS = 5
+BACKUP_ESPERA_MAXIMA_SEGUNDOS = 60
+
+_backup_lock = threading.Lock()          # protege _backup_estado
+_backup_corrida_lock = threading.RLock()  # una sola corrida de backup a la vez
+_backup_evento = threading.Event()
+_backup_hilo = None
+_backup_estado = {
+    "ultimo_ok": None,          # timestamp del último backup terminado bien
+    "ultima_duracion": None,    # segundos que tardó el último backup
+    "ultimo_error": None,       # texto del último error (None si salió bien)
+    "pendiente_desde": None,    # timestamp de la primera escritura sin backup
+    "ultimo_pedido": None,      # timestamp de la última escritura avisada
+}
+
+
+def solicitar_backup():
+    """
+    Avisa al worker que el DB cambió. No bloquea el request.
+    """
+    ahora = time.time()
+    with _backup_lock:
+        if _backup_estado["pendiente_desde"] is None:
+            _backup_estado["pendiente_desde"] = ahora
+        _backup_estado["ultimo_pedido"] = ahora
+
+    iniciar_backup_worker()
+    _backup_evento.set()
+
+
+def ejecutar_backup(verificar=False):
+    """
+    Corre un backup ahora mismo y actualiza el estado que ve el dashboard.
+    """
+    # el worker, el botón de backup manual y atexit pueden coincidir: todos
+    # escriben el mismo backup_latest.db.tmp
+    with _backup_corrida_lock:
+        return _ejecutar_backup(verificar)
+
+
+def _ejecutar_backup(verificar):
+    inicio = time.time()
+    with _backup_lock:
+        _backup_estado["pendiente_desde"] = None
+
+    try:
+        backup_db_if_changed(verificar=verificar)
+    except Exception as e:
+        with _backup_lock:
+            _backup_estado["ultimo_error"] = str(e)
+        print("Backup error:", e)
+        return False
+
+    with _backup_lock:
+        _backup_estado["ultimo_ok"] = time.time()
+        _backup_estado["ultima_duracion"] = time.time() - inicio
+        _backup_estado["ultimo_error"] = None
+    return True
+
+
+def _backup_worker_loop():
+    while True:
+        _backup_evento.wait()
+
+        # esperar a que se calmen las escrituras (con un tope de espera)
+        while True:
+            with _backup_lock:
+                ultimo_pedido = _backup_estado["ultimo_pedido"] or 0
+                pendiente_desde = _backup_estado["pendiente_desde"] or time.time()
+            restante = min(
+                ultimo_pedido + BACKUP_DEBOUNCE_SEGUNDOS,
+                pendiente_desde + BACKUP_ESPERA_MAXIMA_SEGUNDOS
+            ) - time.time()
+            if restante <= 0:
+                break
+            time.sleep(restante)
+
+        _backup_evento.clear()
+        ejecutar_backup()
+
+
+def iniciar_backup_worker():
+    global _backup_hilo
+    with _backup_lock:
+        if _backup_hilo is not None and _backup_hilo.is_alive():
+            return
+        _backup_hilo = threading.Thread(target=_backup_worker_loop, name="backup-worker", daemon=True)
+        _backup_hilo.start()
+
+
+def get_backup_estado():
+    """
+    Estado del backup para mostrar: último ok, duración, demora pendiente y error.
+    """
+    with _backup_lock:
+        estado = dict(_backup_estado)
+
+    pendiente_desde = estado.pop("pendiente_desde")
+    estado.pop("ultimo_pedido")
+    estado["demora"] = (time.time() - pendiente_desde) if pendiente_desde else 0
+    estado["pendiente"] = pendiente_desde is not None
+    return estado
+
+
+@atexit.register
+def _backup_al_salir():
+    # si quedó una escritura sin respaldar, no esperar al debounce
+    with _backup_lock:
+        pendiente = _backup_estado["pendiente_desde"] is not None
+    if pendiente:
+        ejecutar_backup()
+
+
+# =========================
+# Backups generacionales (deduplicados + comprimidos)
+# =========================
+# Cada generación es un manifiesto con la lista de hashes de las páginas del DB.
+# Las páginas se guardan una sola vez, comprimidas, en chunks/<ab>/<sha256>.z,
+# así semanas de historia cuestan poco más que el tamaño del DB.
+BACKUP_STORE = os.path.join(BACKUP_FOLDER, "store")
+BACKUP_CHUNKS = os.path.join(BACKUP_STORE, "chunks")
+BACKUP_GENERACIONES = os.path.join(BACKUP_STORE, "generaciones")
+
+# cuántas generaciones conservar por franja (la más nueva de cada franja)
+BACKUP_RETENCION = [
+    ("reciente", 12),
+    ("hora", 24),
+    ("dia", 14),
+    ("semana", 8),
+]
+
+
+def _db_page_size(path):
+    with open(path, "rb") as f:
+        header = f.read(100)
+    if len(header) < 18:
+        return 4096
+    ps = int.from_bytes(header[16:18], "big")
+    return 65536 if ps == 1 else (ps or 4096)
+
+
+def _ruta_chunk(sha):
+    return os.path.join(BACKUP_CHUNKS, sha[:2], sha + ".z")
+
+
+def guardar_generacion(path, ts=None, wal=None):
+    """
+    Guarda una generación a partir de un snapshot consistente del DB.
+    Sólo escribe las páginas que no estaban ya en el store.
+    """
+    # una página que se saltea por estar en el store no puede desaparecer
+    # (podar_generaciones) antes de que se escriba este manifiesto
+    with _backup_corrida_lock:
+        return _guardar_generacion(path, ts, wal)
+
+
+def _guardar_generacion(path, ts, wal):
+    ts = ts or time.time()
+    pagina = _db_page_size(path)
+    chunks = []
+    nuevos = 0
+
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(pagina), b""):
+            sha = hashlib.sha256(bloque).hexdigest()
+            chunks.append(sha)
+
+            destino = _ruta_chunk(sha)
+            if os.path.exists(destino):
+                continue
+
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            tmp = destino + ".tmp"
+            with open(tmp, "wb") as out:
+                out.write(zlib.compress(bloque, 6))
+            os.replace(tmp, destino)
+            nuevos += 1
+
+    manifiesto = {
+        "ts": ts,
+        "creado": datetime.fromtimestamp(ts).isoformat(sep=" ", timespec="seconds"),
+        "tamanio": os.path.getsize(path),
+        "pagina": pagina,
+        "chunks": chunks,
+        "wal": wal,
+    }
+
+    os.makedirs(BACKUP_GENERACIONES, exist_ok=True)
+    nombre = datetime.fromtimestamp(ts).strftime("gen_%Y%m%d_%H%M%S_%f.json.gz")
+    destino = os.path.join(BACKUP_GENERACIONES, nombre)
+    with gzip.open(destino + ".tmp", "wt", encoding="utf-8") as out:
+        json.dump(manifiesto, out, separators=(",", ":"))
+    os.replace(destino + ".tmp", destino)
+
+    return {"generacion": nombre, "chunks": len(chunks), "chunks_nuevos": nuevos}
+
+
+def listar_generaciones():
+    """
+    Devuelve [(ts, nombre_archivo)] ordenado de más nueva a más vieja.
+    El timestamp sale del nombre, no hace falta abrir los manifiestos.
+    """
+    if not os.path.isdir(BACKUP_GENERACIONES):
+        return []
+
+    gens = []
+    for nombre in os.listdir(BACKUP_GENERACIONES):
+        if not (nombre.startswith("gen_") and nombre.endswith(".json.gz")):
+            continue
+        try:
+            dt = datetime.strptime(nombre[4:-8], "%Y%m%d_%H%M%S_%f")
+        except ValueError:
+            continue
+        gens.append((dt.timestamp(), nombre))
+
+    gens.sort(reverse=True)
+    return gens
+
+
+def leer_generacion(nombre):
+    with gzip.open(os.path.join(BACKUP_GENERACIONES, nombre), "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _clave_franja(ts, franja):
+    dt = datetime.fromtimestamp(ts)
+    if franja == "reciente":
+        return ts
+    if franja == "hora":
+        return dt.strftime("%Y%m%d%H")
+    if franja == "dia":
+        return dt.strftime("%Y%m%d")
+    iso = dt.isocalendar()
+    return f"{iso[0]}-{iso[1]}"
+
+
+def podar_generaciones():
+    """
+    Aplica BACKUP_RETENCION y borra los chunks que ya no usa ninguna generación.
+    """
+    with _backup_corrida_lock:
+        return _podar_generaciones()
+
+
+def _podar_generaciones():
+    gens = listar_generaciones()
+    if not gens:
+        return {"borradas": 0, "chunks_borrados": 0}
+
+    conservar = {gens[0][1]}
+    for franja, cantidad in BACKUP_RETENCION:
+        vistas = set()
+        for ts, nombre in gens:
+            clave = _clave_franja(ts, franja)
+            if clave in vistas:
+                continue
+            if len(vistas) >= cantidad:
+                break
+            vistas.add(clave)
+            conservar.add(nombre)
+
+    borradas = 0
+    for ts, nombre in gens:
+        if nombre not in conservar:
+            os.remove(os.path.join(BACKUP_GENERACIONES, nombre))
+            borradas += 1
+
+    if not borradas:
+        return {"borradas": 0, "chunks_borrados": 0}
+
+    usados = set()
+    posiciones = []
+    for nombre in conservar:
+        manifiesto = leer_generacion(nombre)
+        usados.update(manifiesto["chunks"])
+        posiciones.append(manifiesto.get("wal"))
+
+    podar_segmentos_wal(posiciones)
+
+    chunks_borrados = 0
+    for carpeta in os.listdir(BACKUP_CHUNKS):
+        ruta_carpeta = os.path.join(BACKUP_CHUNKS, carpeta)
+        for archivo in os.listdir(ruta_carpeta):
+            if archivo.endswith(".z") and archivo[:-2] not in usados:
+                os.remove(os.path.join(ruta_carpeta, archivo))
+                chunks_borrados += 1
+
+    return {"borradas": borradas, "chunks_borrados": chunks_borrados}
+
+
+def buscar_generacion(hasta=None):
+    """
+    La generación más nueva creada hasta 'hasta' (datetime). None = la última.
+    """
+    for ts, nombre in listar_generaciones():
+        if hasta is None or ts <= hasta.timestamp():
+            return nombre
+    return None
+
+
+def restaurar_generacion(nombre, destino=DB_NAME, hasta=None):
+    """
+    Reconstruye el DB de una generación, página por página, sin armar
+    el archivo entero en memoria, y le aplica el WAL archivado hasta 'hasta'.
+    El DB actual queda como <destino>.antes_restore.
+    """
+    manifiesto = leer_generacion(nombre)
+    tmp = destino + ".restore.tmp"
+
+    with open(tmp, "wb") as out:
+        for sha in manifiesto["chunks"]:
+            with open(_ruta_chunk(sha), "rb") as f:
+                out.write(zlib.decompress(f.read()))
+        out.truncate(manifiesto["tamanio"])
+        out.flush()
+        os.fsync(out.fileno())
+
+    aplicados, ultimo_ts = aplicar_segmentos_wal(tmp, manifiesto.get("wal"), hasta)
+    manifiesto["segmentos_wal"] = aplicados
+    manifiesto["restaurado_hasta"] = (
+        datetime.fromtimestamp(ultimo_ts).isoformat(sep=" ", timespec="seconds") if ultimo_ts else manifiesto["creado"]
+    )
+
+    if os.path.exists(destino):
+        shutil.copy2(destino, destino + ".antes_restore")
+    for sufijo in ("-wal", "-shm", "-journal"):
+        if os.path.exists(destino + sufijo):
+            os.remove(destino + sufijo)
+    os.replace(tmp, destino)
+
+    return manifiesto
+
+
+def _parsear_momento(txt):
+    txt = (txt or "").strip()
+    if not txt:
+        return None
+    try:
+        dt = datetime.fromisoformat(txt)
+    except ValueError:
+        raise click.BadParameter(f"Fecha/hora inválida: {txt}")
+    # sólo fecha => hasta el final de ese día
+    if len(txt) == 10:
+        dt = dt.replace(hour=23, minute=59, second=59)
+    return dt
+
+
+@app.cli.command("backups")
+def cli_backups():
+    """Lista las generaciones de backup disponibles."""
+    for ts, nombre in listar_generaciones():
+        print(datetime.fromtimestamp(ts).isoformat(sep=" ", timespec="seconds"), nombre)
+
+
+@app.cli.command("restore")
+@click.option("--at", "momento", default="", help="Fecha/hora (YYYY-MM-DD[ HH:MM[:SS]]). Vacío = último backup.")
+@click.option("--destino", default=DB_NAME, show_default=True, help="Archivo DB a reemplazar.")
+def cli_restore(momento, destino):
+    """Restaura el DB a la última generación anterior a --at. Correr con la app detenida."""
+    hasta = _parsear_momento(momento)
+    nombre = buscar_generacion(hasta)
+    if not nombre:
+        raise click.ClickException("No hay ninguna generación de backup para ese momento.")
+
+    manifiesto = restaurar_generacion(nombre, destino=destino, hasta=hasta)
+    print(f"Restaurado {destino} desde {nombre} ({manifiesto['creado']}, {manifiesto['tamanio']} bytes).")
+    if manifiesto.get("segmentos_wal"):
+        print(f"Aplicados {manifiesto['segmentos_wal']} segmentos WAL (hasta {manifiesto['restaurado_hasta']}).")
+
+
+# =========================
+# WAL: archivo continuo + checkpoints
+# =========================
+# El DB corre en modo WAL (los lectores no esperan a los escritores).
+# Un hilo copia los frames ya confirmados del -wal a backups/wal/<cadena>/
+# cada WAL_ARCHIVO_SEGUNDOS. Cada generación de backup guarda la posición
+# (cadena, seq) del WAL en la que se tomó; para restaurar a un momento se
+# reconstruye la generación y se le aplican los segmentos siguientes.
+#
+# Los checkpoints los hace el archivador (después de archivar). Las conexiones
+# tienen un autocheckpoint alto sólo como red de seguridad: si alguien hace
+# checkpoint antes de archivar, se abre una cadena nueva y se pide un backup.
+WAL_FOLDER = os.path.join(BACKUP_FOLDER, "wal")
+WAL_ESTADO = os.path.join(WAL_FOLDER, "estado.json")
+WAL_ARCHIVO_SEGUNDOS = 1
+WAL_CHECKPOINT_BYTES = 4 * 1024 * 1024
+WAL_AUTOCHECKPOINT_PAGINAS = 10000
+
+WAL_HEADER = 32
+WAL_FRAME_HEADER = 24
+
+_wal_lock = threading.Lock()
+_wal_con = None
+_wal_hilo = None
+
+
+def _wal_estado_inicial():
+    return {"cadena": 1, "seq": 0, "salt": None, "offset": WAL_HEADER, "limpio": True, "pagina": None}
+
+
+def _leer_estado_wal():
+    try:
+        with open(WAL_ESTADO, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return _wal_estado_inicial()
+
+
+def _guardar_estado_wal(estado):
+    os.makedirs(WAL_FOLDER, exist_ok=True)
+    with open(WAL_ESTADO + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(estado, f)
+    os.replace(WAL_ESTADO + ".tmp", WAL_ESTADO)
+
+
+def _conexion_wal():
+    global _wal_con
+    if _wal_con is None:
+        _wal_con = sqlite3.connect(DB_NAME, timeout=30, check_same_thread=False, isolation_level=None)
+        _wal_con.execute(f"PRAGMA wal_autocheckpoint={WAL_AUTOCHECKPOINT_PAGINAS}")
+    return _wal_con
+
+
+def _db_en_modo_wal():
+    try:
+        with open(DB_NAME, "rb") as f:
+            header = f.read(20)
+    except OSError:
+        return False
+    return len(header) >= 20 and header[18] == 2 and header[19] == 2
+
+
+def _ruta_segmento(cadena, seq, ts):
+    return os.path.join(WAL_FOLDER, f"{cadena:06d}", f"{seq:010d}_{int(ts * 1000)}.seg.z")
+
+
+def _listar_segmentos(cadena):
+    carpeta = os.path.join(WAL_FOLDER, f"{cadena:06d}")
+    if not os.path.isdir(carpeta):
+        return []
+
+    segs = []
+    for nombre in os.listdir(carpeta):
+        if not nombre.endswith(".seg.z"):
+            continue
+        seq_txt, ts_txt = nombre[:-6].split("_", 1)
+        segs.append((int(seq_txt), int(ts_txt) / 1000.0, os.path.join(carpeta, nombre)))
+    segs.sort()
+    return segs
+
+
+def _archivar_wal_bloqueado(estado):
+    """
+    Copia los frames confirmados nuevos del -wal. Se llama con el lock de
+    escritura tomado (BEGIN IMMEDIATE), así no hay commits a medio escribir.
+    """
+    ruta_wal = DB_NAME + "-wal"
+    try:
+        f = open(ruta_wal, "rb")
+    except OSError:
+        return estado
+
+    with f:
+        header = f.read(WAL_HEADER)
+        if len(header) < WAL_HEADER:
+            return estado
+
+        pagina = int.from_bytes(header[8:12], "big")
+        salt = [int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")]
+
+        if salt != estado["salt"]:
+            if not estado["limpio"]:
+                # el WAL se reinició con frames que no llegamos a copiar
+                estado["cadena"] += 1
+                solicitar_backup()
+            estado["salt"] = salt
+            estado["offset"] = WAL_HEADER
+            estado["pagina"] = pagina
+        estado["limpio"] = False
+
+        tam_frame = WAL_FRAME_HEADER + pagina
+        f.seek(estado["offset"])
+        frames = []
+        confirmado = 0
+        while True:
+            frame = f.read(tam_frame)
+            if len(frame) < tam_frame:
+                break
+            if [int.from_bytes(frame[8:12], "big"), int.from_bytes(frame[12:16], "big")] != salt:
+                break
+            frames.append(frame)
+            if int.from_bytes(frame[4:8], "big"):
+                confirmado = len(frames)
+
+    if not confirmado:
+        return estado
+
+    ts = time.time()
+    estado["seq"] += 1
+    destino = _ruta_segmento(estado["cadena"], estado["seq"], ts)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    with open(destino + ".tmp", "wb") as out:
+        out.write(zlib.compress(b"".join(frames[:confirmado]), 6))
+    os.replace(destino + ".tmp", destino)
+
+    estado["offset"] += confirmado * tam_frame
+    return estado
+
+
+def archivar_wal(checkpoint=True):
+    """
+    Una pasada del archivador: copia frames nuevos y, si el -wal creció
+    más de WAL_CHECKPOINT_BYTES, hace checkpoint(TRUNCATE).
+    """
+    if not _db_en_modo_wal():
+        return None
+
+    with _wal_lock:
+        con = _conexion_wal()
+        estado = _leer_estado_wal()
+
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            estado = _archivar_wal_bloqueado(estado)
+            # data_version cambia con cada commit de otra conexión (de este u
+            # otro proceso): sirve para saber si entró algo después de archivar
+            version = con.execute("PRAGMA data_version").fetchone()[0]
+        finally:
+            con.execute("COMMIT")
+
+        try:
+            tam_wal = os.path.getsize(DB_NAME + "-wal")
+        except OSError:
+            tam_wal = 0
+
+        if checkpoint and tam_wal > WAL_CHECKPOINT_BYTES and estado["pagina"]:
+            ocupado, _, _ = con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            if not ocupado:
+                # un TRUNCATE exitoso devuelve (0, 0, 0) aunque se haya llevado
+                # frames sin archivar: lo que vale es si hubo commits en el medio
+                if con.execute("PRAGMA data_version").fetchone()[0] != version:
+                    estado["cadena"] += 1
+                    solicitar_backup()
+                estado["limpio"] = True
+
+        _guardar_estado_wal(estado)
+        return estado
+
+
+def fijar_lectura_en_posicion_wal(con_lectura):
+    """
+    Con las escrituras frenadas: archiva el WAL hasta el final y abre una
+    transacción de lectura en con_lectura. La foto que se lea con esa
+    conexión corresponde exactamente a la posición devuelta.
+    """
+    if not _db_en_modo_wal():
+        return None
+
+    with _wal_lock:
+        con = _conexion_wal()
+        estado = _leer_estado_wal()
+
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            estado = _archivar_wal_bloqueado(estado)
+            con_lectura.execute("BEGIN")
+            con_lectura.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        finally:
+            con.execute("COMMIT")
+
+        _guardar_estado_wal(estado)
+        return {"cadena": estado["cadena"], "seq": estado["seq"]}
+
+
+def aplicar_segmentos_wal(path, posicion, hasta=None):
+    """
+    Aplica sobre path (un DB reconstruido de una generación) los segmentos
+    archivados después de posicion, hasta el momento 'hasta' (datetime).
+    Devuelve (cantidad_aplicada, timestamp_del_último).
+    """
+    if not posicion:
+        return 0, None
+
+    limite = hasta.timestamp() if hasta else None
+    pagina = _db_page_size(path)
+    tam_frame = WAL_FRAME_HEADER + pagina
+    aplicados = 0
+    ultimo_ts = None
+
+    with open(path, "r+b") as db:
+        for seq, ts, ruta in _listar_segmentos(posicion["cadena"]):
+            if seq <= posicion["seq"]:
+                continue
+            if limite is not None and ts > limite:
+                break
+
+            with open(ruta, "rb") as f:
+                datos = zlib.decompress(f.read())
+
+            for i in range(0, len(datos), tam_frame):
+                frame = datos[i:i + tam_frame]
+                pgno = int.from_bytes(frame[0:4], "big")
+                paginas_commit = int.from_bytes(frame[4:8], "big")
+                db.seek((pgno - 1) * pagina)
+                db.write(frame[WAL_FRAME_HEADER:])
+                if paginas_commit:
+                    db.truncate(paginas_commit * pagina)
+
+            aplicados += 1
+            ultimo_ts = ts
+
+        db.flush()
+        os.fsync(db.fileno())
+
+    return aplicados, ultimo_ts
+
+
+def podar_segmentos_wal(posiciones_vigentes):
+    """
+    Borra los segmentos que ya no hacen falta: los anteriores a la generación
+    más vieja que se conserva dentro de cada cadena, y las cadenas sin base.
+    """
+    minimos = {}
+    for pos in posiciones_vigentes:
+        if pos:
+            minimos[pos["cadena"]] = min(minimos.get(pos["cadena"], pos["seq"]), pos["seq"])
+
+    if not os.path.isdir(WAL_FOLDER):
+        return 0
+
+    cadena_actual = _leer_estado_wal()["cadena"]
+    borrados = 0
+    for carpeta in os.listdir(WAL_FOLDER):
+        if not carpeta.isdigit():
+            continue
+        cadena = int(carpeta)
+        if cadena == cadena_actual and cadena not in minimos:
+            continue
+        for seq, ts, ruta in _listar_segmentos(cadena):
+            if cadena not in minimos or seq <= minimos[cadena]:
+                os.remove(ruta)
+                borrados += 1
+
+    return borrados
+
+
+def _wal_archivador_loop():
+    ultima_firma = None
+    while True:
+        time.sleep(WAL_ARCHIVO_SEGUNDOS)
+        try:
+            st = os.stat(DB_NAME + "-wal")
+            firma = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            continue
+        if firma == ultima_firma:
+            continue
+        try:
+            archivar_wal()
+            ultima_firma = firma
+        except Exception as e:
+            print("WAL archive error:", e)
+
+
+def iniciar_archivador_wal():
+    global _wal_hilo
+    with _wal_lock:
+        if _wal_hilo is not None and _wal_hilo.is_alive():
+            return
+        _wal_hilo = threading.Thread(target=_wal_archivador_loop, name="wal-archiver", daemon=True)
+        _wal_hilo.start()
+
+
+# =========================
+# Decoradores auth
+# =========================
+def login_required(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if "user_id" not in session:
+            return redirect(url_for("login"))
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def admin_required(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if "user_id" not in session or session.get("rol") != "admin":
+            return redirect(url_for("dashboard"))
+        return f(*args, **kwargs)
+    return wrapper
+
+
+# =========================
+# Diagnósticos (AUTEL)
+# =========================
+@app.route("/diagnosticos")
+@login_required
+def diagnosticos_listado():
+    q = (request.args.get("q") or "").strip()
+
+    cur = get_db().cursor()
+
+    sql = """
+        SELECT
+            d.id,
+            d.fecha_mail,
+            d.vin,
+            d.marca,
+            d.modelo,
+            d.odometro,
+            d.subject,
+            d.filename,
             d.created_at,
             d.vehiculo_id,
             d.reparacion_id,
@@ -916,7 +2952,16 @@ def diagnosticos_listado():
     """
     params = []
 
-    if q:
+    match = consulta_fts(q)
+    if match:
+        sql += """
+            AND (
+                d.id IN (SELECT ref_id FROM busqueda_fts WHERE busqueda_fts MATCH ? AND tipo = 'diagnostico')
+                OR d.vehiculo_id IN (SELECT ref_id FROM busqueda_fts WHERE busqueda_fts MATCH ? AND tipo = 'vehiculo')
+            )
+        """
+        params.extend([match, match])
+    elif q:
         p = f"%{q}%"
         sql += """
             AND (
@@ -930,77 +2975,82 @@ def diagnosticos_listado():
         """
         params.extend([p, p, p, p, p, p])
 
-    sql += " ORDER BY d.id DESC"
-
-    cur.execute(sql, params)
-    rows = cur.fetchall()
-
-    # listado de vehículos para vinculación manual
-    cur.execute("""
-        SELECT
-            id,
-            patente,
-            marca,
-            modelo,
-            vin
-        FROM vehiculos
-        ORDER BY patente ASC, marca ASC, modelo ASC
-    """)
-    vehiculos_lookup = cur.fetchall()
-
-    con.close()
+    rows, siguiente = pagina_keyset(
+        cur, sql, params, ["d.id"], lambda d: (d["id"],),
+        request.args.get("despues"), tamanio_pagina(), descendente=True,
+    )
 
+    # la vinculación manual busca el vehículo con /vehiculos/buscar
     return render_template(
         "diagnosticos.html",
         diagnosticos=rows,
         q=q,
-        vehiculos_lookup=vehiculos_lookup
+        siguiente=siguiente,
     )
 
 
+def archivo_diagnostico(diag_id):
+    """
+    (carpeta, ruta, nombre) del PDF de un diagnóstico: del almacén por
+    contenido si está ahí, si no de UPLOAD_DIAG_FOLDER (cargas viejas).
+    """
+    cur = get_db().cursor()
+    cur.execute("""
+        SELECT d.filename, b.ruta
+        FROM diagnosticos d
+        LEFT JOIN blobs b ON b.sha256 = d.sha256
+        WHERE d.id = ?
+    """, (diag_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    if row["ruta"]:
+        return UPLOAD_FOLDER, row["ruta"], row["filename"] or os.path.basename(row["ruta"])
+    return UPLOAD_DIAG_FOLDER, row["filename"], row["filename"]
+
+
 @app.route("/diagnosticos/<int:diag_id>/descargar")
 @login_required
 def diagnostico_descargar(diag_id):
-    con = get_con()
-    cur = con.cursor()
-    cur.execute("SELECT filename FROM diagnosticos WHERE id=?", (diag_id,))
-    row = cur.fetchone()
-    con.close()
+    row = archivo_diagnostico(diag_id)
 
     if not row:
         flash("Diagnóstico no encontrado.", "warning")
         return redirect(url_for("diagnosticos_listado"))
 
-    filename = row["filename"]
-    return send_from_directory(UPLOAD_DIAG_FOLDER, filename, as_attachment=True)
+    carpeta, ruta, filename = row
+    return enviar_archivo(carpeta, ruta, as_attachment=True, download_name=filename)
 
 
 @app.route("/diagnosticos/<int:diag_id>/autovincular", methods=["POST"])
 @login_required
 def diagnostico_autovincular(diag_id):
-    con = get_con()
-    cur = con.cursor()
-
-    res = vincular_diagnostico_existente(cur, diag_id, vehiculo_id=None, reparacion_id=None, crear_reparacion=False)
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        res = vincular_diagnostico_existente(cur, diag_id, vehiculo_id=None, reparacion_id=None, crear_reparacion=False)
 
     flash(res["msg"], "success" if res["ok"] else "warning")
-    backup_db_if_changed()
+    return redirect(request.referrer or url_for("diagnosticos_listado"))
+
+
+@app.route("/diagnosticos/vincular_pendientes", methods=["POST"])
+@admin_required
+def diagnosticos_vincular_pendientes():
+    """Autovincula todos los pendientes por VIN en una sola transacción."""
+    with transaccion() as cur:
+        n = len(revincular_diagnosticos_pendientes(cur))
+
+    if n:
+        flash(f"Diagnósticos vinculados por VIN: {n}.", "success")
+    else:
+        flash("No hay diagnósticos pendientes con un VIN cargado en algún vehículo.", "warning")
     return redirect(request.referrer or url_for("diagnosticos_listado"))
 
 
 @app.route("/diagnosticos/<int:diag_id>/crear_reparacion", methods=["POST"])
 @login_required
 def diagnostico_crear_reparacion(diag_id):
-    con = get_con()
-    cur = con.cursor()
-
-    res = vincular_diagnostico_existente(cur, diag_id, vehiculo_id=None, reparacion_id=None, crear_reparacion=True)
-    con.commit()
-    con.close()
-
-    backup_db_if_changed()
+    with transaccion() as cur:
+        res = vincular_diagnostico_existente(cur, diag_id, vehiculo_id=None, reparacion_id=None, crear_reparacion=True)
 
     if res["ok"] and res.get("reparacion_id"):
         flash("Reparación creada y diagnóstico vinculado.", "success")
@@ -1020,20 +3070,14 @@ def diagnostico_vincular_manual(diag_id):
     vehiculo_id = int(vehiculo_id) if vehiculo_id.isdigit() else None
     reparacion_id = int(reparacion_id) if reparacion_id.isdigit() else None
 
-    con = get_con()
-    cur = con.cursor()
-
-    res = vincular_diagnostico_existente(
-        cur,
-        diag_id,
-        vehiculo_id=vehiculo_id,
-        reparacion_id=reparacion_id,
-        crear_reparacion=crear_reparacion
-    )
-    con.commit()
-    con.close()
-
-    backup_db_if_changed()
+    with transaccion() as cur:
+        res = vincular_diagnostico_existente(
+            cur,
+            diag_id,
+            vehiculo_id=vehiculo_id,
+            reparacion_id=reparacion_id,
+            crear_reparacion=crear_reparacion
+        )
 
     if res["ok"] and res.get("reparacion_id"):
         flash("Diagnóstico vinculado correctamente.", "success")
@@ -1043,17 +3087,37 @@ def diagnostico_vincular_manual(diag_id):
     return redirect(request.referrer or url_for("diagnosticos_listado"))
 
 
+# =========================
+# Generación de escritura (para invalidar cachés)
+# =========================
+_generacion_lock = threading.Lock()
+_generacion_con = None
+
+
+def generacion_escritura():
+    """
+    Número que cambia cada vez que alguien hace commit en el DB (este proceso,
+    fetch_autel_gmail.py, un restore...). Es PRAGMA data_version leído desde
+    una conexión centinela que nunca escribe, así que cuesta microsegundos.
+    """
+    global _generacion_con
+    with _generacion_lock:
+        if _generacion_con is None:
+            _generacion_con = _abrir_conexion(check_same_thread=False)
+        return _generacion_con.execute("PRAGMA data_version").fetchone()[0]
+
+
 # =========================
 # Dashboard
 # =========================
-@app.route("/")
-@login_required
-def dashboard():
-    con = get_con()
-    cur = con.cursor()
+_dashboard_lock = threading.Lock()
+_dashboard_cache = {"clave": None, "datos": None}
 
-    hoy = date.today().isoformat()
-    desde_7 = (date.today() - timedelta(days=6)).isoformat()
+
+def calcular_dashboard(cur, hoy):
+    """Métricas del tablero con unas pocas consultas agrupadas."""
+    desde_7 = (hoy - timedelta(days=6)).isoformat()
+    hoy_txt = hoy.isoformat()
 
     # Reparaciones visibles
     cur.execute("""
@@ -1082,7 +3146,7 @@ def dashboard():
         WHERE fecha >= ?
         ORDER BY fecha, hora
         LIMIT 10
-    """, (hoy,))
+    """, (hoy_txt,))
     citas = cur.fetchall()
 
     # Gastos pendientes
@@ -1095,72 +3159,40 @@ def dashboard():
     """)
     gastos_pendientes = cur.fetchall()
 
+    # Contadores: una sola pasada por las reparaciones abiertas
     cur.execute("""
-        SELECT COALESCE(SUM(monto),0)
-        FROM gastos
-        WHERE COALESCE(pagado,0)=0
-    """)
-    total_gastos_pendientes = (cur.fetchone()[0] or 0)
-
-    # Métricas
-    cur.execute("SELECT COUNT(*) FROM reparaciones WHERE estado='Ingresado'")
-    reparaciones_en_proceso = cur.fetchone()[0] or 0
-
-    cur.execute("SELECT COUNT(*) FROM reparaciones WHERE estado IN ('Ingresado','Entregado')")
-    reparaciones_pendientes = cur.fetchone()[0] or 0
-
-    cur.execute("SELECT COUNT(*) FROM reparaciones WHERE fecha=? AND estado='Ingresado'", (hoy,))
-    reparaciones_hoy = cur.fetchone()[0] or 0
-
-    # Diagnósticos pendientes de vinculación
-    cur.execute("""
-        SELECT COUNT(*)
-        FROM diagnosticos
-        WHERE COALESCE(estado_vinculacion, 'PENDIENTE') <> 'VINCULADO'
-    """)
-    diagnosticos_pendientes = cur.fetchone()[0] or 0
-
-    # Ingresos últimos 7 días
-    cur.execute("""
-        SELECT COALESCE(SUM(COALESCE(total_servicios,total)),0)
-        FROM facturas
-        WHERE COALESCE(es_presupuesto,1)=0
-          AND fecha BETWEEN ? AND ?
-    """, (desde_7, hoy))
-    total_ingresos_7 = cur.fetchone()[0] or 0
-
-    # Gastos últimos 7 días
+        SELECT
+            COALESCE(SUM(estado = 'Ingresado'), 0),
+            COUNT(*),
+            COALESCE(SUM(estado = 'Ingresado' AND fecha = ?), 0),
+            (SELECT COALESCE(SUM(gastos_pendientes),0) FROM ledger_diario),
+            (SELECT COUNT(*) FROM diagnosticos WHERE COALESCE(estado_vinculacion, 'PENDIENTE') <> 'VINCULADO')
+        FROM reparaciones
+        WHERE estado IN ('Ingresado','Entregado')
+    """, (hoy_txt,))
+    (
+        reparaciones_en_proceso,
+        reparaciones_pendientes,
+        reparaciones_hoy,
+        total_gastos_pendientes,
+        diagnosticos_pendientes,
+    ) = cur.fetchone()
+
+    # Series diarias de los últimos 7 días, desde el ledger
     cur.execute("""
-        SELECT COALESCE(SUM(monto),0)
-        FROM gastos
+        SELECT fecha, SUM(ingresos_servicios), SUM(gastos)
+        FROM ledger_diario
         WHERE fecha BETWEEN ? AND ?
-    """, (desde_7, hoy))
-    total_gastos_7 = cur.fetchone()[0] or 0
-
-    balance_7 = total_ingresos_7 - total_gastos_7
-
-    # Serie diaria
-    labels = []
-    ingresos_por_dia = []
-    gastos_por_dia = []
-
-    for i in range(7):
-        d = (date.today() - timedelta(days=(6 - i))).isoformat()
-        labels.append(d)
+        GROUP BY fecha
+    """, (desde_7, hoy_txt))
+    por_dia = {fila[0]: fila for fila in cur.fetchall()}
 
-        cur.execute("""
-            SELECT COALESCE(SUM(COALESCE(total_servicios,total)),0)
-            FROM facturas
-            WHERE COALESCE(es_presupuesto,1)=0 AND fecha = ?
-        """, (d,))
-        ingresos_por_dia.append(float(cur.fetchone()[0] or 0))
+    labels = [(hoy - timedelta(days=(6 - i))).isoformat() for i in range(7)]
+    ingresos_por_dia = [float(por_dia[d][1]) if d in por_dia else 0.0 for d in labels]
+    gastos_por_dia = [float(por_dia[d][2]) if d in por_dia else 0.0 for d in labels]
 
-        cur.execute("""
-            SELECT COALESCE(SUM(monto),0)
-            FROM gastos
-            WHERE fecha = ?
-        """, (d,))
-        gastos_por_dia.append(float(cur.fetchone()[0] or 0))
+    total_ingresos_7 = sum(ingresos_por_dia)
+    total_gastos_7 = sum(gastos_por_dia)
 
     # Pendientes de cobro
     cur.execute("""
@@ -1190,12 +3222,7 @@ def dashboard():
     """)
     pendientes_cobro = cur.fetchall()
 
-    con.close()
-
-    last_backup_dt = get_last_backup_datetime()
-
-    return render_template(
-        "dashboard.html",
+    return dict(
         trabajos=trabajos,
         citas=citas,
         reparaciones_en_proceso=reparaciones_en_proceso,
@@ -1203,11 +3230,10 @@ def dashboard():
         reparaciones_hoy=reparaciones_hoy,
         total_ingresos_7=total_ingresos_7,
         total_gastos_7=total_gastos_7,
-        balance_7=balance_7,
+        balance_7=total_ingresos_7 - total_gastos_7,
         gastos_pendientes=gastos_pendientes,
         total_gastos_pendientes=total_gastos_pendientes,
         diagnosticos_pendientes=diagnosticos_pendientes,
-        last_backup_dt=last_backup_dt,
         pendientes_cobro=pendientes_cobro,
         labels=labels,
         ingresos_por_dia=ingresos_por_dia,
@@ -1215,6 +3241,37 @@ def dashboard():
     )
 
 
+def get_dashboard_snapshot():
+    """
+    Snapshot cacheado del tablero. Se recalcula solo si hubo un commit
+    (generación de escritura) o cambió el día.
+    """
+    hoy = date.today()
+    clave = (generacion_escritura(), hoy)
+
+    with _dashboard_lock:
+        if _dashboard_cache["clave"] == clave:
+            return _dashboard_cache["datos"]
+
+    datos = calcular_dashboard(get_db().cursor(), hoy)
+
+    with _dashboard_lock:
+        _dashboard_cache["clave"] = clave
+        _dashboard_cache["datos"] = datos
+    return datos
+
+
+@app.route("/")
+@login_required
+def dashboard():
+    return render_template(
+        "dashboard.html",
+        last_backup_dt=get_last_backup_datetime(),
+        backup_estado=get_backup_estado(),
+        **get_dashboard_snapshot()
+    )
+
+
 # =========================
 # Auth
 # =========================
@@ -1224,11 +3281,9 @@ def login():
         user = request.form["username"]
         password = request.form["password"]
 
-        con = get_con()
-        cur = con.cursor()
+        cur = get_db().cursor()
         cur.execute("SELECT id, rol FROM users WHERE username=? AND password=?", (user, password))
         data = cur.fetchone()
-        con.close()
 
         if data:
             session["user_id"] = data[0]
@@ -1253,11 +3308,9 @@ def logout():
 @app.route("/usuarios")
 @admin_required
 def usuarios():
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT id, username, rol FROM users ORDER BY username")
     usuarios = cur.fetchall()
-    con.close()
     return render_template("usuarios.html", usuarios=usuarios)
 
 
@@ -1269,11 +3322,8 @@ def usuario_nuevo():
         password = request.form["password"]
         rol = request.form.get("rol") or "operador"
 
-        con = get_con()
-        cur = con.cursor()
-        cur.execute("INSERT INTO users (username, password, rol) VALUES (?, ?, ?)", (username, password, rol))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("INSERT INTO users (username, password, rol) VALUES (?, ?, ?)", (username, password, rol))
         return redirect(url_for("usuarios"))
 
     return render_template("usuario_form.html")
@@ -1282,39 +3332,113 @@ def usuario_nuevo():
 @app.route("/backup", methods=["POST"])
 @admin_required
 def backup_manual():
-    backup_db_if_changed()
+    ejecutar_backup(verificar=True)
     return redirect(url_for("dashboard"))
 
 
 # =========================
 # Clientes
 # =========================
+@app.route("/buscar")
+@login_required
+def buscar():
+    """
+    Búsqueda global. Devuelve JSON con resultados tipados y ordenados por
+    relevancia (bm25, el título pesa más que el resto del texto).
+    """
+    q = (request.args.get("q") or "").strip()
+    try:
+        limite = max(1, min(int(request.args.get("limite") or 20), 50))
+    except ValueError:
+        limite = 20
+
+    if not q:
+        return jsonify(q=q, resultados=[])
+
+    cur = get_db().cursor()
+    match = consulta_fts(q)
+    if match:
+        cur.execute("""
+            SELECT tipo, ref_id, titulo, snippet(busqueda_fts, 3, '[', ']', '…', 8)
+            FROM busqueda_fts
+            WHERE busqueda_fts MATCH ?
+            ORDER BY bm25(busqueda_fts, 0, 0, 10.0, 1.0)
+            LIMIT ?
+        """, (match, limite))
+    else:
+        # menos de 3 letras: LIKE sobre el mismo índice, acotado por el LIMIT
+        cur.execute("""
+            SELECT tipo, ref_id, titulo, texto
+            FROM busqueda_fts
+            WHERE texto LIKE ?
+            LIMIT ?
+        """, (f"%{q}%", limite))
+
+    destinos = {
+        "cliente": ("vehiculos_cliente", "cliente_id"),
+        "vehiculo": ("reparaciones_vehiculo", "vehiculo_id"),
+        "reparacion": ("reparacion_detalle", "reparacion_id"),
+        "diagnostico": ("diagnostico_ver", "diag_id"),
+    }
+    resultados = []
+    for tipo, ref_id, titulo, detalle in cur.fetchall():
+        endpoint, arg = destinos[tipo]
+        resultados.append({
+            "tipo": tipo,
+            "id": ref_id,
+            "titulo": titulo,
+            "detalle": detalle,
+            "url": url_for(endpoint, **{arg: ref_id}),
+        })
+
+    return jsonify(q=q, resultados=resultados)
+
+
 @app.route("/clientes")
 @login_required
 def clientes():
     q = request.args.get("q", "").strip()
 
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
-    if q:
+    match = consulta_fts(q)
+    if match:
+        # clientes que coinciden directo o por alguno de sus vehículos
+        sql = """
+            SELECT * FROM clientes
+            WHERE id IN (
+                SELECT ref_id FROM busqueda_fts WHERE busqueda_fts MATCH ? AND tipo = 'cliente'
+                UNION
+                SELECT v.cliente_id
+                FROM busqueda_fts b
+                JOIN vehiculos v ON v.id = b.ref_id
+                WHERE busqueda_fts MATCH ? AND b.tipo = 'vehiculo'
+            )
+        """
+        params = [match, match]
+    elif q:
         patron = f"%{q}%"
-        cur.execute("""
+        sql = """
             SELECT * FROM clientes
-            WHERE nombre LIKE ?
+            WHERE (nombre LIKE ?
                OR apellido LIKE ?
                OR telefono LIKE ?
                OR email LIKE ?
-               OR id IN (SELECT cliente_id FROM vehiculos WHERE patente LIKE ? OR vin LIKE ?)
-            ORDER BY apellido, nombre
-        """, (patron, patron, patron, patron, patron, patron))
+               OR id IN (SELECT cliente_id FROM vehiculos WHERE patente LIKE ? OR vin LIKE ?))
+        """
+        params = [patron] * 6
     else:
-        cur.execute("SELECT * FROM clientes ORDER BY apellido, nombre")
-
-    lista = cur.fetchall()
-    con.close()
+        sql = "SELECT * FROM clientes WHERE 1=1"
+        params = []
+
+    lista, siguiente = pagina_keyset(
+        cur, sql, params,
+        ["COALESCE(apellido,'')", "COALESCE(nombre,'')", "id"],
+        lambda c: (c["apellido"] or "", c["nombre"] or "", c["id"]),
+        request.args.get("despues"), tamanio_pagina(),
+    )
 
-    return render_template("clientes.html", clientes=lista, q=q)
+    return render_template("clientes.html", clientes=lista, q=q, siguiente=siguiente)
 
 
 @app.route("/clientes/nuevo", methods=["GET", "POST"])
@@ -1333,16 +3457,12 @@ def cliente_nuevo():
         nombre = nombre_raw.strip().title()
         apellido = apellido_raw.strip().title()
 
-        con = get_con()
-        cur = con.cursor()
-        cur.execute("""
-            INSERT INTO clientes (nombre, apellido, telefono, email, direccion, notas, documento, razon_social)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (nombre, apellido, telefono, email, direccion, notas, documento, razon_social))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("""
+                INSERT INTO clientes (nombre, apellido, telefono, email, direccion, notas, documento, razon_social)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (nombre, apellido, telefono, email, direccion, notas, documento, razon_social))
 
-        backup_db_if_changed()
         return redirect(url_for("clientes"))
 
     return render_template("cliente_form.html")
@@ -1351,9 +3471,6 @@ def cliente_nuevo():
 @app.route("/clientes/editar/<int:id>", methods=["GET", "POST"])
 @login_required
 def cliente_editar(id):
-    con = get_con()
-    cur = con.cursor()
-
     if request.method == "POST":
         nombre_raw = request.form["nombre"]
         apellido_raw = request.form["apellido"]
@@ -1367,21 +3484,18 @@ def cliente_editar(id):
         nombre = nombre_raw.strip().title()
         apellido = apellido_raw.strip().title()
 
-        cur.execute("""
-            UPDATE clientes
-            SET nombre=?, apellido=?, telefono=?, email=?, direccion=?, notas=?, documento=?, razon_social=?
-            WHERE id=?
-        """, (nombre, apellido, telefono, email, direccion, notas, documento, razon_social, id))
-
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("""
+                UPDATE clientes
+                SET nombre=?, apellido=?, telefono=?, email=?, direccion=?, notas=?, documento=?, razon_social=?
+                WHERE id=?
+            """, (nombre, apellido, telefono, email, direccion, notas, documento, razon_social, id))
 
-        backup_db_if_changed()
         return redirect(url_for("clientes"))
 
+    cur = get_db().cursor()
     cur.execute("SELECT * FROM clientes WHERE id=?", (id,))
     cliente = cur.fetchone()
-    con.close()
 
     return render_template("cliente_form.html", cliente=cliente)
 
@@ -1389,13 +3503,12 @@ def cliente_editar(id):
 @app.route("/clientes/eliminar/<int:id>")
 @login_required
 def cliente_eliminar(id):
-    con = get_con()
-    cur = con.cursor()
-    cur.execute("DELETE FROM clientes WHERE id=?", (id,))
-    con.commit()
-    con.close()
+    try:
+        with transaccion() as cur:
+            cur.execute("DELETE FROM clientes WHERE id=?", (id,))
+    except sqlite3.IntegrityError:
+        flash("No se puede eliminar el cliente: tiene vehículos cargados.", "warning")
 
-    backup_db_if_changed()
     return redirect(url_for("clientes"))
 
 
@@ -1405,8 +3518,7 @@ def cliente_eliminar(id):
 @app.route("/clientes/<int:cliente_id>/vehiculos")
 @login_required
 def vehiculos_cliente(cliente_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     cur.execute("SELECT * FROM clientes WHERE id=?", (cliente_id,))
     cliente = cur.fetchone()
@@ -1414,18 +3526,112 @@ def vehiculos_cliente(cliente_id):
     cur.execute("SELECT * FROM vehiculos WHERE cliente_id=?", (cliente_id,))
     vehiculos = cur.fetchall()
 
-    con.close()
     return render_template("vehiculos.html", cliente=cliente, vehiculos=vehiculos)
 
 
+@app.route("/vehiculos/buscar")
+@login_required
+def vehiculos_buscar():
+    """
+    Typeahead de vehículos por patente o VIN. Devuelve JSON con los primeros
+    que empiezan con el texto (rango sobre índice) y, si faltan, los que lo
+    contienen (FTS).
+    """
+    q = (request.args.get("q") or "").strip().upper()
+    try:
+        limite = max(1, min(int(request.args.get("limite") or 10), 50))
+    except ValueError:
+        limite = 10
+
+    if not q:
+        return jsonify(q=q, resultados=[])
+
+    cur = get_db().cursor()
+    desde, hasta = rango_prefijo(q)
+
+    cur.execute("""
+        SELECT id, patente, marca, modelo, vin
+        FROM vehiculos
+        WHERE UPPER(COALESCE(patente,'')) >= ? AND UPPER(COALESCE(patente,'')) < ?
+        ORDER BY UPPER(COALESCE(patente,''))
+        LIMIT ?
+    """, (desde, hasta, limite))
+    filas = cur.fetchall()
+
+    vin = limpiar_vin(q)
+    if vin:
+        desde, hasta = rango_prefijo(vin)
+        cur.execute("""
+            SELECT id, patente, marca, modelo, vin
+            FROM vehiculos
+            WHERE vin_norm >= ? AND vin_norm < ?
+            ORDER BY vin_norm
+            LIMIT ?
+        """, (desde, hasta, limite))
+        filas += cur.fetchall()
+
+    match = consulta_fts(q)
+    if match and len({v["id"] for v in filas}) < limite:
+        cur.execute("""
+            SELECT v.id, v.patente, v.marca, v.modelo, v.vin
+            FROM busqueda_fts b
+            JOIN vehiculos v ON v.id = b.ref_id
+            WHERE busqueda_fts MATCH ? AND b.tipo = 'vehiculo'
+            ORDER BY bm25(busqueda_fts, 0, 0, 10.0, 1.0)
+            LIMIT ?
+        """, (match, limite * 2))
+        filas += cur.fetchall()
+
+    resultados = []
+    vistos = set()
+    for v in filas:
+        if v["id"] in vistos:
+            continue
+        vistos.add(v["id"])
+        etiqueta = f"{v['patente'] or '-'} - {v['marca'] or ''} {v['modelo'] or ''}"
+        if v["vin"]:
+            etiqueta += f" | VIN: {v['vin']}"
+        resultados.append({
+            "id": v["id"],
+            "patente": v["patente"] or "",
+            "vin": v["vin"] or "",
+            "etiqueta": etiqueta,
+        })
+        if len(resultados) == limite:
+            break
+
+    return jsonify(q=q, resultados=resultados)
+
+
+def flash_vin_repetido(vin):
+    otro = obtener_vehiculo_por_vin(get_db().cursor(), vin)
+    if otro:
+        flash(f"El VIN {vin} ya está cargado en el vehículo {otro['patente'] or '#' + str(otro['id'])}.", "warning")
+    else:
+        flash(f"El VIN {vin} ya está cargado en otro vehículo.", "warning")
+
+
+def flash_error_vehiculo(error, vin):
+    # sólo el índice único de vin_norm es "VIN repetido"; el resto (FK, NOT NULL) se muestra tal cual
+    if "vehiculos.vin_norm" in str(error):
+        flash_vin_repetido(vin)
+    else:
+        flash(f"No se pudo guardar el vehículo: {error}", "warning")
+
+
+def flash_diagnosticos_vinculados(n):
+    if n == 1:
+        flash("Se vinculó 1 diagnóstico Autel pendiente con este VIN.", "success")
+    elif n:
+        flash(f"Se vincularon {n} diagnósticos Autel pendientes con este VIN.", "success")
+
+
 @app.route("/clientes/<int:cliente_id>/vehiculos/nuevo", methods=["GET", "POST"])
 @login_required
 def vehiculo_nuevo(cliente_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT * FROM clientes WHERE id=?", (cliente_id,))
     cliente = cur.fetchone()
-    con.close()
 
     if request.method == "POST":
         patente = request.form.get("patente", "").strip().upper()
@@ -1436,16 +3642,20 @@ def vehiculo_nuevo(cliente_id):
         vin = limpiar_vin(request.form.get("vin", ""))
         notas = request.form.get("notas", "").strip()
 
-        con = get_con()
-        cur = con.cursor()
-        cur.execute("""
-            INSERT INTO vehiculos (cliente_id, patente, marca, modelo, anio, km, vin, notas)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (cliente_id, patente, marca, modelo, anio, km, vin, notas))
-        con.commit()
-        con.close()
+        try:
+            with transaccion() as cur:
+                cur.execute("""
+                    INSERT INTO vehiculos (cliente_id, patente, marca, modelo, anio, km, vin, vin_norm, notas)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (cliente_id, patente, marca, modelo, anio, km, vin, vin or None, notas))
+                vinculados = len(revincular_diagnosticos_pendientes(cur, vin)) if vin else 0
+        except sqlite3.IntegrityError as e:
+            flash_error_vehiculo(e, vin)
+            # se vuelve a mostrar el formulario con lo que se cargó
+            return render_template("vehiculo_form.html", cliente=cliente, datos=request.form)
+
+        flash_diagnosticos_vinculados(vinculados)
 
-        backup_db_if_changed()
         return redirect(url_for("vehiculos_cliente", cliente_id=cliente_id))
 
     return render_template("vehiculo_form.html", cliente=cliente)
@@ -1454,13 +3664,11 @@ def vehiculo_nuevo(cliente_id):
 @app.route("/vehiculos/editar/<int:id>", methods=["GET", "POST"])
 @login_required
 def vehiculo_editar(id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT * FROM vehiculos WHERE id=?", (id,))
     vehiculo = cur.fetchone()
 
     if not vehiculo:
-        con.close()
         return redirect(url_for("clientes"))
 
     cliente_id = vehiculo["cliente_id"]
@@ -1476,41 +3684,43 @@ def vehiculo_editar(id):
         vin = limpiar_vin(request.form.get("vin", ""))
         notas = request.form.get("notas", "").strip()
 
-        cur.execute("""
-            UPDATE vehiculos
-            SET patente=?, marca=?, modelo=?, anio=?, km=?, vin=?, notas=?
-            WHERE id=?
-        """, (patente, marca, modelo, anio, km, vin, notas, id))
+        try:
+            with transaccion() as cur:
+                cur.execute("""
+                    UPDATE vehiculos
+                    SET patente=?, marca=?, modelo=?, anio=?, km=?, vin=?, vin_norm=?, notas=?
+                    WHERE id=?
+                """, (patente, marca, modelo, anio, km, vin, vin or None, notas, id))
+                vinculados = len(revincular_diagnosticos_pendientes(cur, vin)) if vin else 0
+        except sqlite3.IntegrityError as e:
+            flash_error_vehiculo(e, vin)
+            return render_template("vehiculo_form.html", cliente=cliente, vehiculo=vehiculo, datos=request.form)
 
-        con.commit()
-        con.close()
+        flash_diagnosticos_vinculados(vinculados)
 
-        backup_db_if_changed()
         return redirect(url_for("vehiculos_cliente", cliente_id=cliente_id))
 
-    con.close()
     return render_template("vehiculo_form.html", cliente=cliente, vehiculo=vehiculo)
 
 
 @app.route("/vehiculos/eliminar/<int:id>")
 @login_required
 def vehiculo_eliminar(id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT cliente_id FROM vehiculos WHERE id=?", (id,))
     row = cur.fetchone()
 
-    if row:
-        cliente_id = row[0]
-        cur.execute("DELETE FROM vehiculos WHERE id=?", (id,))
-        con.commit()
-        con.close()
+    if not row:
+        return redirect(url_for("clientes"))
 
-        backup_db_if_changed()
-        return redirect(url_for("vehiculos_cliente", cliente_id=cliente_id))
+    cliente_id = row[0]
+    try:
+        with transaccion() as cur:
+            cur.execute("DELETE FROM vehiculos WHERE id=?", (id,))
+    except sqlite3.IntegrityError:
+        flash("No se puede eliminar el vehículo: tiene reparaciones cargadas.", "warning")
 
-    con.close()
-    return redirect(url_for("clientes"))
+    return redirect(url_for("vehiculos_cliente", cliente_id=cliente_id))
 
 
 # =========================
@@ -1522,13 +3732,11 @@ def reparaciones_vehiculo(vehiculo_id):
     desde = request.args.get("desde", "").strip()
     hasta = request.args.get("hasta", "").strip()
 
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     cur.execute("SELECT * FROM vehiculos WHERE id=?", (vehiculo_id,))
     vehiculo = cur.fetchone()
     if not vehiculo:
-        con.close()
         return redirect(url_for("clientes"))
 
     cliente_id = vehiculo["cliente_id"]
@@ -1538,18 +3746,15 @@ def reparaciones_vehiculo(vehiculo_id):
     sql = "SELECT * FROM reparaciones WHERE vehiculo_id=?"
     params = [vehiculo_id]
 
-    if desde:
-        sql += " AND fecha >= ?"
-        params.append(desde)
-    if hasta:
-        sql += " AND fecha <= ?"
-        params.append(hasta)
+    filtro, params_fecha = filtro_rango_fechas("fecha", desde, hasta)
+    if filtro:
+        sql += " AND " + filtro
+        params.extend(params_fecha)
 
     sql += " ORDER BY fecha DESC, id DESC"
 
     cur.execute(sql, params)
     reparaciones = cur.fetchall()
-    con.close()
 
     return render_template(
         "reparaciones.html",
@@ -1564,13 +3769,11 @@ def reparaciones_vehiculo(vehiculo_id):
 @app.route("/vehiculos/<int:vehiculo_id>/reparaciones/nueva", methods=["GET", "POST"])
 @login_required
 def reparacion_nueva(vehiculo_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     cur.execute("SELECT * FROM vehiculos WHERE id=?", (vehiculo_id,))
     vehiculo = cur.fetchone()
     if not vehiculo:
-        con.close()
         return redirect(url_for("clientes"))
 
     cliente_id = vehiculo["cliente_id"]
@@ -1578,7 +3781,7 @@ def reparacion_nueva(vehiculo_id):
     cliente = cur.fetchone()
 
     if request.method == "POST":
-        fecha = request.form.get("fecha", "")
+        fecha = parsear_fecha_texto(request.form.get("fecha"))
         descripcion = request.form.get("descripcion", "").strip()
         notas = request.form.get("notas", "").strip()
         km = request.form.get("km", "").strip()
@@ -1587,31 +3790,27 @@ def reparacion_nueva(vehiculo_id):
         if estado not in ESTADOS:
             estado = "Presupuesto"
 
-        cur.execute("""
-            INSERT INTO reparaciones (vehiculo_id, fecha, descripcion, notas, estado, km)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (vehiculo_id, fecha, descripcion, notas, estado, km))
-
-        reparacion_id = cur.lastrowid
-
-        km_num = parsear_km(km)
-        if km_num is not None:
-            actualizar_km_vehiculo_si_corresponde(
-                cur,
-                vehiculo_id=vehiculo_id,
-                km_nuevo=km_num,
-                fuente="Carga manual reparación",
-                reparacion_id=reparacion_id,
-                fecha=fecha
-            )
-
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("""
+                INSERT INTO reparaciones (vehiculo_id, fecha, descripcion, notas, estado, km)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (vehiculo_id, fecha, descripcion, notas, estado, km))
+
+            reparacion_id = cur.lastrowid
+
+            km_num = parsear_km(km)
+            if km_num is not None:
+                actualizar_km_vehiculo_si_corresponde(
+                    cur,
+                    vehiculo_id=vehiculo_id,
+                    km_nuevo=km_num,
+                    fuente="Carga manual reparación",
+                    reparacion_id=reparacion_id,
+                    fecha=fecha
+                )
 
-        backup_db_if_changed()
         return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
-    con.close()
     return render_template(
         "reparacion_form.html",
         cliente=cliente,
@@ -1623,13 +3822,11 @@ def reparacion_nueva(vehiculo_id):
 @app.route("/reparaciones/editar/<int:reparacion_id>", methods=["GET", "POST"])
 @login_required
 def reparacion_editar(reparacion_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     cur.execute("SELECT * FROM reparaciones WHERE id=?", (reparacion_id,))
     reparacion = cur.fetchone()
     if not reparacion:
-        con.close()
         return redirect(url_for("clientes"))
 
     vehiculo_id = reparacion["vehiculo_id"]
@@ -1640,7 +3837,7 @@ def reparacion_editar(reparacion_id):
     cliente = cur.fetchone()
 
     if request.method == "POST":
-        fecha = request.form.get("fecha", "")
+        fecha = parsear_fecha_texto(request.form.get("fecha"))
         descripcion = request.form.get("descripcion", "").strip()
         notas = request.form.get("notas", "").strip()
         km = request.form.get("km", "").strip()
@@ -1649,30 +3846,26 @@ def reparacion_editar(reparacion_id):
         if estado not in ESTADOS:
             estado = "Presupuesto"
 
-        cur.execute("""
-            UPDATE reparaciones
-            SET fecha=?, descripcion=?, notas=?, estado=?, km=?
-            WHERE id=?
-        """, (fecha, descripcion, notas, estado, km, reparacion_id))
-
-        km_num = parsear_km(km)
-        if km_num is not None:
-            actualizar_km_vehiculo_si_corresponde(
-                cur,
-                vehiculo_id=vehiculo_id,
-                km_nuevo=km_num,
-                fuente="Edición reparación",
-                reparacion_id=reparacion_id,
-                fecha=fecha
-            )
-
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("""
+                UPDATE reparaciones
+                SET fecha=?, descripcion=?, notas=?, estado=?, km=?
+                WHERE id=?
+            """, (fecha, descripcion, notas, estado, km, reparacion_id))
+
+            km_num = parsear_km(km)
+            if km_num is not None:
+                actualizar_km_vehiculo_si_corresponde(
+                    cur,
+                    vehiculo_id=vehiculo_id,
+                    km_nuevo=km_num,
+                    fuente="Edición reparación",
+                    reparacion_id=reparacion_id,
+                    fecha=fecha
+                )
 
-        backup_db_if_changed()
         return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
-    con.close()
     return render_template(
         "reparacion_form.html",
         cliente=cliente,
@@ -1685,40 +3878,34 @@ def reparacion_editar(reparacion_id):
 @app.route("/reparaciones/eliminar/<int:reparacion_id>")
 @login_required
 def reparacion_eliminar(reparacion_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     cur.execute("SELECT vehiculo_id FROM reparaciones WHERE id=?", (reparacion_id,))
     row = cur.fetchone()
     if not row:
-        con.close()
         return redirect(url_for("clientes"))
 
     vehiculo_id = row[0]
 
-    cur.execute("DELETE FROM reparacion_items WHERE reparacion_id=?", (reparacion_id,))
-    cur.execute("DELETE FROM reparacion_imagenes WHERE reparacion_id=?", (reparacion_id,))
-    cur.execute("DELETE FROM facturas WHERE reparacion_id=?", (reparacion_id,))
-    cur.execute("DELETE FROM gastos WHERE reparacion_id=?", (reparacion_id,))
-    cur.execute("UPDATE diagnosticos SET reparacion_id=NULL WHERE reparacion_id=?", (reparacion_id,))
-    cur.execute("DELETE FROM reparaciones WHERE id=?", (reparacion_id,))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("DELETE FROM reparacion_items WHERE reparacion_id=?", (reparacion_id,))
+        cur.execute("DELETE FROM reparacion_imagenes WHERE reparacion_id=?", (reparacion_id,))
+        cur.execute("DELETE FROM facturas WHERE reparacion_id=?", (reparacion_id,))
+        cur.execute("DELETE FROM gastos WHERE reparacion_id=?", (reparacion_id,))
+        cur.execute("UPDATE diagnosticos SET reparacion_id=NULL WHERE reparacion_id=?", (reparacion_id,))
+        cur.execute("DELETE FROM reparaciones WHERE id=?", (reparacion_id,))
 
-    backup_db_if_changed()
     return redirect(url_for("reparaciones_vehiculo", vehiculo_id=vehiculo_id))
 
 
 @app.route("/reparaciones/<int:reparacion_id>")
 @login_required
 def reparacion_detalle(reparacion_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     cur.execute("SELECT * FROM reparaciones WHERE id=?", (reparacion_id,))
     reparacion = cur.fetchone()
     if not reparacion:
-        con.close()
         return redirect(url_for("clientes"))
 
     vehiculo_id = reparacion["vehiculo_id"]
@@ -1732,7 +3919,7 @@ def reparacion_detalle(reparacion_id):
     items = cur.fetchall()
 
     cur.execute("""
-        SELECT id, filename, descripcion
+        SELECT id, filename, descripcion, miniatura, mediana, ancho, alto
         FROM reparacion_imagenes
         WHERE reparacion_id=?
         ORDER BY id DESC
@@ -1748,15 +3935,7 @@ def reparacion_detalle(reparacion_id):
     """, (reparacion_id,))
     diagnosticos = cur.fetchall()
 
-    total = 0
-    for it in items:
-        cantidad = it["cantidad"] or 0
-        precio = it["precio_unitario"] or 0
-        descuento = it["descuento"] or 0
-        subtotal = cantidad * precio * (1 - descuento / 100.0)
-        total += subtotal
-
-    con.close()
+    total = reparacion["total"] or 0
 
     return render_template(
         "reparacion_detalle.html",
@@ -1772,21 +3951,18 @@ def reparacion_detalle(reparacion_id):
 @app.route("/diagnosticos/<int:diag_id>/ver")
 @login_required
 def diagnostico_ver(diag_id):
-    con = get_con()
-    cur = con.cursor()
-    cur.execute("SELECT filename FROM diagnosticos WHERE id=?", (diag_id,))
-    row = cur.fetchone()
-    con.close()
+    row = archivo_diagnostico(diag_id)
 
     if not row:
         return redirect(url_for("diagnosticos_listado"))
 
-    filename = row[0]
+    carpeta, ruta, filename = row
 
-    return send_from_directory(
-        UPLOAD_DIAG_FOLDER,
-        filename,
-        as_attachment=False  # 🔥 clave: lo abre en el navegador
+    return enviar_archivo(
+        carpeta,
+        ruta,
+        as_attachment=False,  # 🔥 clave: lo abre en el navegador
+        download_name=filename
     )
 
 @app.route("/dashboard/gasto_rapido", methods=["POST"])
@@ -1801,17 +3977,13 @@ def gasto_rapido():
         flash("Completá categoría y monto válido.", "warning")
         return redirect(url_for("dashboard"))
 
-    con = get_con()
-    cur = con.cursor()
-    cur.execute("""
-        INSERT INTO gastos (fecha, categoria, descripcion, monto)
-        VALUES (?, ?, ?, ?)
-    """, (fecha, categoria, descripcion, monto))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("""
+            INSERT INTO gastos (fecha, categoria, descripcion, monto)
+            VALUES (?, ?, ?, ?)
+        """, (fecha, categoria, descripcion, monto))
 
     flash("Gasto guardado.", "success")
-    backup_db_if_changed()
     return redirect(url_for("dashboard"))
 
 
@@ -1828,8 +4000,8 @@ def reparacion_cambiar_estado(reparacion_id):
         flash("Estado inválido.", "warning")
         return redirect(url_for("dashboard"))
 
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
+    facturar_id = None
 
     if nuevo_estado == "Facturado":
         cur.execute("""
@@ -1842,65 +4014,106 @@ def reparacion_cambiar_estado(reparacion_id):
         fac = cur.fetchone()
 
         if not fac:
-            con.close()
             flash("No hay factura/presupuesto generado en esta reparación.", "warning")
             return redirect(url_for("dashboard"))
 
-        factura_id = fac["id"]
         es_presupuesto = fac["es_presupuesto"]
 
         if (es_presupuesto is None) or int(es_presupuesto) == 1:
             if confirm != "1":
-                con.close()
                 flash("Confirmación requerida para facturar.", "warning")
                 return redirect(url_for("dashboard"))
+            facturar_id = fac["id"]
 
-            cur.execute("UPDATE facturas SET es_presupuesto = 0 WHERE id = ?", (factura_id,))
+    with transaccion() as cur:
+        if facturar_id:
+            confirmar_factura(cur, facturar_id)
 
-            cur.execute("""
-                SELECT COALESCE(SUM(cantidad * precio_unitario * (1 - COALESCE(descuento,0)/100.0)), 0)
-                FROM reparacion_items
-                WHERE reparacion_id = ?
-                  AND UPPER(COALESCE(tipo,'SERVICIO')) = 'REPUESTO'
-            """, (reparacion_id,))
-            total_repuestos = float(cur.fetchone()[0] or 0)
+        cur.execute("UPDATE reparaciones SET estado=? WHERE id=?", (nuevo_estado, reparacion_id))
 
-            cur.execute("""
-                DELETE FROM gastos
-                WHERE reparacion_id = ?
-                  AND categoria = 'Repuestos'
-            """, (reparacion_id,))
+    flash("Estado actualizado.", "success")
+    return redirect(url_for("dashboard"))
 
-            if total_repuestos > 0:
-                hoy = date.today().isoformat()
 
-                cur.execute("""
-                    SELECT v.patente
-                    FROM reparaciones r
-                    JOIN vehiculos v ON v.id = r.vehiculo_id
-                    WHERE r.id = ?
-                """, (reparacion_id,))
-                pat = cur.fetchone()
-                patente = pat[0] if pat else ""
+# =========================
+# Catálogo de conceptos (typeahead de ítems)
+# =========================
+_catalogo_lock = threading.Lock()
+_catalogo_cache = {"generacion": None, "claves": [], "entradas": []}
 
-                descripcion = f"Repuestos reparación #{reparacion_id} - {patente}".strip()
 
-                cur.execute("""
-                    INSERT INTO gastos (
-                        fecha, categoria, descripcion, monto,
-                        pagador, medio_pago, notas,
-                        pagado, fecha_pago, reparacion_id
-                    )
-                    VALUES (?, 'Repuestos', ?, ?, '', NULL, NULL, 0, NULL, ?)
-                """, (hoy, descripcion, total_repuestos, reparacion_id))
+def cargar_catalogo_conceptos(cur):
+    """
+    Conceptos guardados + precios activos, ordenados por nombre para buscar
+    por prefijo con bisect. Si un concepto está en la lista de precios, la
+    entrada trae su tipo y precio.
+    """
+    entradas = {}
 
-    cur.execute("UPDATE reparaciones SET estado=? WHERE id=?", (nuevo_estado, reparacion_id))
-    con.commit()
-    con.close()
+    cur.execute("SELECT id, nombre FROM item_conceptos WHERE COALESCE(nombre,'') <> ''")
+    for concepto_id, nombre in cur.fetchall():
+        clave = nombre.strip().upper()
+        entradas[clave] = {"concepto": clave, "concepto_id": concepto_id, "tipo": None, "precio": None}
 
-    flash("Estado actualizado.", "success")
-    backup_db_if_changed()
-    return redirect(url_for("dashboard"))
+    cur.execute("SELECT concepto, tipo, precio FROM lista_precios WHERE activo = 1")
+    for concepto, tipo, precio in cur.fetchall():
+        clave = (concepto or "").strip().upper()
+        if not clave:
+            continue
+        entrada = entradas.setdefault(clave, {"concepto": clave, "concepto_id": None})
+        entrada["tipo"] = "REPUESTO" if (tipo or "").strip().upper() in TIPOS_REPUESTO else "SERVICIO"
+        entrada["precio"] = precio or 0
+
+    claves = sorted(entradas)
+    return claves, [entradas[c] for c in claves]
+
+
+def get_catalogo_conceptos():
+    """Catálogo en memoria; se rearma solo cuando cambió algo en el DB."""
+    generacion = generacion_escritura()
+    with _catalogo_lock:
+        if _catalogo_cache["generacion"] == generacion:
+            return _catalogo_cache["claves"], _catalogo_cache["entradas"]
+
+    claves, entradas = cargar_catalogo_conceptos(get_db().cursor())
+
+    with _catalogo_lock:
+        _catalogo_cache.update(generacion=generacion, claves=claves, entradas=entradas)
+    return claves, entradas
+
+
+def buscar_conceptos(prefijo, limite=10):
+    claves, entradas = get_catalogo_conceptos()
+    prefijo = prefijo.strip().upper()
+    i = bisect.bisect_left(claves, prefijo)
+    resultados = []
+    while i < len(claves) and len(resultados) < limite and claves[i].startswith(prefijo):
+        resultados.append(entradas[i])
+        i += 1
+    return resultados
+
+
+@app.route("/items/conceptos")
+@login_required
+def item_conceptos_buscar():
+    """Conceptos que empiezan con ?q=, con tipo y precio si están en la lista de precios."""
+    q = (request.args.get("q") or "").strip()
+    try:
+        limite = max(1, min(int(request.args.get("limite") or 10), 50))
+    except ValueError:
+        limite = 10
+
+    if not q:
+        return jsonify(q=q, resultados=[])
+
+    resultados = []
+    for e in buscar_conceptos(q, limite):
+        r = dict(e)
+        if e["concepto_id"]:
+            r["eliminar_url"] = url_for("item_concepto_eliminar", concepto_id=e["concepto_id"])
+        resultados.append(r)
+
+    return jsonify(q=q, resultados=resultados)
 
 
 # =========================
@@ -1909,13 +4122,11 @@ def reparacion_cambiar_estado(reparacion_id):
 @app.route("/reparaciones/<int:reparacion_id>/items/nuevo", methods=["GET", "POST"])
 @login_required
 def item_nuevo(reparacion_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT * FROM reparaciones WHERE id=?", (reparacion_id,))
     reparacion = cur.fetchone()
 
     if not reparacion:
-        con.close()
         return redirect(url_for("clientes"))
 
     if request.method == "POST":
@@ -1928,35 +4139,27 @@ def item_nuevo(reparacion_id):
         if tipo not in ("SERVICIO", "REPUESTO"):
             tipo = "SERVICIO"
 
-        cur.execute("""
-            INSERT INTO reparacion_items (reparacion_id, concepto, cantidad, precio_unitario, descuento, tipo)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (reparacion_id, concepto, cantidad, precio_unitario, descuento, tipo))
+        with transaccion() as cur:
+            cur.execute("""
+                INSERT INTO reparacion_items (reparacion_id, concepto, cantidad, precio_unitario, descuento, tipo)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (reparacion_id, concepto, cantidad, precio_unitario, descuento, tipo))
 
-        cur.execute("INSERT OR IGNORE INTO item_conceptos (nombre) VALUES (?)", (concepto,))
-        con.commit()
-        con.close()
+            cur.execute("INSERT OR IGNORE INTO item_conceptos (nombre) VALUES (?)", (concepto,))
 
-        backup_db_if_changed()
         return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
-    cur.execute("SELECT id, nombre FROM item_conceptos ORDER BY nombre")
-    conceptos = cur.fetchall()
-    con.close()
-
-    return render_template("item_form.html", reparacion=reparacion, conceptos=conceptos)
+    return render_template("item_form.html", reparacion=reparacion)
 
 
 @app.route("/items/editar/<int:item_id>", methods=["GET", "POST"])
 @login_required
 def item_editar(item_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT * FROM reparacion_items WHERE id=?", (item_id,))
     item = cur.fetchone()
 
     if not item:
-        con.close()
         return redirect(url_for("clientes"))
 
     reparacion_id = item["reparacion_id"]
@@ -1973,78 +4176,669 @@ def item_editar(item_id):
         if tipo not in ("SERVICIO", "REPUESTO"):
             tipo = "SERVICIO"
 
-        cur.execute("""
-            UPDATE reparacion_items
-            SET concepto=?, cantidad=?, precio_unitario=?, descuento=?, tipo=?
-            WHERE id=?
-        """, (concepto, cantidad, precio_unitario, descuento, tipo, item_id))
+        with transaccion() as cur:
+            cur.execute("""
+                UPDATE reparacion_items
+                SET concepto=?, cantidad=?, precio_unitario=?, descuento=?, tipo=?
+                WHERE id=?
+            """, (concepto, cantidad, precio_unitario, descuento, tipo, item_id))
 
-        cur.execute("INSERT OR IGNORE INTO item_conceptos (nombre) VALUES (?)", (concepto,))
-        con.commit()
-        con.close()
+            cur.execute("INSERT OR IGNORE INTO item_conceptos (nombre) VALUES (?)", (concepto,))
 
-        backup_db_if_changed()
         return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
-    cur.execute("SELECT id, nombre FROM item_conceptos ORDER BY nombre")
-    conceptos = cur.fetchall()
-    con.close()
-
-    return render_template("item_form.html", item=item, reparacion=reparacion, conceptos=conceptos)
+    return render_template("item_form.html", item=item, reparacion=reparacion)
 
 
 @app.route("/items/eliminar/<int:item_id>")
 @login_required
 def item_eliminar(item_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT reparacion_id FROM reparacion_items WHERE id=?", (item_id,))
     row = cur.fetchone()
 
     if not row:
-        con.close()
         return redirect(url_for("clientes"))
 
     reparacion_id = row[0]
-    cur.execute("DELETE FROM reparacion_items WHERE id=?", (item_id,))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("DELETE FROM reparacion_items WHERE id=?", (item_id,))
 
-    backup_db_if_changed()
     return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
 
 @app.route("/items/concepto/eliminar/<int:concepto_id>")
 @login_required
 def item_concepto_eliminar(concepto_id):
-    con = get_con()
-    cur = con.cursor()
-    cur.execute("DELETE FROM item_conceptos WHERE id=?", (concepto_id,))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("DELETE FROM item_conceptos WHERE id=?", (concepto_id,))
 
-    backup_db_if_changed()
     return redirect(request.referrer or url_for("facturas_listado"))
 
 
+# =========================
+# Almacén de archivos por contenido
+# =========================
+# Fotos y PDFs de Autel se guardan una sola vez por contenido en
+# static/uploads/blobs/ab/cd/<sha256>.<ext>. La tabla blobs lleva cuántas
+# filas de reparacion_imagenes / diagnosticos apuntan a cada uno (refs, lo
+# mantienen los triggers de la migración 14).
+BLOB_FOLDER = "blobs"   # relativo a UPLOAD_FOLDER
+BLOQUE_BLOB = 1024 * 1024
+EXT_EQUIVALENTES = {"jpeg": "jpg"}
+
+
+def ruta_blob(sha256, ext):
+    """Ruta relativa a UPLOAD_FOLDER (sirve tal cual para url_for("archivo_subido", ruta=ruta))."""
+    ext = ext.lower().lstrip(".")
+    ext = EXT_EQUIVALENTES.get(ext, ext)
+    return f"{BLOB_FOLDER}/{sha256[:2]}/{sha256[2:4]}/{sha256}.{ext}"
+
+
+def escribir_blob(stream, ext):
+    """
+    Calcula el sha256 leyendo stream por bloques y escribe a disco sólo si
+    ese contenido no estaba. stream tiene que poder volver al principio
+    (FileStorage.stream, BytesIO, archivo abierto).
+    Devuelve (sha256, ruta, tamanio).
+    """
+    h = hashlib.sha256()
+    tamanio = 0
+    for bloque in iter(lambda: stream.read(BLOQUE_BLOB), b""):
+        h.update(bloque)
+        tamanio += len(bloque)
+    sha = h.hexdigest()
+
+    ruta = ruta_blob(sha, ext)
+    destino = os.path.join(UPLOAD_FOLDER, ruta)
+    try:
+        # ya estaba: se le actualiza el mtime para que limpiar_uploads no lo
+        # tome por huérfano antes de que se haga el commit de la fila nueva
+        os.utime(destino)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        stream.seek(0)
+        tmp = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            shutil.copyfileobj(stream, f, BLOQUE_BLOB)
+        os.replace(tmp, destino)
+
+    return sha, ruta, tamanio
+
+
+def registrar_blobs(cur, blobs):
+    """
+    Alta de blobs [(sha256, ruta, tamanio), ...] con refs en 0. Va antes de
+    insertar las filas que los usan: el trigger de INSERT es el que suma.
+    """
+    now_txt = datetime.now().isoformat(sep=" ", timespec="seconds")
+    cur.executemany("""
+        INSERT INTO blobs (sha256, ruta, tamanio, refs, created_at)
+        VALUES (?, ?, ?, 0, ?)
+        ON CONFLICT(sha256) DO NOTHING
+    """, [(sha, ruta, tamanio, now_txt) for sha, ruta, tamanio in blobs])
+
+
+def liberar_blobs(cur, shas):
+    """
+    Saca del registro los blobs que quedaron sin referencias y devuelve sus
+    rutas, para borrar los archivos después del commit.
+    """
+    cur.execute("""
+        DELETE FROM blobs
+        WHERE sha256 IN (SELECT value FROM json_each(?)) AND refs <= 0
+        RETURNING ruta
+    """, (json.dumps([sha for sha in shas if sha]),))
+    return [r[0] for r in cur.fetchall()]
+
+
+def borrar_archivos_blob(sha, archivos):
+    """
+    Borra los archivos de un blob que liberar_blobs sacó del registro, sólo
+    si después del commit sigue sin fila en blobs (una subida del mismo
+    contenido pudo volver a registrarlo). Se borra con el lock de escritura
+    tomado, así insertar_imagenes ve el archivo o lo vuelve a escribir.
+    """
+    with transaccion() as cur:
+        cur.execute("SELECT 1 FROM blobs WHERE sha256=?", (sha,))
+        if not cur.fetchone():
+            borrar_archivos(archivos)
+
+
+def recontar_refs_blobs(cur, shas=None):
+    """Recalcula refs de todos los blobs, o sólo de shas si se pasa."""
+    if shas is None:
+        cur.execute("""
+            UPDATE blobs
+            SET refs = (SELECT COUNT(*) FROM reparacion_imagenes i WHERE i.sha256 = blobs.sha256)
+                     + (SELECT COUNT(*) FROM diagnosticos d WHERE d.sha256 = blobs.sha256)
+        """)
+        return
+    cur.execute("""
+        UPDATE blobs
+        SET refs = (SELECT COUNT(*) FROM reparacion_imagenes i WHERE i.sha256 = blobs.sha256)
+                 + (SELECT COUNT(*) FROM diagnosticos d WHERE d.sha256 = blobs.sha256)
+        WHERE sha256 IN (SELECT value FROM json_each(?))
+    """, (json.dumps(list(shas)),))
+
+
+def borrar_archivos(rutas):
+    for ruta in rutas:
+        if os.path.exists(ruta):
+            try:
+                os.remove(ruta)
+            except Exception:
+                pass
+
+
+# Lo subido no cambia nunca (blobs y variantes llevan el sha256 en el
+# nombre): se cachea un año en el navegador y se revalida por ETag.
+CACHE_INMUTABLE = 365 * 24 * 3600
+
+# "" = Flask manda los bytes. "x-sendfile" (Apache/lighttpd) o "x-accel"
+# (nginx) = Flask sólo arma los headers y el proxy manda el archivo y
+# resuelve los Range. Para x-accel, X_ACCEL_PREFIJO es una location
+# "internal" de nginx con alias a static/uploads/. USE_X_SENDFILE queda
+# apagado: cambiaría también /static, que el proxy no resuelve igual.
+ENVIO_ARCHIVOS = ""
+X_ACCEL_PREFIJO = "/_uploads/"
+
+_RE_NOMBRE_SHA256 = re.compile(r"^[0-9a-f]{64}(_[a-z]+)?$")
+
+
+def enviar_archivo(carpeta, ruta, **kwargs):
+    """
+    send_from_directory para archivos subidos: ETag fuerte sacado del
+    sha256 del nombre (el de Werkzeug para los archivos viejos),
+    Cache-Control private + immutable, If-None-Match y Range.
+    """
+    nombre = os.path.splitext(os.path.basename(ruta))[0]
+    etag = nombre if _RE_NOMBRE_SHA256.match(nombre) else True
+
+    if ENVIO_ARCHIVOS:
+        # sólo headers (X-Sendfile con la ruta absoluta, sin cuerpo)
+        rv = werkzeug_send_from_directory(
+            os.path.join(app.root_path, carpeta), ruta, request.environ,
+            etag=etag, max_age=CACHE_INMUTABLE, conditional=False,
+            use_x_sendfile=True, response_class=app.response_class, **kwargs
+        )
+    else:
+        rv = send_from_directory(carpeta, ruta, etag=etag, max_age=CACHE_INMUTABLE, **kwargs)
+    # detrás del login: sólo el navegador, no caches compartidas
+    rv.cache_control.public = None
+    rv.cache_control.private = True
+    rv.cache_control.immutable = True
+
+    if ENVIO_ARCHIVOS:
+        # el 304 se contesta acá; el Range lo resuelve el proxy
+        rv = rv.make_conditional(request.environ)
+        x_sendfile = rv.headers.pop("X-Sendfile", None)
+        if rv.status_code != 304 and ENVIO_ARCHIVOS == "x-sendfile":
+            rv.headers["X-Sendfile"] = x_sendfile
+        elif rv.status_code != 304:
+            relativa = os.path.relpath(os.path.join(carpeta, ruta), UPLOAD_FOLDER)
+            rv.headers["X-Accel-Redirect"] = X_ACCEL_PREFIJO + relativa.replace(os.sep, "/")
+    return rv
+
+
+@app.route("/archivos/<path:ruta>")
+@login_required
+def archivo_subido(ruta):
+    """Fotos, variantes y blobs de UPLOAD_FOLDER (ruta como la guarda la DB)."""
+    return enviar_archivo(UPLOAD_FOLDER, ruta)
+
+
+@app.before_request
+def proteger_uploads():
+    # static/uploads también cae en la ruta /static de Flask: sin sesión no se
+    # entrega nada de ahí, salvo los archivos del sitio (GC_IGNORAR). El proxy
+    # tampoco tiene que servir static/uploads directo.
+    if request.endpoint != "static" or "user_id" in session:
+        return None
+    ruta = posixpath.normpath((request.view_args or {}).get("filename") or "")
+    if ruta.startswith("uploads/") and ruta[len("uploads/"):] not in GC_IGNORAR:
+        return redirect(url_for("login"))
+    return None
+
+
+def importar_archivos_viejos(cur):
+    """
+    Pasa al almacén por contenido las fotos y PDFs guardados con nombres
+    viejos y deja las filas apuntando al blob. Devuelve las rutas de los
+    originales, que se pueden borrar recién después del commit.
+    """
+    cur.execute("""
+        SELECT id, filename FROM reparacion_imagenes
+        WHERE sha256 IS NULL AND COALESCE(filename, '') <> ''
+    """)
+    imagenes = cur.fetchall()
+    cur.execute("""
+        SELECT d.id, d.filename, d.sha256
+        FROM diagnosticos d
+        LEFT JOIN blobs b ON b.sha256 = d.sha256
+        WHERE b.sha256 IS NULL AND COALESCE(d.filename, '') <> ''
+    """)
+    diagnosticos = cur.fetchall()
+
+    viejos = []
+    for img_id, filename in imagenes:
+        origen = os.path.join(UPLOAD_FOLDER, filename)
+        if not os.path.isfile(origen):
+            continue
+        with open(origen, "rb") as f:
+            sha, ruta, tamanio = escribir_blob(f, filename.rsplit(".", 1)[-1])
+        registrar_blobs(cur, [(sha, ruta, tamanio)])
+        cur.execute("UPDATE reparacion_imagenes SET filename=?, sha256=? WHERE id=?", (ruta, sha, img_id))
+        viejos.append(origen)
+
+    for diag_id, filename, sha_fila in diagnosticos:
+        origen = os.path.join(UPLOAD_DIAG_FOLDER, filename)
+        if not os.path.isfile(origen):
+            continue
+        with open(origen, "rb") as f:
+            sha, ruta, tamanio = escribir_blob(f, "pdf")
+        if sha_fila and sha_fila != sha:
+            continue   # el archivo no es el que se registró: se deja como está
+        if not sha_fila:
+            cur.execute("SELECT 1 FROM diagnosticos WHERE sha256=?", (sha,))
+            if cur.fetchone():
+                continue   # otro diagnóstico ya tiene ese contenido (sha256 es UNIQUE)
+            cur.execute("UPDATE diagnosticos SET sha256=? WHERE id=?", (sha, diag_id))
+        registrar_blobs(cur, [(sha, ruta, tamanio)])
+        viejos.append(origen)
+
+    recontar_refs_blobs(cur)
+    return viejos
+
+
+@app.cli.command("importar-blobs")
+def cli_importar_blobs():
+    """Pasa al almacén lo que haya quedado con nombres viejos (la migración 14 ya lo hace)."""
+    con = get_con()
+    try:
+        with transaccion(con) as cur:
+            viejos = importar_archivos_viejos(cur)
+            cur.execute("SELECT COUNT(*), COALESCE(SUM(tamanio), 0) FROM blobs")
+            total, tamanio_total = cur.fetchone()
+    finally:
+        con.close()
+
+    borrar_archivos(viejos)
+    print(f"{len(viejos)} archivos importados. Almacén: {total} blobs, {tamanio_total / 1024 / 1024:.1f} MB.")
+
+
+# =========================
+# Limpieza de archivos subidos
+# =========================
+# Archivos de UPLOAD_FOLDER que ninguna fila usa (reparaciones, vehículos o
+# clientes borrados, cargas que fallaron a la mitad). No se borran de una:
+# pasan a CUARENTENA_FOLDER/<fecha-hora>/ con la misma ruta y se borran
+# cuando vence el plazo. Si en el medio alguna fila vuelve a apuntarlos, la
+# próxima pasada los devuelve a su lugar.
+CUARENTENA_FOLDER = "cuarentena"
+GC_DIAS_GRACIA = 7
+GC_EDAD_MINIMA = 3600   # lo recién escrito puede ser de una carga sin commit todavía
+GC_LOTE = 1000
+GC_IGNORAR = {"manifest.json", "sw.js"}   # archivos del sitio que viven en uploads
+_FORMATO_CUARENTENA = "%Y%m%d-%H%M%S"
+
+
+def recorrer_archivos(carpeta):
+    """Genera (ruta relativa con "/", tamanio, mtime) sin armar la lista entera."""
+    pendientes = [carpeta]
+    while pendientes:
+        actual = pendientes.pop()
+        try:
+            it = os.scandir(actual)
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    pendientes.append(e.path)
+                elif e.is_file(follow_symlinks=False):
+                    st = e.stat(follow_symlinks=False)
+                    yield os.path.relpath(e.path, carpeta).replace(os.sep, "/"), st.st_size, st.st_mtime
+
+
+def archivos_sin_referencias(con, archivos):
+    """
+    Carga archivos [(ruta, tamanio, mtime)] (puede ser un generador) en una
+    tabla temporal por lotes y devuelve los que ninguna fila usa, con una
+    sola consulta de diferencia contra la DB.
+    """
+    con.execute("DROP TABLE IF EXISTS temp.gc_archivos")
+    con.execute("CREATE TEMP TABLE gc_archivos (ruta TEXT PRIMARY KEY, tamanio INTEGER, mtime REAL)")
+
+    sql_insert = "INSERT OR IGNORE INTO temp.gc_archivos (ruta, tamanio, mtime) VALUES (?, ?, ?)"
+    lote = []
+    for archivo in archivos:
+        lote.append(archivo)
+        if len(lote) >= GC_LOTE:
+            con.executemany(sql_insert, lote)
+            lote = []
+    con.executemany(sql_insert, lote)
+
+    filas = con.execute("""
+        SELECT a.ruta, a.tamanio, a.mtime
+        FROM temp.gc_archivos a
+        WHERE a.ruta NOT IN (
+            SELECT filename FROM reparacion_imagenes WHERE filename IS NOT NULL
+            UNION ALL
+            SELECT 'variantes/' || miniatura FROM reparacion_imagenes WHERE miniatura IS NOT NULL
+            UNION ALL
+            SELECT 'variantes/' || mediana FROM reparacion_imagenes WHERE mediana IS NOT NULL
+            UNION ALL
+            SELECT 'diagnosticos/' || d.filename FROM diagnosticos d
+            WHERE d.filename IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM blobs b WHERE b.sha256 = d.sha256)
+            UNION ALL
+            SELECT ruta FROM blobs WHERE refs > 0
+        )
+        ORDER BY a.ruta
+    """).fetchall()
+    con.execute("DROP TABLE temp.gc_archivos")
+    return [tuple(f) for f in filas]
+
+
+def mover_archivo(origen, destino):
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    os.replace(origen, destino)
+
+
+def restaurar_de_cuarentena(con, simular=False):
+    """Devuelve a UPLOAD_FOLDER lo que está en cuarentena y alguna fila volvió a usar."""
+    en_cuarentena = {}
+    for ruta, tamanio, mtime in recorrer_archivos(CUARENTENA_FOLDER):
+        lote, _, relativa = ruta.partition("/")
+        en_cuarentena.setdefault(relativa, (lote, tamanio, mtime))
+
+    sin_uso = {r for r, _, _ in archivos_sin_referencias(
+        con, ((r, t, m) for r, (_, t, m) in en_cuarentena.items())
+    )}
+    restaurados = 0
+    for relativa, (lote, _, _) in en_cuarentena.items():
+        destino = os.path.join(UPLOAD_FOLDER, relativa)
+        if relativa in sin_uso or os.path.exists(destino):
+            continue
+        if not simular:
+            mover_archivo(os.path.join(CUARENTENA_FOLDER, lote, relativa), destino)
+        restaurados += 1
+    return restaurados
+
+
+def limpiar_uploads(dias_gracia=GC_DIAS_GRACIA, simular=False):
+    """
+    Una pasada de limpieza: restaura lo que se volvió a usar, borra las
+    cuarentenas vencidas y pone en cuarentena lo que no usa nadie.
+    Se puede correr con la app andando: sólo toca archivos de más de
+    GC_EDAD_MINIMA y vuelve a mirar el mtime justo antes de moverlos
+    (escribir_blob lo actualiza al reusar un blob).
+    """
+    ahora = time.time()
+    res = {
+        "restaurados": 0,
+        "en_cuarentena": 0, "bytes_cuarentena": 0,
+        "borrados": 0, "bytes_liberados": 0,
+    }
+    os.makedirs(CUARENTENA_FOLDER, exist_ok=True)
+    limpiar_subidas_vencidas()
+
+    con = get_con()
+    try:
+        if not simular:
+            # blobs sin filas: el alta y la fila van en la misma transacción,
+            # así que refs en 0 sólo queda cuando se borraron las filas
+            with transaccion(con) as cur:
+                cur.execute("DELETE FROM blobs WHERE refs <= 0")
+
+        res["restaurados"] = restaurar_de_cuarentena(con, simular)
+
+        # cuarentenas vencidas
+        limite = datetime.now() - timedelta(days=dias_gracia)
+        for lote in sorted(os.listdir(CUARENTENA_FOLDER)):
+            try:
+                creado = datetime.strptime(lote, _FORMATO_CUARENTENA)
+            except ValueError:
+                continue
+            if creado >= limite:
+                continue
+            carpeta = os.path.join(CUARENTENA_FOLDER, lote)
+            for _, tamanio, _ in recorrer_archivos(carpeta):
+                res["borrados"] += 1
+                res["bytes_liberados"] += tamanio
+            if not simular:
+                shutil.rmtree(carpeta, ignore_errors=True)
+
+        # huérfanos nuevos
+        archivos = (
+            a for a in recorrer_archivos(UPLOAD_FOLDER)
+            if a[0] not in GC_IGNORAR and a[2] < ahora - GC_EDAD_MINIMA
+        )
+        huerfanos = archivos_sin_referencias(con, archivos)
+
+        lote = os.path.join(CUARENTENA_FOLDER, datetime.now().strftime(_FORMATO_CUARENTENA))
+        movidos = []
+        for ruta, tamanio, mtime in huerfanos:
+            origen = os.path.join(UPLOAD_FOLDER, ruta)
+            try:
+                if os.stat(origen).st_mtime != mtime:
+                    continue   # se tocó mientras tanto: una carga lo está usando
+                if not simular:
+                    mover_archivo(origen, os.path.join(lote, ruta))
+            except OSError:
+                continue
+            movidos.append(ruta)
+            res["en_cuarentena"] += 1
+            res["bytes_cuarentena"] += tamanio
+
+        # una carga pudo hacer commit entre la consulta y el movimiento
+        if movidos and not simular:
+            res["restaurados"] += restaurar_de_cuarentena(con)
+    finally:
+        con.close()
+
+    return res
+
+
+@app.cli.command("limpiar-uploads")
+@click.option("--dias-gracia", default=GC_DIAS_GRACIA, show_default=True, help="Días en cuarentena antes de borrar.")
+@click.option("--simular", is_flag=True, help="Sólo informa, no mueve ni borra nada.")
+def cli_limpiar_uploads(dias_gracia, simular):
+    """Pone en cuarentena los archivos subidos que no usa ninguna fila y borra los vencidos."""
+    res = limpiar_uploads(dias_gracia=dias_gracia, simular=simular)
+    mb = 1024 * 1024
+    print(("(simulado) " if simular else "") +
+          f"En cuarentena: {res['en_cuarentena']} archivos ({res['bytes_cuarentena'] / mb:.1f} MB). "
+          f"Borrados: {res['borrados']} ({res['bytes_liberados'] / mb:.1f} MB liberados). "
+          f"Restaurados: {res['restaurados']}.")
+
+
 # =========================
 # Imágenes
 # =========================
+# Las fotos del celular pesan 1.5-2 MB; en el detalle se muestran variantes
+# livianas (ancho máximo en px) y el original sólo al abrir la foto.
+VARIANTES_IMAGEN = {"miniatura": 320, "mediana": 1280}
+CALIDAD_VARIANTES = 80
+
+
+def generar_variantes_imagen(filename):
+    """
+    Genera las variantes de una foto de UPLOAD_FOLDER en UPLOAD_VARIANTES_FOLDER:
+    giradas según el EXIF y sin metadatos, en WebP (o JPEG si Pillow no trae
+    WebP). Devuelve {"miniatura", "mediana", "ancho", "alto"} o None si no
+    hay Pillow, la imagen no se puede leer o falla la escritura; en ese caso
+    no quedan variantes a medias.
+    """
+    if Image is None:
+        return None
+
+    formato, ext = ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+    base = os.path.basename(filename).rsplit(".", 1)[0]   # en blobs: el sha256
+    res = {}
+    escritas = []
+    completo = False
+    try:
+        with Image.open(os.path.join(UPLOAD_FOLDER, filename)) as original:
+            icc = original.info.get("icc_profile")
+            img = ImageOps.exif_transpose(original)   # GIF animado: primer cuadro
+            res["ancho"], res["alto"] = img.size
+            con_alfa = formato == "WEBP" and img.mode in ("RGBA", "LA", "P")
+            img = img.convert("RGBA" if con_alfa else "RGB")
+
+            for nombre, ancho_max in VARIANTES_IMAGEN.items():
+                variante = img.copy()
+                variante.thumbnail((ancho_max, variante.height))
+                destino = f"{base}_{nombre}.{ext}"
+                ruta = os.path.join(UPLOAD_VARIANTES_FOLDER, destino)
+                # el EXIF no se copia (ubicación, modelo del celular); el perfil de color sí
+                opciones = {"quality": CALIDAD_VARIANTES, "icc_profile": icc}
+                if formato == "JPEG":
+                    opciones.update(optimize=True, progressive=True)
+                # tmp propio de cada escritor: dos pedidos de la misma foto no se pisan
+                tmp = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    variante.save(tmp, formato, **opciones)
+                    if not os.path.exists(ruta):
+                        escritas.append(ruta)
+                    os.replace(tmp, ruta)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                res[nombre] = destino
+        completo = True
+    except (OSError, UnidentifiedImageError) as e:
+        # imagen ilegible, disco lleno, permisos: se avisa y se sirve el original
+        print("Variantes error:", filename, e)
+        return None
+    finally:
+        if not completo:
+            borrar_archivos(escritas)
+
+    return res
+
+
+def guardar_variantes_imagen(cur, img_id, variantes):
+    cur.execute("""
+        UPDATE reparacion_imagenes
+        SET miniatura=?, mediana=?, ancho=?, alto=?
+        WHERE id=?
+    """, (variantes["miniatura"], variantes["mediana"], variantes["ancho"], variantes["alto"], img_id))
+
+
+@app.template_global()
+def urls_imagen(img):
+    """
+    src/srcset de una foto de reparación. Si las variantes todavía no están,
+    apuntan a reparacion_imagen_variante, que las genera en el primer pedido;
+    sin Pillow se usa el original.
+    """
+    original = url_for("archivo_subido", ruta=img["filename"])
+    if img["miniatura"] and img["mediana"]:
+        urls = {n: url_for("archivo_subido", ruta="variantes/" + img[n]) for n in VARIANTES_IMAGEN}
+    elif Image is None:
+        return {"src": original, "srcset": "", "original": original}
+    else:
+        urls = {n: url_for("reparacion_imagen_variante", img_id=img["id"], variante=n) for n in VARIANTES_IMAGEN}
+
+    anchos = {n: min(a, img["ancho"]) if img["ancho"] else a for n, a in VARIANTES_IMAGEN.items()}
+    return {
+        "src": urls["miniatura"],
+        "srcset": ", ".join(f"{urls[n]} {anchos[n]}w" for n in VARIANTES_IMAGEN),
+        "original": original,
+    }
+
+
+@app.route("/reparaciones/imagenes/<int:img_id>/<variante>")
+@login_required
+def reparacion_imagen_variante(img_id, variante):
+    cur = get_db().cursor()
+    cur.execute("SELECT id, filename, miniatura, mediana FROM reparacion_imagenes WHERE id=?", (img_id,))
+    img = cur.fetchone()
+    if not img or variante not in VARIANTES_IMAGEN:
+        return redirect(url_for("clientes"))
+
+    nombre = img[variante]
+    if not nombre or not os.path.exists(os.path.join(UPLOAD_VARIANTES_FOLDER, nombre)):
+        variantes = generar_variantes_imagen(img["filename"])
+        if not variantes:
+            # sin Pillow (o archivo ilegible) queda el original
+            return redirect(url_for("archivo_subido", ruta=img["filename"]))
+        with transaccion() as cur:
+            guardar_variantes_imagen(cur, img_id, variantes)
+        nombre = variantes[variante]
+
+    return enviar_archivo(UPLOAD_VARIANTES_FOLDER, nombre)
+
+
+def preparar_imagen(cur, reparacion_id, stream, ext, descripcion):
+    """
+    Guarda la foto en el almacén y arma sus variantes. Devuelve
+    (blob, fila) para registrar_blobs / INSERT en reparacion_imagenes.
+    """
+    sha, ruta, tamanio = escribir_blob(stream, ext)
+
+    # la misma foto subida de nuevo reusa las variantes que ya tiene
+    cur.execute("""
+        SELECT miniatura, mediana, ancho, alto
+        FROM reparacion_imagenes
+        WHERE sha256=? AND miniatura IS NOT NULL
+        LIMIT 1
+    """, (sha,))
+    v = dict(cur.fetchone() or generar_variantes_imagen(ruta) or {})
+    fila = (
+        reparacion_id, ruta, descripcion, sha,
+        v.get("miniatura"), v.get("mediana"), v.get("ancho"), v.get("alto")
+    )
+    return (sha, ruta, tamanio), fila
+
+
+def insertar_imagenes(blobs, filas, fuentes):
+    """
+    Registra los blobs y las filas de preparar_imagen. fuentes son los
+    streams de cada foto: escribir_blob corre fuera de la transacción y un
+    borrado del mismo contenido pudo llevarse el archivo en el medio (ver
+    borrar_archivos_blob); con el lock tomado se vuelve a escribir.
+    """
+    if not filas:
+        return
+    with transaccion() as cur:
+        for (sha, ruta, _), stream in zip(blobs, fuentes):
+            if not os.path.exists(os.path.join(UPLOAD_FOLDER, ruta)):
+                stream.seek(0)
+                escribir_blob(stream, ruta.rsplit(".", 1)[-1])
+        # variantes reusadas de una fila que se borró: se regeneran al pedirlas
+        filas = [
+            fila[:4] + tuple(
+                n if n and os.path.exists(os.path.join(UPLOAD_VARIANTES_FOLDER, n)) else None
+                for n in fila[4:6]
+            ) + fila[6:]
+            for fila in filas
+        ]
+        registrar_blobs(cur, blobs)
+        cur.executemany("""
+            INSERT INTO reparacion_imagenes (reparacion_id, filename, descripcion, sha256, miniatura, mediana, ancho, alto)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, filas)
+
+
 @app.route("/reparaciones/<int:reparacion_id>/imagenes/nueva", methods=["GET", "POST"])
 @login_required
 def reparacion_imagen_nueva(reparacion_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
     cur.execute("SELECT * FROM reparaciones WHERE id=?", (reparacion_id,))
     reparacion = cur.fetchone()
 
     if not reparacion:
-        con.close()
         return redirect(url_for("clientes"))
 
     if request.method == "POST":
         files = request.files.getlist("imagenes")
         descripcion = request.form.get("descripcion", "").strip()
+        guardados = []
+        blobs = []
+        fuentes = []
 
         for file in files:
             if file and allowed_file(file.filename):
@@ -2053,137 +4847,489 @@ def reparacion_imagen_nueva(reparacion_id):
                     continue
 
                 ext = filename.rsplit(".", 1)[1].lower() if "." in filename else ""
-                unique_name = f"rep_{reparacion_id}_{int(time.time()*1000)}.{ext}"
-                save_path = os.path.join(app.config["UPLOAD_FOLDER"], unique_name)
-
-                file.save(save_path)
+                blob, fila = preparar_imagen(cur, reparacion_id, file.stream, ext, descripcion)
+                blobs.append(blob)
+                guardados.append(fila)
+                fuentes.append(file.stream)
 
-                cur.execute("""
-                    INSERT INTO reparacion_imagenes (reparacion_id, filename, descripcion)
-                    VALUES (?, ?, ?)
-                """, (reparacion_id, unique_name, descripcion))
-
-        con.commit()
-        con.close()
+        insertar_imagenes(blobs, guardados, fuentes)
 
-        backup_db_if_changed()
         return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
-    con.close()
     return render_template("imagen_form.html", reparacion=reparacion)
 
 
+# Subidas por partes: el form de imágenes achica las fotos en el celular y
+# las manda en partes de SUBIDA_PARTE con su CRC32. Si se corta la señal,
+# el navegador pregunta cuánto llegó (GET) y sigue desde ahí. Cada subida
+# es un .json (datos) + un .part (bytes recibidos) en SUBIDAS_FOLDER. Al
+# completar, el .part pasa a .armando (lo toma un solo pedido) y queda un
+# .hecho con el sha256, así repetir el POST contesta lo mismo.
+SUBIDA_PARTE = 256 * 1024
+SUBIDA_MAX = 64 * 1024 * 1024
+SUBIDA_VENCE = 24 * 3600   # las que quedan a medias se borran al día
+
+_RE_SUBIDA_ID = re.compile(r"^[0-9a-f]{32}$")
+_subidas_lock = threading.Lock()
+
+
+def rutas_subida(subida_id):
+    base = os.path.join(SUBIDAS_FOLDER, subida_id)
+    return base + ".json", base + ".part", base + ".armando", base + ".hecho"
+
+
+def leer_subida(subida_id):
+    """Datos de una subida en curso más "recibido" (bytes ya escritos), o None."""
+    if not _RE_SUBIDA_ID.match(subida_id or ""):
+        return None
+    ruta_meta, ruta_part, _, _ = rutas_subida(subida_id)
+    try:
+        with open(ruta_meta, encoding="utf-8") as f:
+            meta = json.load(f)
+        meta["recibido"] = os.path.getsize(ruta_part)
+    except (OSError, ValueError):
+        return None
+    return meta
+
+
+def limpiar_subidas_vencidas():
+    """
+    Borra las subidas sin movimiento hace SUBIDA_VENCE. Se mira el archivo
+    más nuevo de cada una (el .json no cambia mientras el .part crece) y se
+    borran todos sus archivos juntos.
+    """
+    limite = time.time() - SUBIDA_VENCE
+    archivos, ultimo = {}, {}
+    try:
+        with os.scandir(SUBIDAS_FOLDER) as entradas:
+            for entrada in entradas:
+                try:
+                    mtime = entrada.stat().st_mtime
+                except FileNotFoundError:
+                    continue   # otro pedido lo borró o renombró recién
+                subida_id = entrada.name.split(".", 1)[0]
+                archivos.setdefault(subida_id, []).append(entrada.path)
+                ultimo[subida_id] = max(ultimo.get(subida_id, 0), mtime)
+    except OSError:
+        return
+    borrar_archivos([ruta for s, rutas in archivos.items() if ultimo[s] < limite for ruta in rutas])
+
+
+def sha256_subida_hecha(subida_id):
+    """sha256 guardado en el .hecho si la subida ya se completó, o None."""
+    try:
+        with open(rutas_subida(subida_id)[3], encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def respuesta_subida_en_curso():
+    # otro pedido la está guardando: 503 para que el navegador reintente
+    rv = jsonify(ok=False, msg="La subida se está completando.")
+    rv.headers["Retry-After"] = "1"
+    return rv, 503
+
+
+@app.route("/reparaciones/<int:reparacion_id>/imagenes/subidas", methods=["POST"])
+@login_required
+def subida_iniciar(reparacion_id):
+    datos = request.get_json(silent=True) or {}
+    nombre = secure_filename(datos.get("nombre") or "")
+    try:
+        tamanio = int(datos.get("tamanio") or 0)
+    except (TypeError, ValueError):
+        tamanio = 0
+
+    if not nombre or not allowed_file(nombre):
+        return jsonify(ok=False, msg="Tipo de archivo no permitido."), 400
+    if not 0 < tamanio <= SUBIDA_MAX:
+        return jsonify(ok=False, msg="Tamaño de archivo inválido."), 400
+
+    cur = get_db().cursor()
+    cur.execute("SELECT 1 FROM reparaciones WHERE id=?", (reparacion_id,))
+    if not cur.fetchone():
+        return jsonify(ok=False, msg="Reparación no encontrada."), 404
+
+    limpiar_subidas_vencidas()
+
+    subida_id = secrets.token_hex(16)
+    ruta_meta, ruta_part, _, _ = rutas_subida(subida_id)
+    with open(ruta_meta, "w", encoding="utf-8") as f:
+        json.dump({
+            "reparacion_id": reparacion_id,
+            "nombre": nombre,
+            "tamanio": tamanio,
+            "descripcion": (datos.get("descripcion") or "").strip(),
+        }, f)
+    open(ruta_part, "wb").close()
+
+    return jsonify(
+        ok=True,
+        id=subida_id,
+        recibido=0,
+        tamanio_parte=SUBIDA_PARTE,
+        url=url_for("subida_parte", subida_id=subida_id),
+        completar_url=url_for("subida_completar", subida_id=subida_id),
+    )
+
+
+@app.route("/subidas/<subida_id>", methods=["GET", "PUT"])
+@login_required
+def subida_parte(subida_id):
+    """
+    GET: cuánto llegó (para retomar), o completada=True si ya se guardó.
+    PUT ?offset=N: agrega la parte si N es justo lo recibido y el header
+    X-Crc32 (hex) coincide con el cuerpo.
+    """
+    meta = leer_subida(subida_id)
+    if not meta:
+        if request.method == "GET" and _RE_SUBIDA_ID.match(subida_id):
+            sha = sha256_subida_hecha(subida_id)
+            if sha:
+                return jsonify(ok=True, completada=True, sha256=sha)
+            if os.path.exists(rutas_subida(subida_id)[2]):
+                return respuesta_subida_en_curso()
+        return jsonify(ok=False, msg="Subida no encontrada."), 404
+
+    if request.method == "GET":
+        return jsonify(ok=True, recibido=meta["recibido"], tamanio=meta["tamanio"])
+
+    parte = request.get_data(cache=False)
+    offset = request.args.get("offset", type=int)
+    crc = (request.headers.get("X-Crc32") or "").strip().lower()
+
+    if not parte or len(parte) > SUBIDA_PARTE:
+        return jsonify(ok=False, recibido=meta["recibido"], msg="Parte vacía o demasiado grande."), 400
+    if f"{zlib.crc32(parte):08x}" != crc:
+        return jsonify(ok=False, recibido=meta["recibido"], msg="CRC32 no coincide."), 422
+
+    _, ruta_part, _, _ = rutas_subida(subida_id)
+    with _subidas_lock:
+        # el offset se vuelve a mirar acá: un reintento de una parte que ya
+        # había llegado no se escribe dos veces
+        try:
+            recibido = os.path.getsize(ruta_part)
+        except FileNotFoundError:
+            return jsonify(ok=False, msg="La subida ya se está completando."), 409
+        if offset is None or offset != recibido or recibido + len(parte) > meta["tamanio"]:
+            return jsonify(ok=False, recibido=recibido, msg="La parte no sigue a lo recibido."), 409
+        with open(ruta_part, "ab") as f:
+            f.write(parte)
+
+    return jsonify(ok=True, recibido=recibido + len(parte))
+
+
+@app.route("/subidas/<subida_id>/completar", methods=["POST"])
+@login_required
+def subida_completar(subida_id):
+    if not _RE_SUBIDA_ID.match(subida_id or ""):
+        return jsonify(ok=False, msg="Subida no encontrada."), 404
+    ruta_meta, ruta_part, ruta_armando, ruta_hecho = rutas_subida(subida_id)
+
+    # ya completada (reintento de un POST cuya respuesta se perdió)
+    sha = sha256_subida_hecha(subida_id)
+    if sha:
+        return jsonify(ok=True, sha256=sha)
+
+    meta = leer_subida(subida_id)
+    if not meta:
+        if os.path.exists(ruta_armando):
+            return respuesta_subida_en_curso()
+        return jsonify(ok=False, msg="Subida no encontrada."), 404
+    if meta["recibido"] != meta["tamanio"]:
+        return jsonify(ok=False, recibido=meta["recibido"], msg="Faltan partes."), 409
+
+    # la toma un solo pedido: el rename es atómico y las partes se escriben con el lock
+    with _subidas_lock:
+        try:
+            os.rename(ruta_part, ruta_armando)
+        except FileNotFoundError:
+            return respuesta_subida_en_curso()
+
+    ext = meta["nombre"].rsplit(".", 1)[1].lower()
+    cur = get_db().cursor()
+    try:
+        with open(ruta_armando, "rb") as f:
+            blob, fila = preparar_imagen(cur, meta["reparacion_id"], f, ext, meta["descripcion"])
+            insertar_imagenes([blob], [fila], [f])
+    except Exception:
+        os.replace(ruta_armando, ruta_part)   # queda para reintentar
+        raise
+
+    tmp = f"{ruta_hecho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(blob[0])
+    os.replace(tmp, ruta_hecho)
+    borrar_archivos([ruta_meta, ruta_armando])
+
+    return jsonify(ok=True, sha256=blob[0])
+
+
 @app.route("/reparaciones/imagenes/eliminar/<int:img_id>")
 @login_required
 def reparacion_imagen_eliminar(img_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
-    cur.execute("SELECT reparacion_id, filename FROM reparacion_imagenes WHERE id=?", (img_id,))
+    cur.execute("SELECT reparacion_id, filename, sha256, miniatura, mediana FROM reparacion_imagenes WHERE id=?", (img_id,))
     row = cur.fetchone()
 
     if not row:
-        con.close()
         return redirect(url_for("clientes"))
 
-    reparacion_id, filename = row
+    reparacion_id, filename, sha, miniatura, mediana = row
 
-    if filename:
-        file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception:
-                pass
+    with transaccion() as cur:
+        cur.execute("DELETE FROM reparacion_imagenes WHERE id=?", (img_id,))
+        # con sha256 el archivo se borra sólo si ninguna otra fila lo usa
+        libre = bool(liberar_blobs(cur, [sha])) if sha else True
 
-    cur.execute("DELETE FROM reparacion_imagenes WHERE id=?", (img_id,))
-    con.commit()
-    con.close()
+    if libre:
+        archivos = [os.path.join(app.config["UPLOAD_FOLDER"], filename)] if filename else []
+        archivos += [os.path.join(UPLOAD_VARIANTES_FOLDER, n) for n in (miniatura, mediana) if n]
+        if sha:
+            borrar_archivos_blob(sha, archivos)
+        else:
+            borrar_archivos(archivos)
 
-    backup_db_if_changed()
     return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
 
 # =========================
 # Factura / Presupuesto
 # =========================
-@app.route("/reparaciones/<int:reparacion_id>/factura")
-@login_required
-def reparacion_factura(reparacion_id):
-    con = get_con()
-    cur = con.cursor()
+# Caché de facturas renderizadas (LRU en memoria). La clave es el ETag, que
+# sale de las filas que se muestran: factura, reparación (incluye
+# items_version), vehículo, cliente y el usuario logueado.
+FACTURA_CACHE_MAX = 128
+
+_factura_cache_lock = threading.Lock()
+_factura_cache = OrderedDict()
+
+
+def etag_factura(factura, reparacion, vehiculo, cliente):
+    partes = (
+        tuple(factura), tuple(reparacion), tuple(vehiculo), tuple(cliente),
+        session.get("username"), session.get("rol"), request.host_url,
+    )
+    return hashlib.sha1(repr(partes).encode("utf-8")).hexdigest()
+
 
+def _factura_cache_get(etag):
+    with _factura_cache_lock:
+        html = _factura_cache.get(etag)
+        if html is not None:
+            _factura_cache.move_to_end(etag)
+        return html
+
+
+def _factura_cache_put(etag, html):
+    with _factura_cache_lock:
+        _factura_cache[etag] = html
+        _factura_cache.move_to_end(etag)
+        while len(_factura_cache) > FACTURA_CACHE_MAX:
+            _factura_cache.popitem(last=False)
+
+
+def snapshot_factura(cur, reparacion_id):
+    """
+    Foto de lo que se factura: filas de reparación, vehículo, cliente e ítems
+    tal como están ahora, como dicts por nombre de columna (no dependen del
+    orden de columnas si después se rearma una tabla).
+    """
     cur.execute("SELECT * FROM reparaciones WHERE id=?", (reparacion_id,))
     reparacion = cur.fetchone()
     if not reparacion:
-        con.close()
-        return redirect(url_for("clientes"))
+        return None
 
-    vehiculo_id = reparacion["vehiculo_id"]
-    cur.execute("SELECT * FROM vehiculos WHERE id=?", (vehiculo_id,))
+    cur.execute("SELECT * FROM vehiculos WHERE id=?", (reparacion["vehiculo_id"],))
     vehiculo = cur.fetchone()
-    cliente_id = vehiculo["cliente_id"]
-    cur.execute("SELECT * FROM clientes WHERE id=?", (cliente_id,))
+    cur.execute("SELECT * FROM clientes WHERE id=?", ((vehiculo["cliente_id"] if vehiculo else None),))
     cliente = cur.fetchone()
-
     cur.execute("SELECT * FROM reparacion_items WHERE reparacion_id=? ORDER BY id ASC", (reparacion_id,))
     items = cur.fetchall()
 
-    base_total = 0.0
-    subtotal_repuestos = 0.0
-    subtotal_servicios = 0.0
+    return {
+        "reparacion": dict(reparacion),
+        "vehiculo": dict(vehiculo) if vehiculo else {},
+        "cliente": dict(cliente) if cliente else {},
+        "items": [dict(it) for it in items],
+    }
+
 
-    for it in items:
-        cantidad = float(it["cantidad"] or 0)
-        precio = float(it["precio_unitario"] or 0)
-        descuento = float(it["descuento"] or 0)
-        subtotal = cantidad * precio * (1 - descuento / 100.0)
-        base_total += subtotal
+def fila_foto(cur, tabla, valores):
+    """
+    Rearma una fila de la foto (dict por columna) como sqlite3.Row de la
+    tabla actual: se lee por nombre y también por posición, como una fila
+    viva. Las columnas agregadas después de la foto quedan en None.
+    """
+    cur.execute(f"SELECT * FROM {tabla} LIMIT 0")
+    valores = valores or {}
+    return sqlite3.Row(cur, tuple(valores.get(c[0]) for c in cur.description))
 
-        tipo = (it["tipo"] or "SERVICIO").strip().upper()
-        if tipo == "REPUESTO":
-            subtotal_repuestos += subtotal
-        else:
-            subtotal_servicios += subtotal
 
-    cur.execute("""
-        SELECT id, reparacion_id, fecha, total, descuento_global, es_presupuesto, total_servicios, total_repuestos
-        FROM facturas
-        WHERE reparacion_id=?
-    """, (reparacion_id,))
+def confirmar_factura(cur, factura_id):
+    """
+    Confirma la factura: congela totales y la foto de cliente/vehículo/ítems,
+    pasa la reparación a Facturado y regenera el gasto de repuestos.
+    Devuelve el reparacion_id, o None si la factura no existe.
+    """
+    cur.execute("SELECT reparacion_id, descuento_global, es_presupuesto FROM facturas WHERE id=?", (factura_id,))
     row = cur.fetchone()
+    if not row:
+        return None
 
+    reparacion_id = row[0]
+    if row[2] is not None and int(row[2]) == 0:
+        return reparacion_id  # ya confirmada: queda como está
+
+    descuento_global = float(row[1] or 0)
     hoy = date.today().isoformat()
 
-    if not row:
-        descuento_global = 0.0
-        total_final = base_total
+    totales = totales_reparacion(cur, reparacion_id)
+    foto = snapshot_factura(cur, reparacion_id) or {"reparacion": {}, "vehiculo": {}, "cliente": {}, "items": []}
+    cliente = fila_foto(cur, "clientes", foto["cliente"])
+    vehiculo = fila_foto(cur, "vehiculos", foto["vehiculo"])
 
-        cur.execute("""
-            INSERT INTO facturas (reparacion_id, fecha, total, descuento_global, es_presupuesto, total_servicios, total_repuestos)
-            VALUES (?, ?, ?, ?, 1, ?, ?)
-        """, (reparacion_id, hoy, total_final, descuento_global, subtotal_servicios, subtotal_repuestos))
-        con.commit()
-
-        factura_id = cur.lastrowid
-        factura_fecha = hoy
-        es_presupuesto = 1
-    else:
-        factura_id = row[0]
-        factura_fecha = row[2]
-        descuento_global = float(row[4] or 0.0)
-        es_presupuesto = int(row[5] or 1)
+    cur.execute("""
+        UPDATE facturas
+        SET es_presupuesto = 0,
+            total_servicios = ?,
+            total_repuestos = ?,
+            total = ?,
+            fecha = ?,
+            cliente_nombre = ?,
+            cliente_apellido = ?,
+            patente = ?,
+            marca = ?,
+            modelo = ?,
+            snapshot = ?
+        WHERE id=?
+    """, (
+        totales["servicios"],
+        totales["repuestos"],
+        totales["total"] * (1 - descuento_global / 100.0),
+        hoy,
+        cliente["nombre"], cliente["apellido"],
+        vehiculo["patente"], vehiculo["marca"], vehiculo["modelo"],
+        json.dumps(foto, separators=(",", ":"), ensure_ascii=False),
+        factura_id,
+    ))
+
+    cur.execute("UPDATE reparaciones SET estado='Facturado' WHERE id=?", (reparacion_id,))
+
+    cur.execute("""
+        DELETE FROM gastos
+        WHERE reparacion_id = ?
+          AND categoria = 'Repuestos'
+    """, (reparacion_id,))
 
-        total_final = base_total * (1 - descuento_global / 100.0)
+    if totales["repuestos"] > 0:
+        descripcion = f"Repuestos reparación #{reparacion_id} - {vehiculo['patente'] or ''}".strip()
 
         cur.execute("""
-            UPDATE facturas
-            SET total=?, descuento_global=?, total_servicios=?, total_repuestos=?
-            WHERE id=?
-        """, (total_final, descuento_global, subtotal_servicios, subtotal_repuestos, factura_id))
-        con.commit()
+            INSERT INTO gastos (
+                fecha, categoria, descripcion, monto,
+                pagador, medio_pago, notas,
+                pagado, fecha_pago, reparacion_id
+            )
+            VALUES (?, 'Repuestos', ?, ?, '', NULL, NULL, 0, NULL, ?)
+        """, (hoy, descripcion, totales["repuestos"], reparacion_id))
+
+    return reparacion_id
+
+
+@app.route("/reparaciones/<int:reparacion_id>/factura/generar", methods=["POST"])
+@login_required
+def reparacion_factura_generar(reparacion_id):
+    """Crea el presupuesto de la reparación si todavía no tiene factura."""
+    with transaccion() as cur:
+        cur.execute("SELECT id FROM reparaciones WHERE id=?", (reparacion_id,))
+        if not cur.fetchone():
+            return redirect(url_for("clientes"))
+
+        cur.execute("SELECT id FROM facturas WHERE reparacion_id=? LIMIT 1", (reparacion_id,))
+        if not cur.fetchone():
+            cur.execute("""
+                INSERT INTO facturas (reparacion_id, fecha, total, descuento_global, es_presupuesto, total_servicios, total_repuestos)
+                SELECT id, ?, COALESCE(total,0), 0, 1, COALESCE(total_servicios,0), COALESCE(total_repuestos,0)
+                FROM reparaciones
+                WHERE id=?
+            """, (date.today().isoformat(), reparacion_id))
+
+    return redirect(url_for("reparacion_factura", reparacion_id=reparacion_id))
+
+
+@app.route("/reparaciones/<int:reparacion_id>/factura")
+@login_required
+def reparacion_factura(reparacion_id):
+    # sólo lectura: los totales del presupuesto los mantienen los triggers
+    cur = get_db().cursor()
+
+    cur.execute("""
+        SELECT id, reparacion_id, fecha, total, descuento_global, es_presupuesto, total_servicios, total_repuestos, snapshot
+        FROM facturas
+        WHERE reparacion_id=?
+        ORDER BY id DESC
+        LIMIT 1
+    """, (reparacion_id,))
+    factura = cur.fetchone()
+
+    if factura and factura["snapshot"]:
+        # factura confirmada: se reimprime desde la foto, sin tocar las tablas vivas
+        foto = json.loads(factura["snapshot"])
+        reparacion = fila_foto(cur, "reparaciones", foto["reparacion"])
+        vehiculo = fila_foto(cur, "vehiculos", foto["vehiculo"])
+        cliente = fila_foto(cur, "clientes", foto["cliente"])
+        items = [fila_foto(cur, "reparacion_items", it) for it in foto["items"]]
+        subtotal_servicios = float(factura["total_servicios"] or 0)
+        subtotal_repuestos = float(factura["total_repuestos"] or 0)
+    else:
+        cur.execute("SELECT * FROM reparaciones WHERE id=?", (reparacion_id,))
+        reparacion = cur.fetchone()
+        if not reparacion:
+            return redirect(url_for("clientes"))
+
+        if not factura:
+            flash("Primero generá el presupuesto.", "warning")
+            return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
-    tel_raw = cliente["telefono"] if "telefono" in cliente.keys() else (cliente[3] or "")
+        cur.execute("SELECT * FROM vehiculos WHERE id=?", (reparacion["vehiculo_id"],))
+        vehiculo = cur.fetchone()
+        cur.execute("SELECT * FROM clientes WHERE id=?", (vehiculo["cliente_id"],))
+        cliente = cur.fetchone()
+        items = None
+        subtotal_servicios = float(reparacion["total_servicios"] or 0)
+        subtotal_repuestos = float(reparacion["total_repuestos"] or 0)
+
+    # con mensajes flash pendientes la página no se cachea (se consumen al mostrarla)
+    cacheable = "_flashes" not in session
+    etag = etag_factura(factura, reparacion, vehiculo, cliente)
+
+    html = _factura_cache_get(etag) if cacheable else None
+    if html is None:
+        if items is None:
+            cur.execute("SELECT * FROM reparacion_items WHERE reparacion_id=? ORDER BY id ASC", (reparacion_id,))
+            items = cur.fetchall()
+        html = render_factura(factura, reparacion, vehiculo, cliente, items, subtotal_servicios, subtotal_repuestos)
+        if cacheable:
+            _factura_cache_put(etag, html)
+
+    resp = make_response(html)
+    if cacheable:
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+
+def render_factura(factura, reparacion, vehiculo, cliente, items, subtotal_servicios, subtotal_repuestos):
+    reparacion_id = reparacion["id"]
+
+    base_total = subtotal_servicios + subtotal_repuestos
+    descuento_global = float(factura["descuento_global"] or 0.0)
+    es_presupuesto = int(factura["es_presupuesto"] if factura["es_presupuesto"] is not None else 1)
+
+    tel_raw = cliente["telefono"] if cliente else ""
     tel_digits = "".join(ch for ch in (tel_raw or "") if ch.isdigit())
     wa_phone = ""
 
@@ -2197,12 +5343,10 @@ def reparacion_factura(reparacion_id):
 
     presupuesto_url = url_for("reparacion_factura", reparacion_id=reparacion_id, _external=True)
 
-    con.close()
-
     return render_template(
         "factura.html",
-        factura_id=factura_id,
-        factura_fecha=factura_fecha,
+        factura_id=factura["id"],
+        factura_fecha=factura["fecha"],
         cliente=cliente,
         vehiculo=vehiculo,
         reparacion=reparacion,
@@ -2214,25 +5358,24 @@ def reparacion_factura(reparacion_id):
         presupuesto_url=presupuesto_url,
         es_presupuesto=es_presupuesto,
         subtotal_repuestos=subtotal_repuestos,
-        subtotal_servicios=subtotal_servicios
+        subtotal_servicios=subtotal_servicios,
+        tipos_repuesto=TIPOS_REPUESTO
     )
 
 
 @app.route("/facturas/<int:factura_id>/descuento", methods=["POST"])
 @login_required
 def factura_descuento(factura_id):
-    con = get_con()
-    cur = con.cursor()
-
     desc = float(request.form.get("descuento_global") or 0)
-    cur.execute("UPDATE facturas SET descuento_global=? WHERE id=?", (desc, factura_id))
-    con.commit()
+    try:
+        with transaccion() as cur:
+            cur.execute("UPDATE facturas SET descuento_global=? WHERE id=?", (desc, factura_id))
+    except sqlite3.IntegrityError:
+        flash("La factura ya está confirmada: no se puede cambiar el descuento.", "warning")
 
+    cur = get_db().cursor()
     cur.execute("SELECT reparacion_id FROM facturas WHERE id=?", (factura_id,))
     row = cur.fetchone()
-    con.close()
-
-    backup_db_if_changed()
 
     if row:
         return redirect(url_for("reparacion_factura", reparacion_id=row[0]))
@@ -2242,93 +5385,18 @@ def factura_descuento(factura_id):
 @app.route("/facturas/<int:factura_id>/confirmar", methods=["POST"])
 @login_required
 def factura_confirmar(factura_id):
-    con = get_con()
-    cur = con.cursor()
+    with transaccion() as cur:
+        reparacion_id = confirmar_factura(cur, factura_id)
 
-    cur.execute("SELECT reparacion_id FROM facturas WHERE id=?", (factura_id,))
-    row = cur.fetchone()
-    if not row:
-        con.close()
+    if not reparacion_id:
         return redirect(url_for("facturas_listado"))
-
-    reparacion_id = row[0]
-    hoy = date.today().isoformat()
-
-    cur.execute("""
-        SELECT cantidad, precio_unitario, COALESCE(descuento,0), COALESCE(tipo,'SERVICIO')
-        FROM reparacion_items
-        WHERE reparacion_id=?
-    """, (reparacion_id,))
-    items = cur.fetchall()
-
-    total_repuestos = 0.0
-    total_servicios = 0.0
-
-    for cant, precio, desc, tipo in items:
-        cant = float(cant or 0)
-        precio = float(precio or 0)
-        desc = float(desc or 0)
-        subtotal = cant * precio * (1 - desc / 100.0)
-
-        tipo_norm = (tipo or "SERVICIO").strip().upper()
-        if tipo_norm in ("REPUESTO", "REPUESTOS"):
-            total_repuestos += subtotal
-        else:
-            total_servicios += subtotal
-
-    total_final = total_servicios + total_repuestos
-
-    cur.execute("""
-        UPDATE facturas
-        SET es_presupuesto = 0,
-            total_servicios = ?,
-            total_repuestos = ?,
-            total = ?,
-            fecha = ?
-        WHERE id=?
-    """, (total_servicios, total_repuestos, total_final, hoy, factura_id))
-
-    cur.execute("UPDATE reparaciones SET estado='Facturado' WHERE id=?", (reparacion_id,))
-
-    cur.execute("""
-        DELETE FROM gastos
-        WHERE reparacion_id = ?
-          AND categoria = 'Repuestos'
-    """, (reparacion_id,))
-
-    if total_repuestos > 0:
-        cur.execute("""
-            SELECT v.patente
-            FROM reparaciones r
-            JOIN vehiculos v ON v.id = r.vehiculo_id
-            WHERE r.id = ?
-        """, (reparacion_id,))
-        pat = cur.fetchone()
-        patente = pat[0] if pat else ""
-
-        descripcion = f"Repuestos reparación #{reparacion_id} - {patente}".strip()
-
-        cur.execute("""
-            INSERT INTO gastos (
-                fecha, categoria, descripcion, monto,
-                pagador, medio_pago, notas,
-                pagado, fecha_pago, reparacion_id
-            )
-            VALUES (?, 'Repuestos', ?, ?, '', NULL, NULL, 0, NULL, ?)
-        """, (hoy, descripcion, total_repuestos, reparacion_id))
-
-    con.commit()
-    con.close()
-
-    backup_db_if_changed()
     return redirect(url_for("reparacion_detalle", reparacion_id=reparacion_id))
 
 
 @app.route("/facturas", methods=["GET"])
 @login_required
 def facturas_listado():
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     desde = request.args.get("desde") or ""
     hasta = request.args.get("hasta") or ""
@@ -2340,69 +5408,37 @@ def facturas_listado():
             f.total,
             COALESCE(f.total_servicios, f.total) AS total_servicios,
             COALESCE(f.total_repuestos, 0) AS total_repuestos,
-            c.nombre,
-            c.apellido,
-            v.patente,
-            v.marca,
-            v.modelo,
-            r.id
+            f.cliente_nombre,
+            f.cliente_apellido,
+            f.patente,
+            f.marca,
+            f.modelo,
+            f.reparacion_id
         FROM facturas f
-        JOIN reparaciones r ON r.id = f.reparacion_id
-        JOIN vehiculos v ON v.id = r.vehiculo_id
-        JOIN clientes c ON c.id = v.cliente_id
         WHERE COALESCE(f.es_presupuesto,1) = 0
     """
 
-    filtros = []
-    params = []
-
-    if desde:
-        filtros.append("DATE(f.fecha) >= DATE(?)")
-        params.append(desde)
-    if hasta:
-        filtros.append("DATE(f.fecha) <= DATE(?)")
-        params.append(hasta)
-
-    if filtros:
-        sql_f += " AND " + " AND ".join(filtros)
-
-    sql_f += " ORDER BY f.fecha DESC"
-    cur.execute(sql_f, params)
-    facturas = cur.fetchall()
-
-    sql_g = """
-        SELECT id, fecha, categoria, descripcion, monto, pagador, medio_pago, notas, pagado, fecha_pago, reparacion_id
-        FROM gastos
-        WHERE 1=1
-    """
-
-    filtros_g = []
-    params_g = []
-
-    if desde:
-        filtros_g.append("DATE(fecha) >= DATE(?)")
-        params_g.append(desde)
-    if hasta:
-        filtros_g.append("DATE(fecha) <= DATE(?)")
-        params_g.append(hasta)
+    filtro, params = filtro_rango_fechas("COALESCE(f.fecha,'')", desde, hasta)
+    if filtro:
+        sql_f += " AND " + filtro
 
-    if filtros_g:
-        sql_g += " AND " + " AND ".join(filtros_g)
-
-    sql_g += " ORDER BY fecha DESC, id DESC"
-    cur.execute(sql_g, params_g)
-    gastos = cur.fetchall()
+    facturas, siguiente = pagina_keyset(
+        cur, sql_f, params,
+        ["COALESCE(f.fecha,'')", "f.id"],
+        lambda f: (f["fecha"] or "", f["id"]),
+        request.args.get("despues"), tamanio_pagina(), descendente=True,
+    )
 
-    total_ingresos = sum((f[3] or 0) for f in facturas)
-    total_gastos = sum((g[4] or 0) for g in gastos)
+    # los totales del período salen del ledger, no de la página
+    totales = totales_ledger(cur, desde, hasta)
+    total_ingresos = totales["ingresos_servicios"]
+    total_gastos = totales["gastos"]
     balance_neto = total_ingresos - total_gastos
 
-    con.close()
-
     return render_template(
         "facturas.html",
         facturas=facturas,
-        gastos=gastos,
+        siguiente=siguiente,
         desde=desde,
         hasta=hasta,
         total_general=total_ingresos,
@@ -2420,8 +5456,7 @@ def gastos_listado():
     desde = request.args.get("desde", "").strip()
     hasta = request.args.get("hasta", "").strip()
 
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     sql = """
         SELECT id, fecha, categoria, descripcion, monto,
@@ -2429,30 +5464,26 @@ def gastos_listado():
         FROM gastos
         WHERE 1=1
     """
-    params = []
-
-    if desde:
-        sql += " AND fecha >= ?"
-        params.append(desde)
-    if hasta:
-        sql += " AND fecha <= ?"
-        params.append(hasta)
-
-    sql += " ORDER BY fecha DESC, id DESC"
-
-    cur.execute(sql, params)
-    gastos = cur.fetchall()
-    con.close()
+    filtro, params = filtro_rango_fechas("COALESCE(fecha,'')", desde, hasta)
+    if filtro:
+        sql += " AND " + filtro
+
+    gastos, siguiente = pagina_keyset(
+        cur, sql, params,
+        ["COALESCE(fecha,'')", "id"],
+        lambda g: (g["fecha"] or "", g["id"]),
+        request.args.get("despues"), tamanio_pagina(), descendente=True,
+    )
 
-    total_gastos = sum((row[4] or 0) for row in gastos) if gastos else 0
+    total_gastos = totales_ledger(cur, desde, hasta)["gastos"]
 
-    return render_template("gastos.html", gastos=gastos, desde=desde, hasta=hasta, total_gastos=total_gastos)
+    return render_template("gastos.html", gastos=gastos, siguiente=siguiente, desde=desde, hasta=hasta, total_gastos=total_gastos)
 
 
 @app.route("/gastos/nuevo", methods=["POST"])
 @login_required
 def gasto_nuevo():
-    fecha = request.form.get("fecha")
+    fecha = parsear_fecha_texto(request.form.get("fecha"))
     descripcion = request.form.get("descripcion", "").strip()
     monto = request.form.get("monto")
     categoria = request.form.get("categoria", "").strip()
@@ -2466,58 +5497,42 @@ def gasto_nuevo():
     pagado = 0
     fecha_pago = None
 
-    con = get_con()
-    cur = con.cursor()
-
-    cur.execute("""
-        INSERT INTO gastos
-        (fecha, categoria, descripcion, monto, pagador, pagado, fecha_pago)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (fecha, categoria, descripcion, monto, pagador, pagado, fecha_pago))
-
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("""
+            INSERT INTO gastos
+            (fecha, categoria, descripcion, monto, pagador, pagado, fecha_pago)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (fecha, categoria, descripcion, monto, pagador, pagado, fecha_pago))
 
-    backup_db_if_changed()
     return redirect(url_for("gastos_listado"))
 
 
 @app.route("/gastos/eliminar/<int:gasto_id>")
 @login_required
 def gasto_eliminar(gasto_id):
-    con = get_con()
-    cur = con.cursor()
-    cur.execute("DELETE FROM gastos WHERE id=?", (gasto_id,))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("DELETE FROM gastos WHERE id=?", (gasto_id,))
 
-    backup_db_if_changed()
     return redirect(url_for("gastos_listado"))
 
 
 @app.route("/gastos/<int:gasto_id>/toggle_pagado", methods=["POST"])
 @login_required
 def gasto_toggle_pagado(gasto_id):
-    con = get_con()
-    cur = con.cursor()
-
-    cur.execute("""
-        UPDATE gastos
-        SET pagado = CASE COALESCE(pagado,0)
-                        WHEN 0 THEN 1
-                        ELSE 0
-                     END,
-            fecha_pago = CASE COALESCE(pagado,0)
-                            WHEN 0 THEN ?
-                            ELSE NULL
-                         END
-        WHERE id = ?
-    """, (date.today().isoformat(), gasto_id))
-
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("""
+            UPDATE gastos
+            SET pagado = CASE COALESCE(pagado,0)
+                            WHEN 0 THEN 1
+                            ELSE 0
+                         END,
+                fecha_pago = CASE COALESCE(pagado,0)
+                                WHEN 0 THEN ?
+                                ELSE NULL
+                             END
+            WHERE id = ?
+        """, (date.today().isoformat(), gasto_id))
 
-    backup_db_if_changed()
     return redirect(request.referrer or url_for("gastos_listado"))
 
 
@@ -2530,48 +5545,39 @@ def citas_listado():
     desde = request.args.get("desde", "").strip()
     hasta = request.args.get("hasta", "").strip()
 
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     sql = "SELECT id, fecha, hora, cliente_nombre, telefono, descripcion FROM citas WHERE 1=1"
-    params = []
-
-    if desde:
-        sql += " AND fecha >= ?"
-        params.append(desde)
-    if hasta:
-        sql += " AND fecha <= ?"
-        params.append(hasta)
-
-    sql += " ORDER BY fecha ASC, hora ASC"
-
-    cur.execute(sql, params)
-    citas = cur.fetchall()
-    con.close()
+    filtro, params = filtro_rango_fechas("COALESCE(fecha,'')", desde, hasta)
+    if filtro:
+        sql += " AND " + filtro
+
+    citas, siguiente = pagina_keyset(
+        cur, sql, params,
+        ["COALESCE(fecha,'')", "COALESCE(hora,'')", "id"],
+        lambda c: (c["fecha"] or "", c["hora"] or "", c["id"]),
+        request.args.get("despues"), tamanio_pagina(),
+    )
 
-    return render_template("citas.html", citas=citas, desde=desde, hasta=hasta)
+    return render_template("citas.html", citas=citas, siguiente=siguiente, desde=desde, hasta=hasta)
 
 
 @app.route("/citas/nueva", methods=["GET", "POST"])
 @login_required
 def cita_nueva():
     if request.method == "POST":
-        fecha = request.form.get("fecha", "")
+        fecha = fecha_iso(request.form.get("fecha"))
         hora = request.form.get("hora", "")
         cliente_nombre = request.form.get("cliente_nombre", "").strip()
         telefono = request.form.get("telefono", "").strip()
         descripcion = request.form.get("descripcion", "").strip()
 
-        con = get_con()
-        cur = con.cursor()
-        cur.execute("""
-            INSERT INTO citas (fecha, hora, cliente_nombre, telefono, descripcion)
-            VALUES (?, ?, ?, ?, ?)
-        """, (fecha, hora, cliente_nombre, telefono, descripcion))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("""
+                INSERT INTO citas (fecha, hora, cliente_nombre, telefono, descripcion)
+                VALUES (?, ?, ?, ?, ?)
+            """, (fecha, hora, cliente_nombre, telefono, descripcion))
 
-        backup_db_if_changed()
         return redirect(url_for("citas_listado"))
 
     return render_template("cita_form.html")
@@ -2580,30 +5586,25 @@ def cita_nueva():
 @app.route("/citas/editar/<int:cita_id>", methods=["GET", "POST"])
 @login_required
 def cita_editar(cita_id):
-    con = get_con()
-    cur = con.cursor()
-
     if request.method == "POST":
-        fecha = request.form.get("fecha", "")
+        fecha = fecha_iso(request.form.get("fecha"))
         hora = request.form.get("hora", "")
         cliente_nombre = request.form.get("cliente_nombre", "").strip()
         telefono = request.form.get("telefono", "").strip()
         descripcion = request.form.get("descripcion", "").strip()
 
-        cur.execute("""
-            UPDATE citas
-            SET fecha=?, hora=?, cliente_nombre=?, telefono=?, descripcion=?
-            WHERE id=?
-        """, (fecha, hora, cliente_nombre, telefono, descripcion, cita_id))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("""
+                UPDATE citas
+                SET fecha=?, hora=?, cliente_nombre=?, telefono=?, descripcion=?
+                WHERE id=?
+            """, (fecha, hora, cliente_nombre, telefono, descripcion, cita_id))
 
-        backup_db_if_changed()
         return redirect(url_for("citas_listado"))
 
+    cur = get_db().cursor()
     cur.execute("SELECT id, fecha, hora, cliente_nombre, telefono, descripcion FROM citas WHERE id=?", (cita_id,))
     cita = cur.fetchone()
-    con.close()
 
     if not cita:
         return redirect(url_for("citas_listado"))
@@ -2614,13 +5615,9 @@ def cita_editar(cita_id):
 @app.route("/citas/eliminar/<int:cita_id>")
 @login_required
 def cita_eliminar(cita_id):
-    con = get_con()
-    cur = con.cursor()
-    cur.execute("DELETE FROM citas WHERE id=?", (cita_id,))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("DELETE FROM citas WHERE id=?", (cita_id,))
 
-    backup_db_if_changed()
     return redirect(url_for("citas_listado"))
 
 
@@ -2633,8 +5630,7 @@ def lista_precios():
     q = request.args.get("q", "").strip()
     tipo = request.args.get("tipo", "").strip()
 
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     sql = """
         SELECT id, concepto, categoria, tipo, precio, notas, activo
@@ -2652,13 +5648,12 @@ def lista_precios():
         sql += " AND tipo = ?"
         params.append(tipo)
 
-    sql += " ORDER BY concepto ASC"
-
-    cur.execute(sql, params)
-    precios = cur.fetchall()
-    con.close()
+    precios, siguiente = pagina_keyset(
+        cur, sql, params, ["concepto", "id"], lambda p: (p["concepto"], p["id"]),
+        request.args.get("despues"), tamanio_pagina(),
+    )
 
-    return render_template("precios.html", precios=precios, q=q, tipo=tipo)
+    return render_template("precios.html", precios=precios, siguiente=siguiente, q=q, tipo=tipo)
 
 
 @app.route("/precios/nuevo", methods=["GET", "POST"])
@@ -2672,16 +5667,12 @@ def precio_nuevo():
         notas = request.form.get("notas", "").strip()
         activo = 1 if request.form.get("activo") == "1" else 0
 
-        con = get_con()
-        cur = con.cursor()
-        cur.execute("""
-            INSERT INTO lista_precios (concepto, categoria, tipo, precio, notas, activo)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (concepto, categoria, tipo, precio, notas, activo))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("""
+                INSERT INTO lista_precios (concepto, categoria, tipo, precio, notas, activo)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (concepto, categoria, tipo, precio, notas, activo))
 
-        backup_db_if_changed()
         return redirect(url_for("lista_precios"))
 
     return render_template("precio_form.html", precio=None)
@@ -2690,8 +5681,7 @@ def precio_nuevo():
 @app.route("/precios/editar/<int:precio_id>", methods=["GET", "POST"])
 @login_required
 def precio_editar(precio_id):
-    con = get_con()
-    cur = con.cursor()
+    cur = get_db().cursor()
 
     cur.execute("""
         SELECT id, concepto, categoria, tipo, precio, notas, activo
@@ -2701,7 +5691,6 @@ def precio_editar(precio_id):
     precio_item = cur.fetchone()
 
     if not precio_item:
-        con.close()
         return redirect(url_for("lista_precios"))
 
     if request.method == "POST":
@@ -2712,31 +5701,24 @@ def precio_editar(precio_id):
         notas = request.form.get("notas", "").strip()
         activo = 1 if request.form.get("activo") == "1" else 0
 
-        cur.execute("""
-            UPDATE lista_precios
-            SET concepto=?, categoria=?, tipo=?, precio=?, notas=?, activo=?
-            WHERE id=?
-        """, (concepto, categoria, tipo, precio, notas, activo, precio_id))
-        con.commit()
-        con.close()
+        with transaccion() as cur:
+            cur.execute("""
+                UPDATE lista_precios
+                SET concepto=?, categoria=?, tipo=?, precio=?, notas=?, activo=?
+                WHERE id=?
+            """, (concepto, categoria, tipo, precio, notas, activo, precio_id))
 
-        backup_db_if_changed()
         return redirect(url_for("lista_precios"))
 
-    con.close()
     return render_template("precio_form.html", precio=precio_item)
 
 
 @app.route("/precios/eliminar/<int:precio_id>")
 @login_required
 def precio_eliminar(precio_id):
-    con = get_con()
-    cur = con.cursor()
-    cur.execute("DELETE FROM lista_precios WHERE id=?", (precio_id,))
-    con.commit()
-    con.close()
+    with transaccion() as cur:
+        cur.execute("DELETE FROM lista_precios WHERE id=?", (precio_id,))
 
-    backup_db_if_changed()
     return redirect(url_for("lista_precios"))
 
 
@@ -2746,21 +5728,41 @@ def precio_eliminar(precio_id):
 def ensure_folders():
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
     os.makedirs(UPLOAD_DIAG_FOLDER, exist_ok=True)
+    os.makedirs(UPLOAD_VARIANTES_FOLDER, exist_ok=True)
     os.makedirs(BACKUP_FOLDER, exist_ok=True)
+    os.makedirs(SUBIDAS_FOLDER, exist_ok=True)
 
 
-try:
-    ensure_folders()
-    init_db()
-except Exception as e:
-    print("Startup init error:", e)
+_app_lista = False
+_app_lista_lock = threading.Lock()
+
+
+def preparar_app():
+    """
+    Carpetas y migraciones pendientes, una vez por proceso. No corre al
+    importar el módulo: así "flask migrar" ve (y aplica) lo pendiente.
+    """
+    global _app_lista
+    with _app_lista_lock:
+        if _app_lista:
+            return
+        ensure_folders()
+        migrar_db()
+        _app_lista = True
+
+
+@app.before_request
+def iniciar_servicios_fondo():
+    # se arrancan en el proceso que atiende requests (no en el del reloader)
+    preparar_app()
+    iniciar_backup_worker()
+    iniciar_archivador_wal()
 
 
 # =========================
 # Main
 # =========================
 if __name__ == "__main__":
-    ensure_folders()
-    init_db()
-    backup_db_if_changed()
+    preparar_app()
+    ejecutar_backup()
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
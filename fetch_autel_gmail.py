@@ -1,12 +1,12 @@
+import io
 import os
 import re
 import imaplib
 import email
 from email.header import decode_header
 from datetime import datetime
-from pathlib import Path
 
-from app import registrar_diagnostico_autel, UPLOAD_DIAG_FOLDER, file_sha256
+from app import registrar_diagnosticos_autel_lote, escribir_blob, preparar_app, UPLOAD_FOLDER, LOTE_DIAGNOSTICOS
 
 # =========================================
 # CONFIG
@@ -181,9 +181,14 @@ def subject_parece_autel(subject: str):
 
 
 def procesar_mail(mail, msg_id):
-    typ, data = mail.fetch(msg_id, "(RFC822)")
+    """
+    Guarda los PDF adjuntos del mail y devuelve sus datos parseados,
+    listos para registrar_diagnosticos_autel_lote.
+    Lee con BODY.PEEK[]: el mail no queda como leído hasta marcar_leido.
+    """
+    typ, data = mail.fetch(msg_id, "(BODY.PEEK[])")
     if typ != "OK":
-        return
+        return []
 
     raw = data[0][1]
     msg = email.message_from_bytes(raw)
@@ -193,8 +198,9 @@ def procesar_mail(mail, msg_id):
     fecha_mail = decode_mime_words(msg.get("Date", ""))
 
     if not subject_parece_autel(subject):
-        return
+        return []
 
+    diagnosticos = []
     for part in msg.walk():
         content_disposition = str(part.get("Content-Disposition", ""))
         filename = part.get_filename()
@@ -215,31 +221,50 @@ def procesar_mail(mail, msg_id):
         if not payload:
             continue
 
-        Path(UPLOAD_DIAG_FOLDER).mkdir(parents=True, exist_ok=True)
+        # se guarda por sha256: un mail repetido no vuelve a escribir el PDF
+        sha, ruta, tamanio = escribir_blob(io.BytesIO(payload), "pdf")
+        datos = extraer_datos_autel_desde_pdf(os.path.join(UPLOAD_FOLDER, ruta))
 
-        unique_name = f"autel_{int(datetime.now().timestamp())}_{filename_decoded}"
-        save_path = os.path.join(UPLOAD_DIAG_FOLDER, unique_name)
+        diagnosticos.append({
+            "fecha_mail": fecha_mail,
+            "from_email": from_email,
+            "subject": subject,
+            "filename": filename_decoded,
+            "vin": datos["vin"],
+            "marca": datos["marca"],
+            "modelo": datos["modelo"],
+            "odometro": datos["odometro"],
+            "sha256": sha,
+            "ruta": ruta,
+            "tamanio": tamanio,
+        })
 
-        with open(save_path, "wb") as f:
-            f.write(payload)
+    return diagnosticos
 
-        sha = file_sha256(save_path)
-        datos = extraer_datos_autel_desde_pdf(save_path)
 
-        res = registrar_diagnostico_autel(
-            fecha_mail=fecha_mail,
-            from_email=from_email,
-            subject=subject,
-            filename=unique_name,
-            vin=datos["vin"],
-            marca=datos["marca"],
-            modelo=datos["modelo"],
-            odometro=datos["odometro"],
-            sha256=sha,
-            intentar_autovinculo=True
-        )
+def marcar_leidos(mail, msg_ids):
+    mail.store(b",".join(msg_ids), "+FLAGS", "\\Seen")
 
-        print("Diagnóstico procesado:", res)
+
+def registrar_lote_mails(mail, msg_ids, diagnosticos, totales):
+    """
+    Registra los adjuntos de varios mails en una llamada y recién después del
+    commit los marca como leídos: si algo falla, quedan sin leer para la
+    próxima corrida (los PDF van por sha256, reintentar no duplica).
+    """
+    if not msg_ids:
+        return
+    try:
+        res = registrar_diagnosticos_autel_lote(diagnosticos, intentar_autovinculo=True)
+        marcar_leidos(mail, msg_ids)
+    except Exception as e:
+        print(f"Error registrando {len(msg_ids)} mails ->", e)
+        return
+
+    for r in res["resultados"]:
+        print("Diagnóstico procesado:", r)
+    for k in totales:
+        totales[k] += res[k]
 
 
 def main():
@@ -247,16 +272,29 @@ def main():
         print("Falta AUTEL_IMAP_PASS en variables de entorno.")
         return
 
+    preparar_app()
     mail = conectar_imap()
     ids = buscar_mails_no_leidos(mail)
 
     print(f"Mails sin leer: {len(ids)}")
 
+    # de a LOTE_DIAGNOSTICOS mails por llamada; un mail que no se pudo leer
+    # queda afuera del lote (y sin leer)
+    totales = {"total": 0, "nuevos": 0, "actualizados": 0, "vinculados": 0, "segundos": 0.0}
+    lote_ids, lote_diagnosticos = [], []
     for msg_id in ids:
         try:
-            procesar_mail(mail, msg_id)
+            lote_diagnosticos.extend(procesar_mail(mail, msg_id))
         except Exception as e:
             print("Error procesando mail", msg_id, "->", e)
+            continue
+        lote_ids.append(msg_id)
+
+        if len(lote_ids) >= LOTE_DIAGNOSTICOS:
+            registrar_lote_mails(mail, lote_ids, lote_diagnosticos, totales)
+            lote_ids, lote_diagnosticos = [], []
+
+    registrar_lote_mails(mail, lote_ids, lote_diagnosticos, totales)
 
     try:
         mail.close()
@@ -264,6 +302,11 @@ def main():
         pass
     mail.logout()
 
+    print(
+        f"Diagnósticos: {totales['total']} ({totales['nuevos']} nuevos, {totales['actualizados']} actualizados, "
+        f"{totales['vinculados']} vinculados) en {totales['segundos']:.2f} s"
+    )
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file